@@ -1,10 +1,12 @@
 from __future__ import annotations
 
+import multiprocessing
 import os
 from logging.config import fileConfig
 
 from alembic import context
-from sqlalchemy import engine_from_config, pool
+from sqlalchemy import engine_from_config, event, pool
+from sqlalchemy.engine import make_url
 
 from src.models import Base
 
@@ -16,6 +18,26 @@ if config.config_file_name is not None:
 
 target_metadata = Base.metadata
 
+# Migrations are DDL-heavy: WAL + NORMAL sync avoid an fsync per statement,
+# a bigger page cache / mmap keep the schema b-trees in memory.
+SQLITE_PRAGMAS = (
+    # no-op unless the database is still empty; must come before the first CREATE TABLE
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=2147483648",
+)
+
+# Refresh planner statistics after DDL so new indexes are picked up immediately.
+# 0x10002: consider every table, not only ones queried on this connection (SQLite 3.46+;
+# older versions ignore the extra bit). analysis_limit keeps ANALYZE bounded on big tables.
+SQLITE_OPTIMIZE = (
+    "PRAGMA analysis_limit=400",
+    "PRAGMA optimize=0x10002",
+)
+
 
 def _db_url_from_env() -> str:
     # Prefer explicit DATABASE_URL
@@ -28,6 +50,28 @@ def _db_url_from_env() -> str:
     return f"sqlite:///{db_path}"
 
 
+def _db_urls_from_env() -> list[str]:
+    # DATABASE_URLS=url1,url2,... migrates several (e.g. per-tenant) databases in one run
+    urls = [u.strip() for u in os.getenv("DATABASE_URLS", "").split(",") if u.strip()]
+    return urls or [_db_url_from_env()]
+
+
+def _set_sqlite_pragmas(dbapi_conn, _record) -> None:
+    cur = dbapi_conn.cursor()
+    try:
+        for stmt in SQLITE_PRAGMAS:
+            cur.execute(stmt)
+    finally:
+        cur.close()
+    # pysqlite never emits BEGIN before DDL, so every CREATE autocommits (one fsync each).
+    # Take over transaction control and BEGIN explicitly in _sqlite_begin.
+    dbapi_conn.isolation_level = None
+
+
+def _sqlite_begin(conn) -> None:
+    conn.exec_driver_sql("BEGIN")
+
+
 def run_migrations_offline() -> None:
     url = _db_url_from_env()
     context.configure(
@@ -36,28 +80,79 @@ def run_migrations_offline() -> None:
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
         compare_type=True,
+        transactional_ddl=True if url.startswith("sqlite") else None,
     )
 
+    if url.startswith("sqlite"):
+        for stmt in SQLITE_PRAGMAS:
+            context.execute(stmt)
+
     with context.begin_transaction():
         context.run_migrations()
+        if url.startswith("sqlite"):
+            for stmt in SQLITE_OPTIMIZE:
+                context.execute(stmt)
 
 
-def run_migrations_online() -> None:
+def _run_migrations_online_for(url: str) -> None:
     configuration = config.get_section(config.config_ini_section) or {}
-    configuration["sqlalchemy.url"] = _db_url_from_env()
+    configuration["sqlalchemy.url"] = url
 
+    # Reuse one pooled connection for the whole run (keeps per-connection PRAGMA state,
+    # avoids reconnects behind PgBouncer). ALEMBIC_NULLPOOL=1 restores the old behaviour.
+    pool_kw: dict = {"pool_pre_ping": False, "pool_recycle": 60}
+    if os.getenv("ALEMBIC_NULLPOOL"):
+        pool_kw = {"poolclass": pool.NullPool}
     connectable = engine_from_config(
         configuration,
         prefix="sqlalchemy.",
-        poolclass=pool.NullPool,
         future=True,
+        **pool_kw,
     )
+    if connectable.dialect.name == "sqlite":
+        # per DBAPI connection, before any transaction is opened
+        event.listen(connectable, "connect", _set_sqlite_pragmas)
+        event.listen(connectable, "begin", _sqlite_begin)
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata, compare_type=True)
+        # all DDL (tables + indexes of every pending revision) commits once
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            compare_type=True,
+            transactional_ddl=True,
+        )
 
         with context.begin_transaction():
             context.run_migrations()
+            if connection.dialect.name == "sqlite":
+                for stmt in SQLITE_OPTIMIZE:
+                    connection.exec_driver_sql(stmt)
+
+
+def run_migrations_online() -> None:
+    urls = _db_urls_from_env()
+    if len(urls) == 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for url in urls:
+            _run_migrations_online_for(url)
+        return
+
+    # Separate databases share nothing, so migrate them in parallel worker processes.
+    # fork (not spawn): children inherit the configured alembic context, and env.py
+    # functions are not importable by name. The parent never opens a connection.
+    mp = multiprocessing.get_context("fork")
+    workers = min(len(urls), os.cpu_count() or 1)
+    failed: list[str] = []
+    for i in range(0, len(urls), workers):
+        procs = [(url, mp.Process(target=_run_migrations_online_for, args=(url,))) for url in urls[i : i + workers]]
+        for _, proc in procs:
+            proc.start()
+        for url, proc in procs:
+            proc.join()
+            if proc.exitcode != 0:
+                failed.append(make_url(url).render_as_string(hide_password=True))
+    if failed:
+        raise RuntimeError(f"migrations failed for: {', '.join(failed)}")
 
 
 if context.is_offline_mode():
@@ -0,0 +1,47 @@
+"""drop user_id-only indexes covered by (user_id, ...) composites
+
+Revision ID: 0004_composite_indexes
+Revises: 0003_goals_weight_checkins
+Create Date: 2026-10-16
+"""
+
+from __future__ import annotations
+
+from alembic import op
+
+
+revision = "0004_composite_indexes"
+down_revision = "0003_goals_weight_checkins"
+branch_labels = None
+depends_on = None
+
+
+# single-column user_id indexes that are a left prefix of an existing composite
+_COVERED = [
+    ("ix_meals_user_id", "meals"),
+    ("ix_coach_notes_user_id", "coach_notes"),
+    ("ix_goals_user_id", "goals"),
+    ("ix_weight_logs_user_id", "weight_logs"),
+    ("ix_daily_checkins_user_id", "daily_checkins"),
+]
+
+
+def upgrade() -> None:
+    for name, table in _COVERED:
+        op.drop_index(name, table_name=table)
+
+    # plans/stats had no composite: replace user_id-only index with (user_id, date)
+    op.create_index("ix_plans_user_date", "plans", ["user_id", "date"], unique=False)
+    op.drop_index("ix_plans_user_id", table_name="plans")
+    op.create_index("ix_stats_user_week", "stats", ["user_id", "week_start"], unique=False)
+    op.drop_index("ix_stats_user_id", table_name="stats")
+
+
+def downgrade() -> None:
+    op.create_index("ix_stats_user_id", "stats", ["user_id"], unique=False)
+    op.drop_index("ix_stats_user_week", table_name="stats")
+    op.create_index("ix_plans_user_id", "plans", ["user_id"], unique=False)
+    op.drop_index("ix_plans_user_date", table_name="plans")
+
+    for name, table in reversed(_COVERED):
+        op.create_index(name, table, ["user_id"], unique=False)
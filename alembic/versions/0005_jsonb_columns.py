@@ -0,0 +1,56 @@
+"""store JSON document columns as JSONB on postgres
+
+Revision ID: 0005_jsonb_columns
+Revises: 0004_composite_indexes
+Create Date: 2026-10-16
+"""
+
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+
+revision = "0005_jsonb_columns"
+down_revision = "0004_composite_indexes"
+branch_labels = None
+depends_on = None
+
+
+_JSON_COLUMNS = [
+    ("users", "dialog_data_json"),
+    ("preferences", "json"),
+    ("meals", "meal_json"),
+    ("plans", "plan_json"),
+    ("coach_notes", "note_json"),
+    ("daily_checkins", "raw_json"),
+    ("foods", "nutriments_json"),
+]
+
+
+def upgrade() -> None:
+    # SQLite keeps TEXT: binary jsonb() needs 3.45+, and documents are always read whole
+    if op.get_context().dialect.name != "postgresql":
+        return
+    for table, col in _JSON_COLUMNS:
+        op.alter_column(
+            table,
+            col,
+            type_=postgresql.JSONB(),
+            existing_type=sa.Text(),
+            postgresql_using=f'"{col}"::jsonb',
+        )
+
+
+def downgrade() -> None:
+    if op.get_context().dialect.name != "postgresql":
+        return
+    for table, col in reversed(_JSON_COLUMNS):
+        op.alter_column(
+            table,
+            col,
+            type_=sa.Text(),
+            existing_type=postgresql.JSONB(),
+            postgresql_using=f'"{col}"::text',
+        )
@@ -0,0 +1,38 @@
+"""telegram_id as BIGINT, meal macros as SMALLINT
+
+Revision ID: 0006_int_widths
+Revises: 0005_jsonb_columns
+Create Date: 2026-10-16
+"""
+
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+
+revision = "0006_int_widths"
+down_revision = "0005_jsonb_columns"
+branch_labels = None
+depends_on = None
+
+
+# grams per meal; calories / total weight can exceed the SMALLINT range and stay INTEGER
+_MACROS = ["protein_g", "fat_g", "carbs_g"]
+
+
+def upgrade() -> None:
+    # SQLite INTEGER is already a 64-bit varint; declared width changes nothing there
+    if op.get_context().dialect.name == "sqlite":
+        return
+    op.alter_column("users", "telegram_id", type_=sa.BigInteger(), existing_type=sa.Integer(), existing_nullable=False)
+    for col in _MACROS:
+        op.alter_column("meals", col, type_=sa.SmallInteger(), existing_type=sa.Integer(), existing_nullable=True)
+
+
+def downgrade() -> None:
+    if op.get_context().dialect.name == "sqlite":
+        return
+    for col in reversed(_MACROS):
+        op.alter_column("meals", col, type_=sa.Integer(), existing_type=sa.SmallInteger(), existing_nullable=True)
+    op.alter_column("users", "telegram_id", type_=sa.Integer(), existing_type=sa.BigInteger(), existing_nullable=False)
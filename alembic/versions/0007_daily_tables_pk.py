@@ -0,0 +1,108 @@
+"""weight_logs / daily_checkins keyed by (user_id, date), WITHOUT ROWID on sqlite
+
+Revision ID: 0007_daily_tables_pk
+Revises: 0006_int_widths
+Create Date: 2026-10-16
+"""
+
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+
+revision = "0007_daily_tables_pk"
+down_revision = "0006_int_widths"
+branch_labels = None
+depends_on = None
+
+
+def _weight_logs_columns() -> list[sa.Column]:
+    return [
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("date", sa.Date(), nullable=False),
+        sa.Column("weight_kg", sa.Float(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+    ]
+
+
+def _daily_checkins_columns() -> list[sa.Column]:
+    return [
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("date", sa.Date(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("calories_ok", sa.Boolean(), nullable=True),
+        sa.Column("protein_ok", sa.Boolean(), nullable=True),
+        sa.Column("steps", sa.Integer(), nullable=True),
+        sa.Column("sleep_hours", sa.Float(), nullable=True),
+        sa.Column("training_done", sa.Boolean(), nullable=True),
+        sa.Column("alcohol", sa.Boolean(), nullable=True),
+        sa.Column("note_text", sa.Text(), nullable=True),
+        sa.Column("raw_json", sa.Text(), nullable=True),
+    ]
+
+
+_TABLES = [
+    ("weight_logs", _weight_logs_columns),
+    ("daily_checkins", _daily_checkins_columns),
+]
+
+
+def _sqlite_rebuild(table: str, columns, *, keyed: bool) -> None:
+    # SQLite can't change a table's primary key / rowid-ness in place: copy into a new table
+    tmp = f"_{table}_new"
+    cols = columns()
+    names = ", ".join(c.name for c in cols)
+    if keyed:
+        op.create_table(
+            tmp,
+            *cols,
+            sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+            sa.PrimaryKeyConstraint("user_id", "date"),
+            sqlite_with_rowid=False,
+        )
+    else:
+        op.create_table(
+            tmp,
+            sa.Column("id", sa.Integer(), primary_key=True, autoincrement=True),
+            *cols,
+            sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        )
+    op.execute(f"INSERT INTO {tmp} ({names}) SELECT {names} FROM {table} ORDER BY user_id, date")
+    op.drop_table(table)
+    op.rename_table(tmp, table)
+
+
+def _dedupe(table: str) -> None:
+    # keep the latest row per (user_id, date) so the new key can't collide: databases whose
+    # schema didn't come from 0003 may lack the unique (user_id, date) index
+    op.execute(
+        f"DELETE FROM {table} WHERE id NOT IN "
+        f"(SELECT MAX(id) FROM {table} GROUP BY user_id, date)"
+    )
+
+
+def upgrade() -> None:
+    sqlite = op.get_context().dialect.name == "sqlite"
+    for table, columns in _TABLES:
+        _dedupe(table)
+        if sqlite:
+            # the unique (user_id, date) index goes away with the old table: the PK replaces it
+            _sqlite_rebuild(table, columns, keyed=True)
+            op.create_index(f"ix_{table}_date", table, ["date"], unique=False)
+        else:
+            op.drop_index(f"ix_{table}_user_date", table_name=table)
+            op.drop_column(table, "id")
+            op.create_primary_key(f"{table}_pkey", table, ["user_id", "date"])
+
+
+def downgrade() -> None:
+    sqlite = op.get_context().dialect.name == "sqlite"
+    for table, columns in reversed(_TABLES):
+        if sqlite:
+            _sqlite_rebuild(table, columns, keyed=False)
+            op.create_index(f"ix_{table}_date", table, ["date"], unique=False)
+        else:
+            op.drop_constraint(f"{table}_pkey", table, type_="primary")
+            op.execute(f"ALTER TABLE {table} ADD COLUMN id SERIAL PRIMARY KEY")
+        op.create_index(f"ix_{table}_user_date", table, ["user_id", "date"], unique=True)
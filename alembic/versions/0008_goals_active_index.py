@@ -0,0 +1,33 @@
+"""partial index for the active goal lookup
+
+Revision ID: 0008_goals_active_index
+Revises: 0007_daily_tables_pk
+Create Date: 2026-10-16
+"""
+
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+
+revision = "0008_goals_active_index"
+down_revision = "0007_daily_tables_pk"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # historical (inactive) goals stay out of the index
+    op.create_index(
+        "ix_goals_user_active",
+        "goals",
+        ["user_id"],
+        unique=False,
+        sqlite_where=sa.text("active = 1"),
+        postgresql_where=sa.text("active"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_goals_user_active", table_name="goals")
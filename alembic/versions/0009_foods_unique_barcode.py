@@ -0,0 +1,33 @@
+"""foods: unique (source, barcode), drop barcode-only index
+
+Revision ID: 0009_foods_unique_barcode
+Revises: 0008_goals_active_index
+Create Date: 2026-10-16
+"""
+
+from __future__ import annotations
+
+from alembic import op
+
+
+revision = "0009_foods_unique_barcode"
+down_revision = "0008_goals_active_index"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # keep the most recently cached row per (source, barcode); barcode-less rows are never looked up
+    op.execute(
+        "DELETE FROM foods WHERE barcode IS NOT NULL AND id NOT IN "
+        "(SELECT MAX(id) FROM foods WHERE barcode IS NOT NULL GROUP BY source, barcode)"
+    )
+    op.drop_index("ix_foods_source_barcode", table_name="foods")
+    op.create_index("ix_foods_source_barcode", "foods", ["source", "barcode"], unique=True)
+    op.drop_index("ix_foods_barcode", table_name="foods")
+
+
+def downgrade() -> None:
+    op.create_index("ix_foods_barcode", "foods", ["barcode"], unique=False)
+    op.drop_index("ix_foods_source_barcode", table_name="foods")
+    op.create_index("ix_foods_source_barcode", "foods", ["source", "barcode"], unique=False)
@@ -1,14 +1,58 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import io
 import shutil
 import subprocess
-import tempfile
+import wave
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 from src.config import settings
 
+try:  # optional: in-process decode via libav, no ffmpeg child process
+    import av
+except ImportError:  # pragma: no cover - depends on environment
+    av = None
 
+_WAV_RATE = 16000
+
+# forwarded / re-sent voice notes: sha256(ogg) -> decoded wav (a 1-minute note is ~2MB)
+_WAV_CACHE: OrderedDict[bytes, bytes] = OrderedDict()
+_WAV_CACHE_SIZE = 16
+
+# Bounded decode workers for the async path: PyAV runs on its own threads (not the shared
+# to_thread pool) and at most the same number of ffmpeg children exist at once. A long-lived
+# ffmpeg can't be reused across requests: it decodes a single ogg container per run.
+_AUDIO_WORKERS = max(1, settings.audio_workers)
+_DECODE_POOL = ThreadPoolExecutor(max_workers=_AUDIO_WORKERS, thread_name_prefix="audio")
+_FFMPEG_SLOTS = asyncio.Semaphore(_AUDIO_WORKERS)
+
+# ogg in via stdin, raw 16kHz mono s16le out via stdout: no temp files.
+# (ffmpeg can't seek back on a pipe to patch WAV sizes, so the header is ours)
+_FFMPEG_ARGS = (
+    "-loglevel",
+    "error",
+    "-threads",
+    "1",
+    "-i",
+    "pipe:0",
+    "-ac",
+    "1",
+    "-ar",
+    str(_WAV_RATE),
+    "-f",
+    "s16le",
+    "pipe:1",
+)
+
+
+@lru_cache(maxsize=1)
 def _ffmpeg_exe() -> str | None:
+    # settings and PATH don't change at runtime: resolve once per process
     if settings.ffmpeg_path:
         p = Path(settings.ffmpeg_path)
         if p.exists():
@@ -16,30 +60,103 @@ def _ffmpeg_exe() -> str | None:
     return shutil.which("ffmpeg")
 
 
-def ogg_opus_to_wav_bytes(ogg_bytes: bytes) -> bytes | None:
+def _pcm16_mono_to_wav(pcm: bytes) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(_WAV_RATE)
+        w.writeframes(pcm)
+    return buf.getvalue()
+
+
+def _decode_with_pyav(ogg_bytes: bytes) -> bytes | None:
+    try:
+        with av.open(io.BytesIO(ogg_bytes)) as container:
+            resampler = av.AudioResampler(format="s16", layout="mono", rate=_WAV_RATE)
+            chunks: list[bytes] = []
+
+            def _take(frames) -> None:
+                for f in frames:
+                    # packed s16 mono: plane 0 holds the samples (plus possible padding)
+                    chunks.append(bytes(f.planes[0])[: f.samples * 2])
+
+            for frame in container.decode(audio=0):
+                _take(resampler.resample(frame))
+            _take(resampler.resample(None))
+    except Exception:
+        return None
+    if not chunks:
+        return None
+    return _pcm16_mono_to_wav(b"".join(chunks))
+
+
+def _decode_with_ffmpeg(ogg_bytes: bytes) -> bytes | None:
     ffmpeg = _ffmpeg_exe()
     if not ffmpeg:
         return None
 
-    with tempfile.TemporaryDirectory() as td:
-        inp = Path(td) / "in.ogg"
-        out = Path(td) / "out.wav"
-        inp.write_bytes(ogg_bytes)
+    proc = subprocess.run((ffmpeg, *_FFMPEG_ARGS), input=ogg_bytes, capture_output=True, check=False)
+    if proc.returncode != 0 or not proc.stdout:
+        return None
+    return _pcm16_mono_to_wav(proc.stdout)
 
-        # 16kHz mono wav
-        cmd = [
+
+async def _decode_with_ffmpeg_async(ogg_bytes: bytes) -> bytes | None:
+    ffmpeg = _ffmpeg_exe()
+    if not ffmpeg:
+        return None
+
+    async with _FFMPEG_SLOTS:
+        proc = await asyncio.create_subprocess_exec(
             ffmpeg,
-            "-y",
-            "-i",
-            str(inp),
-            "-ac",
-            "1",
-            "-ar",
-            "16000",
-            str(out),
-        ]
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
-        if not out.exists():
-            return None
-        return out.read_bytes()
+            *_FFMPEG_ARGS,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        out, _ = await proc.communicate(ogg_bytes)
+    if proc.returncode != 0 or not out:
+        return None
+    return _pcm16_mono_to_wav(out)
+
+
+def _cache_get(key: bytes) -> bytes | None:
+    wav = _WAV_CACHE.get(key)
+    if wav is not None:
+        _WAV_CACHE.move_to_end(key)
+    return wav
+
+
+def _cache_put(key: bytes, wav: bytes | None) -> bytes | None:
+    if wav is not None:
+        _WAV_CACHE[key] = wav
+        _WAV_CACHE.move_to_end(key)
+        while len(_WAV_CACHE) > _WAV_CACHE_SIZE:
+            _WAV_CACHE.popitem(last=False)
+    return wav
+
+
+def ogg_opus_to_wav_bytes(ogg_bytes: bytes) -> bytes | None:
+    key = hashlib.sha256(ogg_bytes).digest()
+    wav = _cache_get(key)
+    if wav is not None:
+        return wav
+    if av is not None:
+        wav = _decode_with_pyav(ogg_bytes)
+        if wav is not None:
+            return _cache_put(key, wav)
+    return _cache_put(key, _decode_with_ffmpeg(ogg_bytes))
+
 
+async def ogg_opus_to_wav_bytes_async(ogg_bytes: bytes) -> bytes | None:
+    """Same as ogg_opus_to_wav_bytes, without blocking the event loop."""
+    key = hashlib.sha256(ogg_bytes).digest()
+    wav = _cache_get(key)
+    if wav is not None:
+        return wav
+    if av is not None:
+        wav = await asyncio.get_running_loop().run_in_executor(_DECODE_POOL, _decode_with_pyav, ogg_bytes)
+        if wav is not None:
+            return _cache_put(key, wav)
+    return _cache_put(key, await _decode_with_ffmpeg_async(ogg_bytes))
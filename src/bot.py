@@ -2,29 +2,31 @@ from __future__ import annotations
 
 import asyncio
 import datetime as dt
-import json
 import math
 import re
 import traceback
-from typing import Any
+from dataclasses import asdict, dataclass, fields
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, TypeVar
 from zoneinfo import ZoneInfo
 
-from sqlalchemy import delete, select
+from sqlalchemy import delete
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import Message
 
 from src.config import settings
-from src.db import SessionLocal
+from src.db import SessionLocal, sqlite_incremental_vacuum_loop
 from src.init_db import init_db
 from src.jsonutil import dumps, loads
 from aiogram.types import ReplyKeyboardRemove
 
-from src.nutrition import compute_targets, compute_targets_with_meta, macros_for_targets
-from src.audio import ogg_opus_to_wav_bytes
+from src.nutrition import compute_targets, compute_targets_with_meta, compute_tdee, macros_for_targets
+from src.audio import ogg_opus_to_wav_bytes_async
 from src.openai_client import text_json, text_output, transcribe_audio, vision_json
 from src.prompts import (
     COACH_ONBOARD_JSON,
@@ -44,6 +46,7 @@ from src.prompts import (
     WEEKLY_ANALYSIS_JSON,
 )
 from src.food_service import FoodService, compute_item_macros
+from src.openfoodfacts import FoodCandidate, close_http as close_off_http
 from src.keyboards import (
     BTN_CANCEL,
     BTN_DAYS_1,
@@ -90,10 +93,15 @@ from src.repositories import (
     WeightLogRepo,
 )
 from src.tg_files import download_telegram_file
-from src.models import CoachNote, DailyCheckin, Goal, Meal, Plan, Stat, User, WeightLog
+from src.models import CoachNote, DailyCheckin, Goal, Meal, Plan, Stat, WeightLog
 
 
+T = TypeVar("T")
+
 router = Router()
+# slash commands live in their own router: plain text skips every Command filter with one prefix check
+commands_router = Router(name="commands")
+commands_router.message.filter(F.text.startswith("/"))
 
 def _utcnow_naive() -> dt.datetime:
     # avoid deprecated datetime.utcnow(); store as naive UTC for SQLite
@@ -114,8 +122,64 @@ ONBOARDING_QUESTIONS = {
 }
 
 
+# compiled once: these run on (nearly) every incoming message
+_WS_RE = re.compile(r"\s+")
+_INT_RE = re.compile(r"(\d+)")
+_FLOAT_RE = re.compile(r"(\d+(?:\.\d+)?)")
+_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+_DIGIT_RE = re.compile(r"\d")
+_BARCODE_RE = re.compile(r"\b(\d{8,14})\b")
+_HHMM_RE = re.compile(r"\d{2}:\d{2}")
+_CYR_RE = re.compile(r"[А-Яа-яЁё]")
+_TIME_RE = re.compile(r"\b([01]?\d|2[0-3]):([0-5]\d)\b")
+_DAY_NUM_RE = re.compile(r"(?:день|day)\s*(\d+)")
+_MEAL_QTY_RE = re.compile(r"\b\d+\s?(?:г|гр|kg|кг|ml|мл|шт)\b")
+# typical food markers for _looks_like_meal: one alternation = one scan instead of 14 `in` checks
+_FOOD_KEYWORDS = ("съел", "поел", "ел ", "завтрак", "обед", "ужин", "перекус", "греч", "куриц", "рис", "паста", "йогур", "творог", "омлет")
+_FOOD_KW_RE = re.compile("|".join(map(re.escape, _FOOD_KEYWORDS)))
+# same trick for the other keyword probes on meal/plan texts
+# ban supplements / powders unless explicitly requested (common low-quality failure in plans)
+_BANNED_FOODS = ("whey", "protein powder", "mass gainer", "gainer", "bca", "bcaa", "creatine", "протеин", "сыворот", "гейнер", "креатин")
+_BANNED_FOOD_RE = re.compile("|".join(map(re.escape, _BANNED_FOODS)))
+_FULL_REGEN_RE = re.compile("|".join(map(re.escape, ("полностью", "переделай", "пересобери", "с нуля", "сделай по-другому", "вкуснее", "разнообраз"))))
+_HIDDEN_KCAL_RISKY_RE = re.compile("|".join(map(re.escape, ("жар", "гриль", "салат", "соус", "сыр", "орех", "майон", "шаур", "бургер", "пицц", "паста"))))
+_HIDDEN_KCAL_GIVEN_RE = re.compile("|".join(map(re.escape, ("масло", "олив", "соус", "майон", "кетч", "алког", "пиво", "вино", "сыр "))))
+_OPENAI_KEY_RE = re.compile(r"\bsk-[A-Za-z0-9]{10,}\b")
+_HTML_LINK_RE = re.compile(r"\s*<a href=\"[^\"]+\">[^<]+</a>\s*(\|\s*)?")
+_MD_BOLD_STAR_RE = re.compile(r"\*\*(.+?)\*\*", re.S)
+_MD_BOLD_UNDER_RE = re.compile(r"__(.+?)__", re.S)
+_MD_ITALIC_STAR_RE = re.compile(r"(?<!\*)\*(?!\*)(.+?)(?<!\*)\*(?!\*)", re.S)
+_MD_ITALIC_UNDER_RE = re.compile(r"(?<!_)_(?!_)(.+?)(?<!_)_(?!_)", re.S)
+
+# yes/no answers in confirmation steps (compared against _norm_text output)
+_AFFIRM = frozenset({"да", "yes", "y", "ок", "ага"})
+_DENY = frozenset({"нет", "no", "n"})
+# reminder/checkin schedules in preferences
+_VALID_DAYS = frozenset({"weekdays", "weekends", "all"})
+_DEFAULT_TZ = "Europe/Prague"
+# cancel and menu buttons: leave any dialog step
+_ESCAPE_TEXTS = frozenset(
+    {
+        BTN_CANCEL,
+        BTN_MENU,
+        BTN_HELP,
+        BTN_PROFILE,
+        BTN_WEIGHT,
+        BTN_LOG_MEAL,
+        BTN_PHOTO_HELP,
+        BTN_PLAN,
+        BTN_WEEK,
+        BTN_REMINDERS,
+        BTN_PROGRESS,
+    }
+)
+
+
 def _norm_text(s: str) -> str:
-    return re.sub(r"\s+", " ", s.strip().lower())
+    return _WS_RE.sub(" ", s.strip().lower())
+
+
+_CANCEL_NORM = frozenset({_norm_text(BTN_CANCEL), "отмена"})
 
 
 def _sanitize_ai_text(s: str) -> str:
@@ -126,19 +190,29 @@ def _sanitize_ai_text(s: str) -> str:
     if not s:
         return s
     t = s.strip()
+    # passes never add markers, so a marker absent now stays absent: skip its scans
+    star = "*" in t
+    under = "_" in t
     # convert common markdown emphasis
     try:
-        t = re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", t, flags=re.S)
-        t = re.sub(r"__(.+?)__", r"<b>\1</b>", t, flags=re.S)
+        if star:
+            t = _MD_BOLD_STAR_RE.sub(r"<b>\1</b>", t)
+        if under:
+            t = _MD_BOLD_UNDER_RE.sub(r"<b>\1</b>", t)
         # italics: single * or _
-        t = re.sub(r"(?<!\*)\*(?!\*)(.+?)(?<!\*)\*(?!\*)", r"<i>\1</i>", t, flags=re.S)
-        t = re.sub(r"(?<!_)_(?!_)(.+?)(?<!_)_(?!_)", r"<i>\1</i>", t, flags=re.S)
+        if star:
+            t = _MD_ITALIC_STAR_RE.sub(r"<i>\1</i>", t)
+        if under:
+            t = _MD_ITALIC_UNDER_RE.sub(r"<i>\1</i>", t)
     except Exception:
         pass
     # normalize bullets a bit
     t = t.replace("•", "- ")
     # remove leftover markdown tokens
-    t = t.replace("*", "").replace("_", "")
+    if star:
+        t = t.replace("*", "")
+    if under:
+        t = t.replace("_", "")
     return t
 
 
@@ -174,29 +248,38 @@ async def _send_html_lines(
     IMPORTANT: never cut HTML tags (e.g. <a href="...">) by slicing mid-string.
     We chunk by whole lines only.
     """
+    max_chunks = 5  # safety: don't spam
+    head = header.strip()
     chunks: list[str] = []
-    cur = header.strip()
+    # current chunk as a line buffer + its joined length: no re-concatenation per line
+    buf: list[str] = [head] if head else []
+    cur_len = len(head)
     for ln in lines:
         ln = str(ln or "").strip()
         if not ln:
             continue
-        cand = cur + ("\n" if cur else "") + ln
-        if len(cand) <= limit:
-            cur = cand
+        cand_len = cur_len + (1 if cur_len else 0) + len(ln)
+        if cand_len <= limit:
+            buf.append(ln)
+            cur_len = cand_len
             continue
         # flush current chunk
-        if cur:
-            chunks.append(cur)
+        if cur_len:
+            chunks.append("\n".join(buf))
+            if len(chunks) >= max_chunks:
+                break
         # start new chunk with header repeated for clarity
-        cur = header.strip() + "\n" + ln
-        if len(cur) > limit:
+        if len(head) + 1 + len(ln) > limit:
             # if a single line is too long, drop links safely (avoid malformed HTML)
-            safe_ln = re.sub(r"\s*<a href=\"[^\"]+\">[^<]+</a>\s*(\|\s*)?", " ", ln).strip()
-            cur = header.strip() + "\n" + safe_ln[: max(0, limit - len(header) - 1)]
-    if cur:
-        chunks.append(cur)
+            safe_ln = _HTML_LINK_RE.sub(" ", ln).strip()
+            ln = safe_ln[: max(0, limit - len(header) - 1)]
+        buf = [head, ln]
+        cur_len = len(head) + 1 + len(ln)
+    else:
+        if cur_len:
+            chunks.append("\n".join(buf))
 
-    for ch in chunks[:5]:  # safety: don't spam
+    for ch in chunks:
         try:
             await message.answer(ch, reply_markup=reply_markup or main_menu_kb())
         except TelegramBadRequest:
@@ -205,7 +288,7 @@ async def _send_html_lines(
 
 
 def _has_cyrillic_text(s: str) -> bool:
-    return any("а" <= ch.lower() <= "я" or ch.lower() == "ё" for ch in (s or ""))
+    return bool(s) and _CYR_RE.search(s) is not None
 
 
 def _coerce_number(x: Any) -> float | None:
@@ -215,13 +298,25 @@ def _coerce_number(x: Any) -> float | None:
     Returns float or None.
     """
     try:
+        t = type(x)
+        if t is float or t is int:
+            return float(x)
         if isinstance(x, bool):
             return None
         if isinstance(x, (int, float)):
             return float(x)
         if isinstance(x, str):
-            s = x.strip().replace(",", ".")
-            m = re.search(r"-?\d+(?:\.\d+)?", s)
+            s = x.strip()
+            if "," in s:
+                s = s.replace(",", ".")
+            # plain "120" / "120.5" (what the model usually sends) skip the regex
+            if s.isdigit() and s.isascii():
+                return float(s)
+            if "." in s:
+                head, _, tail = s.partition(".")
+                if head.isdigit() and tail.isdigit() and s.isascii():
+                    return float(s)
+            m = _NUMBER_RE.search(s)
             if m:
                 return float(m.group(0))
     except Exception:
@@ -236,7 +331,7 @@ def _scrub_secrets(s: str) -> str:
     """
     if not s:
         return s
-    return re.sub(r"\bsk-[A-Za-z0-9]{10,}\b", "sk-***", s)
+    return _OPENAI_KEY_RE.sub("sk-***", s)
 
 
 def _escape_html(s: str) -> str:
@@ -355,10 +450,8 @@ def _normalize_day_plan(plan: dict[str, Any]) -> dict[str, Any]:
             continue
         norm_sl.append({"name_ru": name_ru, "name_cz": name_cz, "grams": float(grams)})
     if not norm_sl:
-        for mm in norm_meals:
-            for pp in (mm.get("products") or []):
-                if isinstance(pp, dict):
-                    norm_sl.append({"name_ru": str(pp.get("name_ru") or ""), "name_cz": str(pp.get("name_cz") or ""), "grams": float(pp.get("grams") or 0)})
+        # products above are already normalized to the same {name_ru, name_cz, grams} shape
+        norm_sl = [dict(pp) for mm in norm_meals for pp in mm["products"]]
 
     return {"meals": norm_meals, "totals": norm_totals, "shopping_list": norm_sl}
 
@@ -368,8 +461,6 @@ def _plan_quality_ok(plan: dict[str, Any], kcal_target: int) -> bool:
         meals = plan.get("meals") or []
         if not isinstance(meals, list) or not meals:
             return False
-        # ban supplements / powders unless explicitly requested (common low-quality failure)
-        banned = ["whey", "protein powder", "mass gainer", "gainer", "bca", "bcaa", "creatine", "протеин", "сыворот", "гейнер", "креатин"]
         for m in meals:
             prods = (m or {}).get("products") or []
             if not isinstance(prods, list) or not prods:
@@ -381,9 +472,7 @@ def _plan_quality_ok(plan: dict[str, Any], kcal_target: int) -> bool:
                     return False
                 low = (name or "").lower()
                 low2 = str((p or {}).get("name_ru") or "").lower()
-                if any(b in low for b in banned):
-                    return False
-                if any(b in low2 for b in banned):
+                if _BANNED_FOOD_RE.search(low) or _BANNED_FOOD_RE.search(low2):
                     return False
         totals = plan.get("totals") or {}
         kcal = _coerce_number(totals.get("kcal"))
@@ -397,12 +486,8 @@ def _plan_quality_ok(plan: dict[str, Any], kcal_target: int) -> bool:
 
 
 async def _load_day_plans(*, plan_repo: PlanRepo, user_id: int, start_date: dt.date, days: int) -> list[dict[str, Any]]:
-    out: list[dict[str, Any]] = []
-    for i in range(days):
-        d = start_date + dt.timedelta(days=i)
-        p = await plan_repo.get_day_plan_json(user_id, d)
-        out.append(p or {})
-    return out
+    by_date = await plan_repo.get_day_plans_json(user_id, start_date, days)
+    return [by_date.get(start_date + dt.timedelta(days=i)) or {} for i in range(days)]
 
 
 async def _send_plans(
@@ -413,9 +498,6 @@ async def _send_plans(
     start_date: dt.date,
     day_plans: list[dict[str, Any]],
 ) -> None:
-    def _norm(s: str) -> str:
-        return re.sub(r"\s+", " ", (s or "").strip().lower())
-
     # Intentionally no shopping list + no recipes by default (chat-first UX).
     # If needed later, we can add "покажи список покупок" as a separate command.
 
@@ -463,8 +545,9 @@ async def _send_plans(
     await message.answer("Если хочешь правку — просто напиши: например «обед 14:30, тренировка 15:30» или «замени ужин на рыбу».", reply_markup=main_menu_kb())
 
 
-def _plan_day_index_from_text(txt: str, *, days: int) -> int:
-    mday = re.search(r"(?:день|day)\s*(\d+)", _norm_text(txt or ""))
+def _plan_day_index_from_text(tnorm: str, *, days: int) -> int:
+    # tnorm: already passed through _norm_text
+    mday = _DAY_NUM_RE.search(tnorm)
     if mday:
         try:
             return max(1, min(int(mday.group(1)), days))
@@ -475,7 +558,7 @@ def _plan_day_index_from_text(txt: str, *, days: int) -> int:
 
 def _looks_like_full_regen(txt: str) -> bool:
     t = _norm_text(txt or "")
-    return any(k in t for k in ["полностью", "переделай", "пересобери", "с нуля", "сделай по-другому", "вкуснее", "разнообраз"])
+    return _FULL_REGEN_RE.search(t) is not None
 
 
 def _extract_times(txt: str) -> list[str]:
@@ -483,7 +566,7 @@ def _extract_times(txt: str) -> list[str]:
         return []
     # Accept both "H:MM" and "HH:MM" and normalize to "HH:MM"
     out: list[str] = []
-    for h, m in re.findall(r"\b([01]?\d|2[0-3]):([0-5]\d)\b", txt):
+    for h, m in _TIME_RE.findall(txt):
         try:
             hh = int(h)
             mm = int(m)
@@ -501,10 +584,6 @@ def _extract_times(txt: str) -> list[str]:
     return uniq
 
 
-def _stable_dumps(obj: Any) -> str:
-    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
-
-
 def _plan_has_time(plan: dict[str, Any] | None, hhmm: str) -> bool:
     if not plan or not hhmm:
         return False
@@ -517,8 +596,9 @@ def _plan_has_time(plan: dict[str, Any] | None, hhmm: str) -> bool:
     return False
 
 
-def _detect_meal_slot(txt: str) -> str | None:
-    t = _norm_text(txt or "")
+def _detect_meal_slot(tnorm: str) -> str | None:
+    # tnorm: already passed through _norm_text
+    t = tnorm
     if "завтрак" in t:
         return "breakfast"
     if "обед" in t:
@@ -590,7 +670,7 @@ def _parse_hhmm(t: str) -> tuple[int, int] | None:
     if not isinstance(t, str):
         return None
     s = t.strip()
-    if not re.fullmatch(r"\d{2}:\d{2}", s):
+    if not _HHMM_RE.fullmatch(s):
         return None
     return int(s[:2]), int(s[3:5])
 
@@ -707,7 +787,7 @@ def _active_targets(
 
 def _parse_int(s: str) -> int | None:
     s = _norm_text(s)
-    m = re.search(r"(\d+)", s)
+    m = _INT_RE.search(s)
     if not m:
         return None
     return int(m.group(1))
@@ -715,71 +795,89 @@ def _parse_int(s: str) -> int | None:
 
 def _parse_float(s: str) -> float | None:
     s = _norm_text(s).replace(",", ".")
-    m = re.search(r"(\d+(?:\.\d+)?)", s)
+    m = _FLOAT_RE.search(s)
     if not m:
         return None
     return float(m.group(1))
 
 
+_SEX_MALE = frozenset({"м", "m", "male", "муж", "мужчина", "мужской"})
+_SEX_FEMALE = frozenset({"ж", "f", "female", "жен", "женщина", "женский"})
+
+
+def _compile_rules(rules: tuple[tuple[str, tuple[str, ...]], ...]) -> tuple[tuple[str, re.Pattern[str]], ...]:
+    # one C-level scan per rule instead of one `in` per keyword; rule order still decides
+    return tuple((key, re.compile("|".join(map(re.escape, toks)))) for key, toks in rules)
+
+
+# first matching rule wins; substrings of the normalized answer
+_GOAL_RULES = _compile_rules(
+    (
+        ("loss", ("пох", "суш", "сниз")),
+        ("maintain", ("подд", "держ")),
+        ("gain", ("набор", "мас")),
+        ("recomp", ("рекомп", "recomp", "подтян", "тонус")),
+    )
+)
+
+# one token per level: a plain `in` beats a one-branch regex
+_ACTIVITY_RULES = (("низ", "low"), ("сред", "medium"), ("выс", "high"))
+
+# tempo keyboard buttons / free text -> GOAL_TEMPO key (emoji survive _norm_text)
+_TEMPO_RULES = _compile_rules(
+    (
+        ("hard", ("жест", "жёст", "быстр", "🔥")),
+        ("standard", ("станд", "✅")),
+        ("soft", ("мяг", "🟢")),
+        ("recomp", ("рекомп", "🧱")),
+        ("maintain", ("поддерж", "⚖")),
+        ("gain", ("набор", "📈")),
+    )
+)
+
+_GOAL_FMT = {
+    "loss": "похудение",
+    "maintain": "поддержание",
+    "gain": "набор",
+    "recomp": "рекомпозиция",
+}
+
+
 def _map_sex(s: str) -> str | None:
     s = _norm_text(s)
-    if s in {"м", "m", "male", "муж", "мужчина", "мужской"}:
+    if s in _SEX_MALE:
         return "male"
-    if s in {"ж", "f", "female", "жен", "женщина", "женский"}:
+    if s in _SEX_FEMALE:
         return "female"
     return None
 
 
 def _map_activity(s: str) -> str | None:
     s = _norm_text(s)
-    if "низ" in s:
-        return "low"
-    if "сред" in s:
-        return "medium"
-    if "выс" in s:
-        return "high"
+    for tok, level in _ACTIVITY_RULES:
+        if tok in s:
+            return level
     return None
 
 
 def _map_goal(s: str) -> str | None:
     s = _norm_text(s)
-    if "пох" in s or "суш" in s or "сниз" in s:
-        return "loss"
-    if "подд" in s or "поддерж" in s or "держ" in s:
-        return "maintain"
-    if "набор" in s or "мас" in s:
-        return "gain"
-    if "рекомп" in s or "рекомпоз" in s or "recomp" in s or "recomposition" in s:
-        return "recomp"
-    if "подтян" in s or "тонус" in s:
-        return "recomp"
+    for goal, rx in _GOAL_RULES:
+        if rx.search(s):
+            return goal
     return None
 
 
 def _parse_tempo_choice(s: str) -> tuple[str, float] | None:
     t = _norm_text(s)
-    if "жест" in t or "жёст" in t or "быстр" in t or "🔥" in s:
-        return "hard", 0.25
-    if "станд" in t or "✅" in s:
-        return "standard", 0.15
-    if "мяг" in t or "🟢" in s:
-        return "soft", 0.10
-    if "рекомп" in t or "🧱" in s:
-        return "recomp", 0.10
-    if "поддерж" in t or "⚖" in s:
-        return "maintain", 0.0
-    if "набор" in t or "📈" in s:
-        return "gain", -0.10
+    for key, rx in _TEMPO_RULES:
+        if rx.search(t):
+            return key, GOAL_TEMPO[key][1]
     return None
 
 
 def _fmt_goal(goal: str) -> str:
-    return {
-        "loss": "похудение",
-        "maintain": "поддержание",
-        "gain": "набор",
-        "recomp": "рекомпозиция",
-    }.get(goal, goal)
+    return _GOAL_FMT.get(goal, goal)
 
 
 def _fmt_pct(p: float) -> str:
@@ -795,6 +893,45 @@ GOAL_TEMPO = {
     "gain": ("Набор", -0.10),
 }
 
+# (key, TDEE multiplier) for the tempo preview; derived from GOAL_TEMPO so the two tables cannot drift apart
+_TEMPO_FACTORS = tuple((k, 1 - pct) for k, (_label, pct) in GOAL_TEMPO.items())
+
+
+@dataclass(slots=True)
+class OnboardingAnswers:
+    """Answers of the classic questionnaire; stored in dialog_data_json as a plain dict."""
+
+    age: int | None = None
+    sex: str | None = None
+    height_cm: float | None = None
+    weight_kg: float | None = None
+    activity_level: str | None = None
+    goal: str | None = None
+    goal_raw: str | None = None
+    deficit_pct: float | None = None
+    tempo_key: str | None = None
+    allergies: str | None = None
+    restrictions: str | None = None
+    favorite_products: str | None = None
+    disliked_products: str | None = None
+
+    @classmethod
+    def from_dict(cls, raw: Any) -> OnboardingAnswers:
+        if not isinstance(raw, dict):
+            return cls()
+        # unknown keys (older dialog states) are dropped
+        return cls(**{f.name: raw[f.name] for f in fields(cls) if f.name in raw})
+
+
+# onboarding steps 1-5: step -> (answers key, parser, min, max, hint on invalid input)
+_ONBOARDING_FIELDS: dict[int, tuple[str, Callable[[str], Any], float | None, float | None, str]] = {
+    1: ("age", _parse_int, 10, 100, "Возраст числом (пример: 29)."),
+    2: ("sex", _map_sex, None, None, "Пол: напиши «м» или «ж»."),
+    3: ("height_cm", _parse_float, 120, 230, "Рост в см (пример: 178)."),
+    4: ("weight_kg", _parse_float, 30, 300, "Вес в кг (пример: 82.5)."),
+    5: ("activity_level", _map_activity, None, None, "Активность: низкий / средний / высокий."),
+}
+
 
 async def _start_onboarding(message: Message, user_repo: UserRepo, user: Any) -> None:
     await user_repo.set_dialog(user, state="onboarding", step=1, data={"answers": {}})
@@ -821,7 +958,7 @@ async def _start_coach_onboarding(message: Message, user_repo: UserRepo, user: A
     )
 
 
-@router.message(Command("start"))
+@commands_router.message(Command("start"))
 async def cmd_start(message: Message) -> None:
     async with SessionLocal() as db:
         repo = UserRepo(db)
@@ -841,17 +978,15 @@ async def cmd_start(message: Message) -> None:
         await db.commit()
 
 
-@router.message(Command("profile"))
+@commands_router.message(Command("profile"))
 async def cmd_profile(message: Message) -> None:
     async with SessionLocal() as db:
         repo = UserRepo(db)
-        pref_repo = PreferenceRepo(db)
-        user = await repo.get_or_create(message.from_user.id, message.from_user.username if message.from_user else None)
+        user, prefs = await repo.get_with_prefs(message.from_user.id, message.from_user.username if message.from_user else None)
         if not user.profile_complete:
             await message.answer("Профиль не заполнен. Напиши /start чтобы пройти анкету.")
             return
 
-        prefs = await pref_repo.get_json(user.id)
         tz = _tz_from_prefs(prefs)
         today_local = dt.datetime.now(dt.timezone.utc).astimezone(tz).date()
         active = _active_targets(prefs=prefs, user=user, date_local=today_local)
@@ -889,7 +1024,7 @@ async def cmd_profile(message: Message) -> None:
         )
 
 
-@router.message(Command("help"))
+@commands_router.message(Command("help"))
 async def cmd_help(message: Message) -> None:
     await message.answer(
         "Команды:\n"
@@ -905,7 +1040,7 @@ async def cmd_help(message: Message) -> None:
     )
 
 
-@router.message(Command("weight"))
+@commands_router.message(Command("weight"))
 async def cmd_weight(message: Message) -> None:
     if not message.from_user:
         return
@@ -919,13 +1054,12 @@ async def cmd_weight(message: Message) -> None:
     async with SessionLocal() as db:
         repo = UserRepo(db)
         pref_repo = PreferenceRepo(db)
-        user = await repo.get_or_create(message.from_user.id, message.from_user.username)
+        user, prefs = await repo.get_with_prefs(message.from_user.id, message.from_user.username)
         if not user.profile_complete:
             await message.answer("Сначала заполним профиль: /start")
             return
 
         user.weight_kg = float(w)
-        prefs = await pref_repo.get_json(user.id)
         deficit_pct = prefs.get("deficit_pct")
         t, meta = compute_targets_with_meta(
             sex=user.sex,  # type: ignore[arg-type]
@@ -938,15 +1072,14 @@ async def cmd_weight(message: Message) -> None:
         )
         # Update meta always, but do NOT overwrite custom targets
         targets_source = str(prefs.get("targets_source") or "coach").strip().lower()
+        prefs_patch: dict[str, Any] = {"bmr_kcal": meta.bmr_kcal, "tdee_kcal": meta.tdee_kcal, "deficit_pct": meta.deficit_pct}
         if targets_source != "custom":
             user.calories_target = t.calories
             user.protein_g_target = t.protein_g
             user.fat_g_target = t.fat_g
             user.carbs_g_target = t.carbs_g
-            await pref_repo.merge(
-                user.id,
-                {"targets_source": "coach", "targets": {"calories": t.calories, "protein_g": t.protein_g, "fat_g": t.fat_g, "carbs_g": t.carbs_g}},
-            )
+            prefs_patch["targets_source"] = "coach"
+            prefs_patch["targets"] = {"calories": t.calories, "protein_g": t.protein_g, "fat_g": t.fat_g, "carbs_g": t.carbs_g}
         else:
             # keep active custom targets mirrored into user table for /profile consistency
             tz = _tz_from_prefs(prefs)
@@ -960,10 +1093,7 @@ async def cmd_weight(message: Message) -> None:
                 user.fat_g_target = int(active["fat_g"])
             if active.get("carbs_g") is not None:
                 user.carbs_g_target = int(active["carbs_g"])
-        await pref_repo.merge(
-            user.id,
-            {"bmr_kcal": meta.bmr_kcal, "tdee_kcal": meta.tdee_kcal, "deficit_pct": meta.deficit_pct},
-        )
+        await pref_repo.merge(user.id, prefs_patch)
         await db.commit()
 
     await message.answer(
@@ -976,40 +1106,50 @@ async def cmd_weight(message: Message) -> None:
         reply_markup=main_menu_kb(),
     )
 
-@router.message(Command("reset"))
+# per-user history tables cleared by /reset
+_USER_HISTORY_MODELS = (Meal, Plan, Stat, CoachNote, Goal, WeightLog, DailyCheckin)
+
+
+def _wipe_user_history(sess: Any, user_id: int) -> None:
+    for model in _USER_HISTORY_MODELS:
+        sess.execute(delete(model).where(model.user_id == user_id))
+
+
+@commands_router.message(Command("reset"))
 async def cmd_reset(message: Message) -> None:
     async with SessionLocal() as db:
         repo = UserRepo(db)
         user = await repo.get_or_create(message.from_user.id, message.from_user.username if message.from_user else None)
         # wipe durable history (meals/plans/stats/notes/goals/weights/checkins) + preferences json
         try:
-            await db.execute(delete(Meal).where(Meal.user_id == user.id))
-            await db.execute(delete(Plan).where(Plan.user_id == user.id))
-            await db.execute(delete(Stat).where(Stat.user_id == user.id))
-            await db.execute(delete(CoachNote).where(CoachNote.user_id == user.id))
-            await db.execute(delete(Goal).where(Goal.user_id == user.id))
-            await db.execute(delete(WeightLog).where(WeightLog.user_id == user.id))
-            await db.execute(delete(DailyCheckin).where(DailyCheckin.user_id == user.id))
+            # one greenlet hop for all deletes; an AsyncSession can't run statements concurrently (no gather)
+            await db.run_sync(_wipe_user_history, user.id)
             # clear preferences json safely (no delete/create)
             pref_repo = PreferenceRepo(db)
             await pref_repo.set_json(user.id, {})
         except Exception:
             pass
-        user.profile_complete = False
-        user.age = None
-        user.sex = None
-        user.height_cm = None
-        user.weight_kg = None
-        user.activity_level = None
-        user.goal = None
-        user.allergies = None
-        user.restrictions = None
-        user.favorite_products = None
-        user.disliked_products = None
-        user.calories_target = None
-        user.protein_g_target = None
-        user.fat_g_target = None
-        user.carbs_g_target = None
+        # through update_profile: a profile_complete change must also drop the cached checkin list
+        await repo.update_profile(
+            user,
+            {
+                "profile_complete": False,
+                "age": None,
+                "sex": None,
+                "height_cm": None,
+                "weight_kg": None,
+                "activity_level": None,
+                "goal": None,
+                "allergies": None,
+                "restrictions": None,
+                "favorite_products": None,
+                "disliked_products": None,
+                "calories_target": None,
+                "protein_g_target": None,
+                "fat_g_target": None,
+                "carbs_g_target": None,
+            },
+        )
         await repo.set_dialog(user, state=None, step=None, data=None)
         await db.commit()
     await message.answer("🧹 Память и профиль сброшены полностью ✅\n\n🚀 Напиши /start — пройдём анкету заново.", reply_markup=main_menu_kb())
@@ -1021,43 +1161,22 @@ async def _handle_onboarding_step(message: Message, user_repo: UserRepo, user: A
 
     step = int(user.dialog_step)
     text = message.text or ""
-    data = await user_repo.get_dialog_data(user) or {"answers": {}}
-    answers: dict[str, Any] = data.get("answers", {})
-
-    if step == 1:
-        age = _parse_int(text)
-        if age is None or not (10 <= age <= 100):
-            await message.answer("Возраст числом (пример: 29).")
-            return True
-        answers["age"] = age
-
-    elif step == 2:
-        sex = _map_sex(text)
-        if sex is None:
-            await message.answer("Пол: напиши «м» или «ж».")
-            return True
-        answers["sex"] = sex
 
-    elif step == 3:
-        h = _parse_float(text)
-        if h is None or not (120 <= h <= 230):
-            await message.answer("Рост в см (пример: 178).")
+    # validate simple fields before touching dialog state
+    field = _ONBOARDING_FIELDS.get(step)
+    value: Any = None
+    if field is not None:
+        _key, parse, lo, hi, hint = field
+        value = parse(text)
+        if value is None or (lo is not None and not (lo <= value <= hi)):
+            await message.answer(hint)
             return True
-        answers["height_cm"] = h
 
-    elif step == 4:
-        w = _parse_float(text)
-        if w is None or not (30 <= w <= 300):
-            await message.answer("Вес в кг (пример: 82.5).")
-            return True
-        answers["weight_kg"] = w
+    data = await user_repo.get_dialog_data(user) or {"answers": {}}
+    answers = OnboardingAnswers.from_dict(data.get("answers"))
 
-    elif step == 5:
-        a = _map_activity(text)
-        if a is None:
-            await message.answer("Активность: низкий / средний / высокий.")
-            return True
-        answers["activity_level"] = a
+    if field is not None:
+        setattr(answers, field[0], value)
 
     elif step == 6:
         if data.get("awaiting_goal_tempo"):
@@ -1068,23 +1187,23 @@ async def _handle_onboarding_step(message: Message, user_repo: UserRepo, user: A
             tempo_key, deficit_pct = tempo
             # keep goal, but allow explicit override by tempo choice
             if tempo_key == "maintain":
-                answers["goal"] = "maintain"
+                answers.goal = "maintain"
             elif tempo_key == "gain":
-                answers["goal"] = "gain"
+                answers.goal = "gain"
             elif tempo_key == "recomp":
-                answers["goal"] = "recomp"
+                answers.goal = "recomp"
             else:
                 # for soft/standard/hard we assume fat loss mode
-                answers["goal"] = answers.get("goal") or "loss"
-                if answers["goal"] not in {"loss", "recomp"}:
-                    answers["goal"] = "loss"
+                answers.goal = answers.goal or "loss"
+                if answers.goal not in {"loss", "recomp"}:
+                    answers.goal = "loss"
 
-            answers["deficit_pct"] = float(deficit_pct)
-            answers["tempo_key"] = tempo_key
+            answers.deficit_pct = float(deficit_pct)
+            answers.tempo_key = tempo_key
 
             # advance to next question
             next_step = step + 1
-            await user_repo.set_dialog(user, state="onboarding", step=next_step, data={"answers": answers})
+            await user_repo.set_dialog(user, state="onboarding", step=next_step, data={"answers": asdict(answers)})
             await message.answer(f"{next_step}/10 — {ONBOARDING_QUESTIONS[next_step]}", reply_markup=ReplyKeyboardRemove())
             return True
 
@@ -1093,30 +1212,21 @@ async def _handle_onboarding_step(message: Message, user_repo: UserRepo, user: A
             await message.answer("Напиши цель (например: «рекомпозиция», «похудение до 105 кг», «набор»).")
             return True
 
-        answers["goal"] = g
-        answers["goal_raw"] = (message.text or "").strip()
+        answers.goal = g
+        answers.goal_raw = (message.text or "").strip()
 
         # show tempo previews (kcal) so user can choose correctly
         preview: dict[str, int] | None
         preview_text: str
         try:
-            tdee_only = compute_targets_with_meta(
-                sex=answers["sex"],
-                age=int(answers["age"]),
-                height_cm=float(answers["height_cm"]),
-                weight_kg=float(answers["weight_kg"]),
-                activity=answers["activity_level"],
-                goal=str(answers["goal"]),
-                deficit_pct=0.0,
-            )[1].tdee_kcal
-            preview = {
-                "soft": int(round(tdee_only * (1 - 0.10))),
-                "standard": int(round(tdee_only * (1 - 0.15))),
-                "hard": int(round(tdee_only * (1 - 0.25))),
-                "recomp": int(round(tdee_only * (1 - 0.10))),
-                "maintain": int(round(tdee_only)),
-                "gain": int(round(tdee_only * (1 + 0.10))),
-            }
+            tdee_only = compute_tdee(
+                answers.sex,
+                int(answers.age),
+                float(answers.height_cm),
+                float(answers.weight_kg),
+                answers.activity_level,
+            )
+            preview = {k: int(round(tdee_only * f)) for k, f in _TEMPO_FACTORS}
             preview_text = (
                 f"При твоих данных поддержание (TDEE) ≈ <b>{tdee_only} ккал</b>.\n"
                 f"Если выбрать темп:\n"
@@ -1131,65 +1241,74 @@ async def _handle_onboarding_step(message: Message, user_repo: UserRepo, user: A
             user,
             state="onboarding",
             step=step,
-            data={"answers": answers, "awaiting_goal_tempo": True},
+            data={"answers": asdict(answers), "awaiting_goal_tempo": True},
         )
+        preview_block = f"{preview_text}\n" if preview_text else ""
         await message.answer(
             f"Ок, цель: <b>{_fmt_goal(g)}</b>.\n"
-            + (preview_text + "\n" if preview_text else "")
-            + "Теперь выбери темп (он влияет на дефицит/профицит):",
+            f"{preview_block}"
+            "Теперь выбери темп (он влияет на дефицит/профицит):",
             reply_markup=goal_tempo_kb(preview),
         )
         return True
 
     elif step == 7:
-        answers["allergies"] = text.strip()
+        answers.allergies = text.strip()
 
     elif step == 8:
-        answers["restrictions"] = text.strip()
+        answers.restrictions = text.strip()
 
     elif step == 9:
-        answers["favorite_products"] = text.strip()
+        answers.favorite_products = text.strip()
 
     elif step == 10:
-        answers["disliked_products"] = text.strip()
+        answers.disliked_products = text.strip()
 
         # finalize
-        user.age = int(answers["age"])
-        user.sex = str(answers["sex"])
-        user.height_cm = float(answers["height_cm"])
-        user.weight_kg = float(answers["weight_kg"])
-        user.activity_level = str(answers["activity_level"])
-        user.goal = str(answers["goal"])
-        user.allergies = str(answers.get("allergies") or "")
-        user.restrictions = str(answers.get("restrictions") or "")
-        user.favorite_products = str(answers.get("favorite_products") or "")
-        user.disliked_products = str(answers.get("disliked_products") or "")
+        profile: dict[str, Any] = {
+            "age": int(answers.age),
+            "sex": str(answers.sex),
+            "height_cm": float(answers.height_cm),
+            "weight_kg": float(answers.weight_kg),
+            "activity_level": str(answers.activity_level),
+            "goal": str(answers.goal),
+            "allergies": str(answers.allergies or ""),
+            "restrictions": str(answers.restrictions or ""),
+            "favorite_products": str(answers.favorite_products or ""),
+            "disliked_products": str(answers.disliked_products or ""),
+        }
 
         # defaults
         if not user.country:
-            user.country = settings.default_country
+            profile["country"] = settings.default_country
         if not user.stores_csv:
-            user.stores_csv = settings.default_stores
+            profile["stores_csv"] = settings.default_stores
 
         pref_repo = PreferenceRepo(user_repo.db)
-        deficit_pct = answers.get("deficit_pct")
-        goal_raw = answers.get("goal_raw")
-        tempo_key = answers.get("tempo_key")
+        deficit_pct = answers.deficit_pct
+        goal_raw = answers.goal_raw
+        tempo_key = answers.tempo_key
 
         t, meta = compute_targets_with_meta(
-            sex=user.sex,  # type: ignore[arg-type]
-            age=user.age,
-            height_cm=user.height_cm,
-            weight_kg=user.weight_kg,
-            activity=user.activity_level,  # type: ignore[arg-type]
-            goal=user.goal,  # type: ignore[arg-type]
+            sex=profile["sex"],
+            age=profile["age"],
+            height_cm=profile["height_cm"],
+            weight_kg=profile["weight_kg"],
+            activity=profile["activity_level"],
+            goal=profile["goal"],
             deficit_pct=float(deficit_pct) if deficit_pct is not None else None,
         )
-        user.calories_target = t.calories
-        user.protein_g_target = t.protein_g
-        user.fat_g_target = t.fat_g
-        user.carbs_g_target = t.carbs_g
-        user.profile_complete = True
+        await user_repo.update_profile(
+            user,
+            {
+                **profile,
+                "calories_target": t.calories,
+                "protein_g_target": t.protein_g,
+                "fat_g_target": t.fat_g,
+                "carbs_g_target": t.carbs_g,
+                "profile_complete": True,
+            },
+        )
 
         # store “truth” of calculation in preferences (no schema changes)
         await pref_repo.merge(
@@ -1242,7 +1361,7 @@ async def _handle_onboarding_step(message: Message, user_repo: UserRepo, user: A
 
     # advance
     next_step = step + 1
-    await user_repo.set_dialog(user, state="onboarding", step=next_step, data={"answers": answers})
+    await user_repo.set_dialog(user, state="onboarding", step=next_step, data={"answers": asdict(answers)})
     await message.answer(f"{next_step}/10 — {ONBOARDING_QUESTIONS[next_step]}")
     return True
 
@@ -1255,35 +1374,38 @@ async def _handle_coach_onboarding(message: Message, user_repo: UserRepo, user:
         return True
 
     pref_repo = PreferenceRepo(user_repo.db)
-    prefs = await pref_repo.get_json(user.id)
     data = await user_repo.get_dialog_data(user) or {"profile": {}, "prefs": {}}
-    prof = data.get("profile") or {}
-    pref_local = data.get("prefs") or {}
+    # get_dialog_data is read-only: copy what gets patched below
+    prof = dict(data.get("profile") or {})
+    pref_local = dict(data.get("prefs") or {})
+    prefs = await pref_repo.get_json(user.id)
 
     extracted = await text_json(
         system=f"{SYSTEM_COACH}\n\n{COACH_ONBOARD_JSON}",
-        user=(
-            "Текущий профиль (что уже известно):\n"
-            + dumps(
-                {
-                    "age": user.age,
-                    "sex": user.sex,
-                    "height_cm": user.height_cm,
-                    "weight_kg": user.weight_kg,
-                    "activity_level": user.activity_level,
-                    "goal": user.goal,
-                    "allergies": user.allergies,
-                    "restrictions": user.restrictions,
-                    "favorite_products": user.favorite_products,
-                    "disliked_products": user.disliked_products,
-                }
+        user="\n".join(
+            (
+                "Текущий профиль (что уже известно):",
+                dumps(
+                    {
+                        "age": user.age,
+                        "sex": user.sex,
+                        "height_cm": user.height_cm,
+                        "weight_kg": user.weight_kg,
+                        "activity_level": user.activity_level,
+                        "goal": user.goal,
+                        "allergies": user.allergies,
+                        "restrictions": user.restrictions,
+                        "favorite_products": user.favorite_products,
+                        "disliked_products": user.disliked_products,
+                    }
+                ),
+                "Текущие предпочтения:",
+                dumps(prefs),
+                "Локально собранные данные (в этой сессии):",
+                dumps({"profile": prof, "prefs": pref_local}),
+                "Сообщение пользователя:",
+                (message.text or "").strip(),
             )
-            + "\nТекущие предпочтения:\n"
-            + dumps(prefs)
-            + "\nЛокально собранные данные (в этой сессии):\n"
-            + dumps({"profile": prof, "prefs": pref_local})
-            + "\nСообщение пользователя:\n"
-            + (message.text or "").strip()
         ),
         max_output_tokens=900,
     )
@@ -1333,20 +1455,25 @@ async def _handle_coach_onboarding(message: Message, user_repo: UserRepo, user:
     if isinstance(prefs_patch.get("meal_times"), list):
         times: list[str] = []
         for t in prefs_patch.get("meal_times")[:8]:
-            if isinstance(t, str) and re.fullmatch(r"\d{2}:\d{2}", t.strip()):
+            if isinstance(t, str) and _HHMM_RE.fullmatch(t.strip()):
                 times.append(t.strip())
         if times:
             pref_local["meal_times"] = times
     if isinstance(prefs_patch.get("snacks"), bool):
         pref_local["snacks"] = bool(prefs_patch.get("snacks"))
-    if isinstance(prefs_patch.get("wake_time"), str) and re.fullmatch(r"\d{2}:\d{2}", prefs_patch["wake_time"].strip()):
+    if isinstance(prefs_patch.get("wake_time"), str) and _HHMM_RE.fullmatch(prefs_patch["wake_time"].strip()):
         pref_local["wake_time"] = prefs_patch["wake_time"].strip()
-    if isinstance(prefs_patch.get("sleep_time"), str) and re.fullmatch(r"\d{2}:\d{2}", prefs_patch["sleep_time"].strip()):
+    if isinstance(prefs_patch.get("sleep_time"), str) and _HHMM_RE.fullmatch(prefs_patch["sleep_time"].strip()):
         pref_local["sleep_time"] = prefs_patch["sleep_time"].strip()
     if isinstance(prefs_patch.get("notes"), str) and prefs_patch.get("notes"):
         pref_local["notes"] = str(prefs_patch.get("notes")).strip()
 
-    await user_repo.set_dialog(user, state="coach_onboarding", step=1, data={"profile": prof, "prefs": pref_local})
+    await user_repo.set_dialog(
+        user,
+        state="coach_onboarding",
+        step=1,
+        data={"profile": prof, "prefs": pref_local},
+    )
 
     required = {"age", "sex", "height_cm", "weight_kg", "activity_level", "goal", "tempo_key", "deficit_pct"}
     if not required.issubset(set(prof.keys())):
@@ -1356,36 +1483,44 @@ async def _handle_coach_onboarding(message: Message, user_repo: UserRepo, user:
         return True
 
     # finalize: persist to user + preferences
-    user.age = int(prof["age"])
-    user.sex = str(prof["sex"])
-    user.height_cm = float(prof["height_cm"])
-    user.weight_kg = float(prof["weight_kg"])
-    user.activity_level = str(prof["activity_level"])
-    user.goal = str(prof["goal"])
-    user.allergies = str(prof.get("allergies") or "")
-    user.restrictions = str(prof.get("restrictions") or "")
-    user.favorite_products = str(prof.get("favorite_products") or "")
-    user.disliked_products = str(prof.get("disliked_products") or "")
+    profile: dict[str, Any] = {
+        "age": int(prof["age"]),
+        "sex": str(prof["sex"]),
+        "height_cm": float(prof["height_cm"]),
+        "weight_kg": float(prof["weight_kg"]),
+        "activity_level": str(prof["activity_level"]),
+        "goal": str(prof["goal"]),
+        "allergies": str(prof.get("allergies") or ""),
+        "restrictions": str(prof.get("restrictions") or ""),
+        "favorite_products": str(prof.get("favorite_products") or ""),
+        "disliked_products": str(prof.get("disliked_products") or ""),
+    }
 
     if not user.country:
-        user.country = settings.default_country
+        profile["country"] = settings.default_country
     if not user.stores_csv:
-        user.stores_csv = settings.default_stores
+        profile["stores_csv"] = settings.default_stores
 
     t, meta = compute_targets_with_meta(
-        sex=user.sex,  # type: ignore[arg-type]
-        age=user.age,
-        height_cm=user.height_cm,
-        weight_kg=user.weight_kg,
-        activity=user.activity_level,  # type: ignore[arg-type]
-        goal=user.goal,  # type: ignore[arg-type]
+        sex=profile["sex"],
+        age=profile["age"],
+        height_cm=profile["height_cm"],
+        weight_kg=profile["weight_kg"],
+        activity=profile["activity_level"],
+        goal=profile["goal"],
         deficit_pct=float(prof["deficit_pct"]),
     )
-    user.calories_target = t.calories
-    user.protein_g_target = t.protein_g
-    user.fat_g_target = t.fat_g
-    user.carbs_g_target = t.carbs_g
-    user.profile_complete = True
+    await user_repo.update_profile(
+        user,
+        {
+            **profile,
+            "calories_target": t.calories,
+            "protein_g_target": t.protein_g,
+            "fat_g_target": t.fat_g,
+            "carbs_g_target": t.carbs_g,
+            "profile_complete": True,
+        },
+    )
 
     await pref_repo.merge(
         user.id,
@@ -1431,24 +1566,52 @@ async def _handle_coach_onboarding(message: Message, user_repo: UserRepo, user:
     return True
 
 
+_PROFILE_CTX_FIELDS = (
+    "age",
+    "sex",
+    "height_cm",
+    "weight_kg",
+    "activity_level",
+    "goal",
+    "allergies",
+    "restrictions",
+    "favorite_products",
+    "disliked_products",
+    "country",
+    "stores_csv",
+    "calories_target",
+    "protein_g_target",
+    "fat_g_target",
+    "carbs_g_target",
+)
+
+
 def _profile_context(user: Any) -> str:
-    return (
+    # memo on the instance, keyed by the field values: any profile edit rebuilds the text
+    key = tuple(getattr(user, f) for f in _PROFILE_CTX_FIELDS)
+    memo = user.__dict__.get("_profile_ctx_memo")
+    if memo is not None and memo[0] == key:
+        return memo[1]
+    age, sex, height_cm, weight_kg, activity, goal, allergies, restrictions, fav, disliked, country, stores, kcal, p, f, c = key
+    text = (
         "Профиль пользователя:\n"
-        f"- возраст: {user.age}\n"
-        f"- пол: {user.sex}\n"
-        f"- рост см: {user.height_cm}\n"
-        f"- вес кг: {user.weight_kg}\n"
-        f"- активность: {user.activity_level}\n"
-        f"- цель: {user.goal}\n"
-        f"- аллергии: {user.allergies}\n"
-        f"- ограничения: {user.restrictions}\n"
-        f"- любимые продукты: {user.favorite_products}\n"
-        f"- нелюбимые продукты: {user.disliked_products}\n"
-        f"- страна: {user.country}\n"
-        f"- магазины: {user.stores_csv}\n"
-        f"- норма ккал: {user.calories_target}\n"
-        f"- БЖУ: {user.protein_g_target}/{user.fat_g_target}/{user.carbs_g_target}\n"
+        f"- возраст: {age}\n"
+        f"- пол: {sex}\n"
+        f"- рост см: {height_cm}\n"
+        f"- вес кг: {weight_kg}\n"
+        f"- активность: {activity}\n"
+        f"- цель: {goal}\n"
+        f"- аллергии: {allergies}\n"
+        f"- ограничения: {restrictions}\n"
+        f"- любимые продукты: {fav}\n"
+        f"- нелюбимые продукты: {disliked}\n"
+        f"- страна: {country}\n"
+        f"- магазины: {stores}\n"
+        f"- норма ккал: {kcal}\n"
+        f"- БЖУ: {p}/{f}/{c}\n"
     )
+    user.__dict__["_profile_ctx_memo"] = (key, text)
+    return text
 
 
 async def _start_meal_confirm(
@@ -1497,23 +1660,45 @@ async def _start_meal_confirm(
             )
     except Exception:
         per100 = ""
+    head = "Я распознал рецепт так (оценка):" if source == "recipe" else "Я распознал так (оценка):"
     text = (
-        ("Я распознал рецепт так (оценка):\n" if source == "recipe" else "Я распознал так (оценка):\n")
-        + f"<pre>{tbl}</pre>\n"
-        + f"Итого: {totals.get('total_weight_g')} г, {totals.get('calories')} ккал, "
-        + f"Б {totals.get('protein_g')} / Ж {totals.get('fat_g')} / У {totals.get('carbs_g')}"
-        + f"{per100}\n\n"
-        + "Подтвердить и внести в дневник? (да/нет)"
+        f"{head}\n"
+        f"<pre>{tbl}</pre>\n"
+        f"Итого: {totals.get('total_weight_g')} г, {totals.get('calories')} ккал, "
+        f"Б {totals.get('protein_g')} / Ж {totals.get('fat_g')} / У {totals.get('carbs_g')}"
+        f"{per100}\n\n"
+        "Подтвердить и внести в дневник? (да/нет)"
     )
     await message.answer(text)
 
 
 def _maybe_barcode(s: str) -> str | None:
     t = _norm_text(s).replace(" ", "")
-    m = re.search(r"\b(\d{8,14})\b", t)
+    m = _BARCODE_RE.search(t)
     return m.group(1) if m else None
 
 
+@dataclass(slots=True, frozen=True)
+class PickOption:
+    """A product option in food_pick; orjson writes it to dialog_data_json as a plain dict."""
+
+    barcode: str | None
+    name: str
+    brand: str | None
+    kcal_100g: float | None
+    protein_100g: float | None
+    fat_100g: float | None
+    carbs_100g: float | None
+
+    @classmethod
+    def from_candidate(cls, c: FoodCandidate) -> PickOption:
+        return cls(c.barcode, c.name, c.brand, c.kcal_100g, c.protein_100g, c.fat_100g, c.carbs_100g)
+
+    @classmethod
+    def from_dict(cls, raw: dict[str, Any]) -> PickOption:
+        return cls(**{f.name: raw.get(f.name) for f in fields(cls)})
+
+
 def _format_food_pick_question(ctx: dict[str, Any], idx: int) -> str:
     unresolved: list[dict[str, Any]] = ctx.get("unresolved") or []
     if idx >= len(unresolved):
@@ -1521,7 +1706,8 @@ def _format_food_pick_question(ctx: dict[str, Any], idx: int) -> str:
     it = unresolved[idx]
     q = it.get("query")
     grams = it.get("grams")
-    cands: list[dict[str, Any]] = it.get("candidates") or []
+    # a fresh ctx carries PickOption instances, one restored from dialog_data carries dicts
+    cands = [c if isinstance(c, PickOption) else PickOption.from_dict(c) for c in it.get("candidates") or []]
     if not cands:
         return (
             f"Не нашел точный продукт для: <b>{q}</b> ({grams} г).\n"
@@ -1531,104 +1717,124 @@ def _format_food_pick_question(ctx: dict[str, Any], idx: int) -> str:
     lines = [f"Выбери продукт для: <b>{q}</b> ({grams} г)\n"]
     for i, c in enumerate(cands, start=1):
         lines.append(
-            f"{i}) {c.get('name')} — {c.get('brand') or '—'} "
-            f"({c.get('kcal_100g')} ккал/100г) [barcode: {c.get('barcode')}]"
+            f"{i}) {c.name} — {c.brand or '—'} "
+            f"({c.kcal_100g} ккал/100г) [barcode: {c.barcode}]"
         )
     lines.append("\nОтветь цифрой (1-5) или пришли штрихкод.")
     lines.append("Чтобы отменить — напиши: ❌ Отмена")
     return "\n".join(lines)
 
 
+def _sum_totals(resolved: list[dict[str, Any]]) -> dict[str, int]:
+    # one pass over the rows; compute_item_macros already stores numbers, no float() per field
+    w = kcal = p = f = c = 0.0
+    for r in resolved:
+        w += r["grams"]
+        kcal += r["calories"]
+        p += r["protein_g"]
+        f += r["fat_g"]
+        c += r["carbs_g"]
+    return {
+        "total_weight_g": int(round(w)),
+        "calories": int(round(kcal)),
+        "protein_g": int(round(p)),
+        "fat_g": int(round(f)),
+        "carbs_g": int(round(c)),
+    }
+
+
+def _make_draft(resolved: list[dict[str, Any]]) -> dict[str, Any]:
+    """Meal draft from compute_item_macros rows (OFF-resolved items)."""
+    return {
+        "items": [
+            {
+                "name": r["name"],
+                "grams": r["grams"],
+                "calories": int(round(r["calories"])),
+                "protein_g": r["protein_g"],
+                "fat_g": r["fat_g"],
+                "carbs_g": r["carbs_g"],
+                "barcode": r.get("barcode"),
+                "brand": r.get("brand"),
+                "per_100g": r.get("per_100g"),
+            }
+            for r in resolved
+        ],
+        "totals": _sum_totals(resolved),
+        "data_source": "openfoodfacts",
+    }
+
+
 async def _build_meal_from_items(
     *,
     items: list[dict[str, Any]],
     food_service: FoodService,
 ) -> tuple[dict[str, Any] | None, dict[str, Any] | None]:
-    resolved: list[dict[str, Any]] = []
-    unresolved: list[dict[str, Any]] = []
+    def _barcode(it: dict[str, Any]) -> str | None:
+        bc = it.get("barcode") or None
+        return str(bc).strip() if bc else None
+
+    def _valid(it: dict[str, Any]) -> bool:
+        return bool(str(it.get("query") or "").strip()) and float(it.get("grams") or 0) > 0
 
-    for it in items:
+    # all barcodes of the meal in one batch (one DB query, OFF only for misses);
+    # runs alongside the name searches, only barcode items wait for it
+    barcodes = [bc for it in items if _valid(it) and (bc := _barcode(it))]
+    by_barcode = asyncio.ensure_future(food_service.resolve_many(barcodes)) if barcodes else None
+
+    async def _resolve_one(it: dict[str, Any]) -> tuple[str, dict[str, Any]] | None:
         query = str(it.get("query") or "").strip()
         grams = float(it.get("grams") or 0)
-        barcode = it.get("barcode") or None
-        barcode = str(barcode).strip() if barcode else None
+        barcode = _barcode(it)
         if not query or grams <= 0:
-            continue
+            return None
 
-        cand = None
-        if barcode:
-            cand = await food_service.resolve_by_barcode(barcode)
+        cand = (await by_barcode).get(barcode) if barcode and by_barcode else None
         if not cand:
             cands = await food_service.search(query)
-            usable = [
-                c
-                for c in cands
-                if c.kcal_100g is not None
-                and c.protein_100g is not None
-                and c.fat_100g is not None
-                and c.carbs_100g is not None
-            ]
+            # only "exactly one" and the first 5 (for the pick list) matter: stop at 5
+            usable: list[FoodCandidate] = []
+            for c in cands:
+                if c.has_macros:
+                    usable.append(c)
+                    if len(usable) == 5:
+                        break
             if len(usable) == 1:
                 cand = usable[0]
             else:
-                unresolved.append(
+                return (
+                    "unresolved",
                     {
                         "query": query,
                         "grams": grams,
-                        "candidates": [
-                            {
-                                "barcode": c.barcode,
-                                "name": c.name,
-                                "brand": c.brand,
-                                "kcal_100g": c.kcal_100g,
-                                "protein_100g": c.protein_100g,
-                                "fat_100g": c.fat_100g,
-                                "carbs_100g": c.carbs_100g,
-                            }
-                            for c in usable[:5]
-                        ],
-                    }
+                        "candidates": [PickOption.from_candidate(c) for c in usable],
+                    },
                 )
-                continue
 
         if not cand:
-            unresolved.append({"query": query, "grams": grams, "candidates": []})
-            continue
+            return "unresolved", {"query": query, "grams": grams, "candidates": []}
 
         macros = compute_item_macros(grams=grams, cand=cand)
         if not macros:
-            unresolved.append({"query": query, "grams": grams, "candidates": []})
+            return "unresolved", {"query": query, "grams": grams, "candidates": []}
+        return "resolved", macros
+
+    # OFF lookups overlap; FoodService serializes its own DB access
+    results = await asyncio.gather(*(_resolve_one(it) for it in items), return_exceptions=True)
+    resolved: list[dict[str, Any]] = []
+    unresolved: list[dict[str, Any]] = []
+    for res in results:
+        if isinstance(res, BaseException):
+            raise res
+        if res is None:
             continue
-        resolved.append(macros)
+        kind, row = res
+        (resolved if kind == "resolved" else unresolved).append(row)
 
     if unresolved:
         return None, {"unresolved": unresolved, "resolved": resolved}
 
-    totals = {
-        "total_weight_g": int(round(sum(float(r["grams"]) for r in resolved))),
-        "calories": int(round(sum(float(r["calories"]) for r in resolved))),
-        "protein_g": int(round(sum(float(r["protein_g"]) for r in resolved))),
-        "fat_g": int(round(sum(float(r["fat_g"]) for r in resolved))),
-        "carbs_g": int(round(sum(float(r["carbs_g"]) for r in resolved))),
-    }
-    draft = {
-        "items": [
-            {
-                "name": r["name"],
-                "grams": r["grams"],
-                "calories": int(round(float(r["calories"]))),
-                "protein_g": float(r["protein_g"]),
-                "fat_g": float(r["fat_g"]),
-                "carbs_g": float(r["carbs_g"]),
-                "barcode": r.get("barcode"),
-                "brand": r.get("brand"),
-                "per_100g": r.get("per_100g"),
-            }
-            for r in resolved
-        ],
-        "totals": totals,
-        "data_source": "openfoodfacts",
-    }
+    draft = _make_draft(resolved)
     return draft, None
 
 
@@ -1638,61 +1844,49 @@ async def _handle_food_pick(message: Message, user_repo: UserRepo, food_service:
 
     # allow cancel / menu escape to prevent loops
     t = (message.text or "").strip()
-    if t in {
-        "❌ Отмена",
-        BTN_MENU,
-        BTN_HELP,
-        BTN_PROFILE,
-        BTN_WEIGHT,
-        BTN_LOG_MEAL,
-        BTN_PHOTO_HELP,
-        BTN_PLAN,
-        BTN_WEEK,
-        BTN_REMINDERS,
-        BTN_PROGRESS,
-    }:
+    if t in _ESCAPE_TEXTS:
         await user_repo.set_dialog(user, state=None, step=None, data=None)
         await message.answer("Ок, отменил выбор продукта.", reply_markup=main_menu_kb())
         return {"handled": True}
 
-    data = loads(user.dialog_data_json) or {}
+    data = await user_repo.get_dialog_data(user) or {}
     ctx = data.get("ctx") or {}
     source = data.get("source") or "text"
     photo_file_id = data.get("photo_file_id")
     unresolved: list[dict[str, Any]] = ctx.get("unresolved") or []
-    resolved: list[dict[str, Any]] = ctx.get("resolved") or []
+    resolved: list[dict[str, Any]] = list(ctx.get("resolved") or [])  # appended to below
     idx = int(user.dialog_step or 0)
 
     if idx >= len(unresolved):
         await user_repo.set_dialog(user, state=None, step=None, data=None)
         return None
 
-    reply = (message.text or "").strip()
+    reply = t
     bc = _maybe_barcode(reply)
-    chosen = None
+    cand: FoodCandidate | None = None
 
     if bc:
+        # the candidate fetched here is final: no second lookup of the same barcode
         cand = await food_service.resolve_by_barcode(bc)
         if not cand:
             await message.answer("Не нашел продукт по этому штрихкоду. Проверь цифры и пришли еще раз.")
             return {"handled": True}
-        chosen = {"barcode": cand.barcode, "name": cand.name, "brand": cand.brand, "kcal_100g": cand.kcal_100g, "protein_100g": cand.protein_100g, "fat_100g": cand.fat_100g, "carbs_100g": cand.carbs_100g}
     else:
+        chosen = None
         if reply.isdigit():
             n = int(reply)
             cands: list[dict[str, Any]] = unresolved[idx].get("candidates") or []
             if 1 <= n <= len(cands):
                 chosen = cands[n - 1]
 
-    if not chosen:
-        await message.answer("Ответь цифрой из списка или пришли штрихкод (8-14 цифр).")
-        return {"handled": True}
+        if not chosen:
+            await message.answer("Ответь цифрой из списка или пришли штрихкод (8-14 цифр).")
+            return {"handled": True}
+
+        if chosen.get("barcode"):
+            cand = await food_service.resolve_by_barcode(str(chosen["barcode"]))
 
     grams = float(unresolved[idx].get("grams") or 0)
-    if chosen.get("barcode"):
-        cand = await food_service.resolve_by_barcode(str(chosen["barcode"]))
-    else:
-        cand = None
     if not cand:
         await message.answer("Не смог зафиксировать выбранный продукт. Пришли штрихкод.")
         return {"handled": True}
@@ -1716,31 +1910,7 @@ async def _handle_food_pick(message: Message, user_repo: UserRepo, food_service:
         return {"handled": True}
 
     # All resolved: build draft
-    totals = {
-        "total_weight_g": int(round(sum(float(r["grams"]) for r in resolved))),
-        "calories": int(round(sum(float(r["calories"]) for r in resolved))),
-        "protein_g": int(round(sum(float(r["protein_g"]) for r in resolved))),
-        "fat_g": int(round(sum(float(r["fat_g"]) for r in resolved))),
-        "carbs_g": int(round(sum(float(r["carbs_g"]) for r in resolved))),
-    }
-    draft = {
-        "items": [
-            {
-                "name": r["name"],
-                "grams": r["grams"],
-                "calories": int(round(float(r["calories"]))),
-                "protein_g": float(r["protein_g"]),
-                "fat_g": float(r["fat_g"]),
-                "carbs_g": float(r["carbs_g"]),
-                "barcode": r.get("barcode"),
-                "brand": r.get("brand"),
-                "per_100g": r.get("per_100g"),
-            }
-            for r in resolved
-        ],
-        "totals": totals,
-        "data_source": "openfoodfacts",
-    }
+    draft = _make_draft(resolved)
     await user_repo.set_dialog(user, state=None, step=None, data=None)
     return {"handled": True, "draft": draft, "source": source, "photo_file_id": photo_file_id}
 
@@ -1753,7 +1923,7 @@ async def photo_message(message: Message, bot: Bot) -> None:
     async with SessionLocal() as db:
         user_repo = UserRepo(db)
         note_repo = CoachNoteRepo(db)
-        user = await user_repo.get_or_create(message.from_user.id, message.from_user.username)
+        user = await user_repo.get_or_create(message.from_user.id, message.from_user.username, food_prefs=True)
         if not user.profile_complete:
             await message.answer("Сначала заполним профиль: /start")
             return
@@ -1842,7 +2012,7 @@ async def voice_message(message: Message, bot: Bot) -> None:
         stat_repo = StatRepo(db)
         food_repo = FoodRepo(db)
         food_service = FoodService(food_repo)
-        user = await user_repo.get_or_create(message.from_user.id, message.from_user.username)
+        user = await user_repo.get_or_create(message.from_user.id, message.from_user.username, food_prefs=True)
         if not user.profile_complete:
             await message.answer("Сначала заполним профиль: /start")
             return
@@ -1853,7 +2023,7 @@ async def voice_message(message: Message, bot: Bot) -> None:
             await message.answer(f"Не смог скачать голосовое: {e}")
             return
 
-        wav = ogg_opus_to_wav_bytes(ogg)
+        wav = await ogg_opus_to_wav_bytes_async(ogg)
         if wav is None:
             await message.answer("Голосовые пока не могу распознавать без ffmpeg. Установи ffmpeg или напиши текстом.")
             return
@@ -1916,26 +2086,14 @@ async def _handle_photo_clarify(
         return False
 
     t0 = (message.text or "").strip()
-    if t0 in {
-        "❌ Отмена",
-        BTN_MENU,
-        BTN_HELP,
-        BTN_PROFILE,
-        BTN_WEIGHT,
-        BTN_LOG_MEAL,
-        BTN_PHOTO_HELP,
-        BTN_PLAN,
-        BTN_WEEK,
-        BTN_REMINDERS,
-        BTN_PROGRESS,
-    }:
+    if t0 in _ESCAPE_TEXTS:
         await user_repo.set_dialog(user, state=None, step=None, data=None)
         await message.answer("Ок, отменил разбор фото.", reply_markup=main_menu_kb())
         return True
 
-    data = loads(user.dialog_data_json) or {}
+    data = await user_repo.get_dialog_data(user) or {}
     questions: list[str] = data.get("questions") or []
-    answers: list[str] = data.get("answers") or []
+    answers: list[str] = list(data.get("answers") or [])  # appended to below
     idx = int(user.dialog_step or 0)
     text = t0
     answers.append(text)
@@ -1990,31 +2148,19 @@ async def _handle_photo_clarify(
 async def _handle_meal_confirm(message: Message, user_repo: UserRepo, meal_repo: MealRepo, user: Any) -> bool:
     if user.dialog_state != "meal_confirm":
         return False
-    data = loads(user.dialog_data_json) or {}
+    data = await user_repo.get_dialog_data(user) or {}
     draft = data.get("draft") or {}
     source = data.get("source") or "text"
     photo_file_id = data.get("photo_file_id")
 
     raw = (message.text or "").strip()
-    if raw in {
-        "❌ Отмена",
-        BTN_MENU,
-        BTN_HELP,
-        BTN_PROFILE,
-        BTN_WEIGHT,
-        BTN_LOG_MEAL,
-        BTN_PHOTO_HELP,
-        BTN_PLAN,
-        BTN_WEEK,
-        BTN_REMINDERS,
-        BTN_PROGRESS,
-    }:
+    if raw in _ESCAPE_TEXTS:
         await user_repo.set_dialog(user, state=None, step=None, data=None)
         await message.answer("Ок, отменил подтверждение.", reply_markup=main_menu_kb())
         return True
 
     text = _norm_text(raw)
-    if text in {"да", "yes", "y", "ок", "ага"}:
+    if text in _AFFIRM:
         totals = draft.get("totals") or {}
         await meal_repo.add_meal(
             user_id=user.id,
@@ -2027,7 +2173,7 @@ async def _handle_meal_confirm(message: Message, user_repo: UserRepo, meal_repo:
         await user_repo.set_dialog(user, state=None, step=None, data=None)
         await message.answer("Готово — внес в дневник.")
         return True
-    if text in {"нет", "no", "n"}:
+    if text in _DENY:
         await user_repo.set_dialog(user, state=None, step=None, data=None)
         await message.answer("Ок, не вношу. Можешь прислать уточнение или заново описать прием пищи.")
         return True
@@ -2042,27 +2188,15 @@ async def _handle_meal_clarify(message: Message, user_repo: UserRepo, food_servi
         return False
 
     t0 = (message.text or "").strip()
-    if t0 in {
-        "❌ Отмена",
-        BTN_MENU,
-        BTN_HELP,
-        BTN_PROFILE,
-        BTN_WEIGHT,
-        BTN_LOG_MEAL,
-        BTN_PHOTO_HELP,
-        BTN_PLAN,
-        BTN_WEEK,
-        BTN_REMINDERS,
-        BTN_PROGRESS,
-    }:
+    if t0 in _ESCAPE_TEXTS:
         await user_repo.set_dialog(user, state=None, step=None, data=None)
         await message.answer("Ок, отменил уточнения по приёму пищи.", reply_markup=main_menu_kb())
         return True
 
-    data = loads(user.dialog_data_json) or {}
+    data = await user_repo.get_dialog_data(user) or {}
     source = data.get("source") or "text"
     qs: list[str] = data.get("questions") or []
-    answers: list[str] = data.get("answers") or []
+    answers: list[str] = list(data.get("answers") or [])  # appended to below
     idx = int(user.dialog_step or 0)
     answers.append(t0)
     idx += 1
@@ -2102,28 +2236,16 @@ async def _handle_meal_clarify(message: Message, user_repo: UserRepo, food_servi
 async def _handle_apply_calories(message: Message, user_repo: UserRepo, user: Any) -> bool:
     if user.dialog_state != "apply_calories":
         return False
-    data = loads(user.dialog_data_json) or {}
+    data = await user_repo.get_dialog_data(user) or {}
     new_cal = data.get("new_calories")
     raw = (message.text or "").strip()
-    if raw in {
-        "❌ Отмена",
-        BTN_MENU,
-        BTN_HELP,
-        BTN_PROFILE,
-        BTN_WEIGHT,
-        BTN_LOG_MEAL,
-        BTN_PHOTO_HELP,
-        BTN_PLAN,
-        BTN_WEEK,
-        BTN_REMINDERS,
-        BTN_PROGRESS,
-    }:
+    if raw in _ESCAPE_TEXTS:
         await user_repo.set_dialog(user, state=None, step=None, data=None)
         await message.answer("Ок, не применяю изменения.", reply_markup=main_menu_kb())
         return True
 
     text = _norm_text(raw)
-    if text in {"да", "yes", "y", "ок", "ага"} and isinstance(new_cal, (int, float)):
+    if text in _AFFIRM and isinstance(new_cal, (int, float)):
         user.calories_target = int(new_cal)
         # пересчитаем макросы от новой калорийности с тем же весом/целью (приближение)
         t = compute_targets(
@@ -2150,7 +2272,7 @@ async def _handle_apply_calories(message: Message, user_repo: UserRepo, user: An
         )
         return True
 
-    if text in {"нет", "no", "n"}:
+    if text in _DENY:
         await user_repo.set_dialog(user, state=None, step=None, data=None)
         await message.answer("Ок, не меняю норму.")
         return True
@@ -2175,12 +2297,12 @@ def _looks_like_meal(text: str) -> bool:
     if not t:
         return False
     # grams / quantities / typical food markers
-    if re.search(r"\b\d+\s?(г|гр|kg|кг|ml|мл|шт)\b", t):
+    if _MEAL_QTY_RE.search(t):
         return True
-    if any(k in t for k in ["съел", "поел", "ел ", "завтрак", "обед", "ужин", "перекус", "греч", "куриц", "рис", "паста", "йогур", "творог", "омлет"]):
+    if _FOOD_KW_RE.search(t):
         return True
     # list-like: commas with numbers
-    if "," in t and re.search(r"\d", t):
+    if "," in t and _DIGIT_RE.search(t):
         return True
     return False
 
@@ -2189,11 +2311,10 @@ def _needs_hidden_calorie_clarification(user_text: str) -> list[str]:
     t = _norm_text(user_text)
     if not t:
         return []
-    risky = any(k in t for k in ["жар", "гриль", "салат", "соус", "сыр", "орех", "майон", "шаур", "бургер", "пицц", "паста"])
-    if not risky:
+    if not _HIDDEN_KCAL_RISKY_RE.search(t):
         return []
     # if user already mentioned oil/sauce amounts, skip
-    if any(k in t for k in ["масло", "олив", "соус", "майон", "кетч", "алког", "пиво", "вино", "сыр "]):
+    if _HIDDEN_KCAL_GIVEN_RE.search(t):
         return []
     return [
         "Сколько масла/соуса было в приготовлении? (пример: масло 10г / 1 ст.л.)",
@@ -2210,12 +2331,18 @@ def _parse_dt(s: str | None) -> dt.datetime | None:
         return None
 
 
-def _tz_from_prefs(prefs: dict[str, Any]) -> ZoneInfo:
-    tz_name = prefs.get("timezone") if isinstance(prefs.get("timezone"), str) else "Europe/Prague"
+@lru_cache(maxsize=512)
+def _get_tz(name: str) -> ZoneInfo:
+    # per user per minute in _checkin_loop: resolve each tz name once, bad names -> Prague
     try:
-        return ZoneInfo(tz_name)
+        return ZoneInfo(name)
     except Exception:
-        return ZoneInfo("Europe/Prague")
+        return ZoneInfo(_DEFAULT_TZ)
+
+
+def _tz_from_prefs(prefs: dict[str, Any]) -> ZoneInfo:
+    tz_name = prefs.get("timezone")
+    return _get_tz(tz_name if isinstance(tz_name, str) else _DEFAULT_TZ)
 
 
 def _mean(xs: list[float]) -> float | None:
@@ -2293,13 +2420,30 @@ def _detect_weight_stall(weights: list[dict[str, Any]], days: int = 14) -> bool:
     return abs(window[-1] - window[0]) < 0.2
 
 
-async def _apply_coach_memory_if_needed(message: Message, *, pref_repo: PreferenceRepo, user: Any) -> bool:
+def _could_be_memory(tnorm: str) -> bool:
+    """
+    Cheap gate before the COACH_MEMORY_JSON call: «да»/«нет» and lone words never patch preferences.
+    Anything with digits goes to the model (targets_custom sends «2800» through the same extractor).
+    Takes text already passed through _norm_text.
+    """
+    t = tnorm
+    if t in _AFFIRM or t in _DENY:
+        return False
+    if _DIGIT_RE.search(t):
+        return True
+    return " " in t
+
+
+async def _apply_coach_memory_if_needed(
+    message: Message, *, pref_repo: PreferenceRepo, user: Any, text_norm: str | None = None
+) -> bool:
     """
     Parse free-form "remember this" / routines / supplements and persist to preferences.
     Returns True if handled (i.e., saved and user was replied to).
+    text_norm: the message text through _norm_text, when the caller already has it.
     """
     txt = (message.text or "").strip()
-    if not txt:
+    if not txt or not _could_be_memory(text_norm if text_norm is not None else _norm_text(txt)):
         return False
 
     prefs = await pref_repo.get_json(user.id)
@@ -2330,9 +2474,9 @@ async def _apply_coach_memory_if_needed(message: Message, *, pref_repo: Preferen
         merged_patch["checkin_ask"] = patch["checkin_ask"]
     if isinstance(patch.get("weight_prompt_enabled"), bool):
         merged_patch["weight_prompt_enabled"] = bool(patch["weight_prompt_enabled"])
-    if isinstance(patch.get("weight_prompt_time"), str) and re.fullmatch(r"\d{2}:\d{2}", patch["weight_prompt_time"].strip()):
+    if isinstance(patch.get("weight_prompt_time"), str) and _HHMM_RE.fullmatch(patch["weight_prompt_time"].strip()):
         merged_patch["weight_prompt_time"] = patch["weight_prompt_time"].strip()
-    if patch.get("weight_prompt_days") in {"weekdays", "weekends", "all"}:
+    if patch.get("weight_prompt_days") in _VALID_DAYS:
         merged_patch["weight_prompt_days"] = patch["weight_prompt_days"]
     if isinstance(patch.get("reminders"), list):
         rems: list[dict[str, Any]] = []
@@ -2342,7 +2486,7 @@ async def _apply_coach_memory_if_needed(message: Message, *, pref_repo: Preferen
             t = r.get("time")
             d = r.get("days")
             txt = r.get("text")
-            if isinstance(t, str) and re.fullmatch(r"\d{2}:\d{2}", t.strip()) and d in {"weekdays", "weekends", "all"} and isinstance(txt, str) and txt.strip():
+            if isinstance(t, str) and _HHMM_RE.fullmatch(t.strip()) and d in _VALID_DAYS and isinstance(txt, str) and txt.strip():
                 rems.append({"time": t.strip(), "days": d, "text": txt.strip()})
         merged_patch["reminders"] = rems
     # targets override (store in prefs + user snapshot)
@@ -2387,47 +2531,49 @@ async def _apply_coach_memory_if_needed(message: Message, *, pref_repo: Preferen
     return True
 
 
+# recall-plan slots: title keywords first, then typical hour ranges [start, end)
+_SLOT_KW: dict[str, str] = {
+    "breakfast": "завтрак",
+    "lunch": "обед",
+    "dinner": "ужин",
+    "snack": "перекус",
+}
+_SLOT_HOURS: dict[str, tuple[int, int]] = {
+    "breakfast": (5, 11),
+    "lunch": (11, 16),
+    "dinner": (16, 22),
+}
+
+
 def _pick_meal_from_plan(plan: dict[str, Any], slot: str | None) -> dict[str, Any] | None:
     meals = plan.get("meals") or []
     if not isinstance(meals, list) or not meals:
         return None
 
     slot = (slot or "").lower().strip()
-    # try by title keywords
-    kw = {
-        "breakfast": ["завтрак"],
-        "lunch": ["обед"],
-        "dinner": ["ужин"],
-        "snack": ["перекус"],
-    }.get(slot, [])
-    if kw:
-        for m in meals:
-            title = str((m or {}).get("title_ru") or (m or {}).get("title") or "").lower()
-            if any(k in title for k in kw):
-                return m
-
-    # try by time ranges (if present)
-    def _tval(m: dict[str, Any]) -> str:
-        return str(m.get("time") or "").strip()
+    kw = _SLOT_KW.get(slot)
+    hours = _SLOT_HOURS.get(slot)
 
     def _in_range(t: str, start_h: int, end_h: int) -> bool:
-        if not re.fullmatch(r"\d{2}:\d{2}", t):
+        # "HH:MM" without a regex: the hour is the two ASCII digits before ':'
+        if len(t) != 5 or t[2] != ":":
+            return False
+        digits = t[:2] + t[3:]
+        if not (digits.isascii() and digits.isdigit()):
             return False
-        h = int(t[:2])
+        h = (ord(t[0]) - 48) * 10 + (ord(t[1]) - 48)
         return start_h <= h < end_h
 
-    if slot == "breakfast":
-        for m in meals:
-            if _in_range(_tval(m), 5, 11):
-                return m
-    if slot == "lunch":
-        for m in meals:
-            if _in_range(_tval(m), 11, 16):
-                return m
-    if slot == "dinner":
-        for m in meals:
-            if _in_range(_tval(m), 16, 22):
-                return m
+    # one pass: a title match wins outright, the first meal in the slot's hours is the fallback
+    by_time: dict[str, Any] | None = None
+    for m in meals:
+        m0 = m or {}
+        if kw and kw in str(m0.get("title_ru") or m0.get("title") or "").lower():
+            return m
+        if hours and by_time is None and _in_range(str(m0.get("time") or "").strip(), *hours):
+            by_time = m
+    if by_time is not None:
+        return by_time
 
     # fallback: middle meal looks like lunch
     return meals[min(1, len(meals) - 1)]
@@ -2451,58 +2597,104 @@ async def _handle_recall_plan(message: Message, *, plan_repo: PlanRepo, user: An
     products = m.get("products") or []
     recipe = m.get("recipe_ru") or m.get("recipe") or []
 
-    text = (
-        f"<b>{'Сегодня' if today else ''} {tm + ' — ' if tm else ''}{title}{' / ' + title_cz if title_cz else ''}</b>\n\n"
-        + (
-            "<b>Продукты</b>:\n"
-            + "\n".join(
-                [
-                    f"- {(p.get('name_ru') or p.get('name'))}{(' / ' + str(p.get('name_cz'))) if p.get('name_cz') else ''} — {p.get('grams')} г"
-                    for p in products
-                ]
-            )
-            + "\n\n"
-            if products
-            else ""
+    # flat line list + one join (no nested joins / concatenated intermediates)
+    lines = [f"<b>{'Сегодня' if today else ''} {tm + ' — ' if tm else ''}{title}{' / ' + title_cz if title_cz else ''}</b>", ""]
+    if products:
+        lines.append("<b>Продукты</b>:")
+        lines.extend(
+            f"- {(p.get('name_ru') or p.get('name'))}{(' / ' + str(p.get('name_cz'))) if p.get('name_cz') else ''} — {p.get('grams')} г"
+            for p in products
         )
-        + ("<b>Рецепт</b>:\n" + "\n".join([f"- {s}" for s in recipe]) if recipe else "")
-    )
+        lines.append("")
+    if recipe:
+        lines.append("<b>Рецепт</b>:")
+        lines.extend(f"- {s}" for s in recipe)
+    else:
+        lines.append("")  # same trailing blank line as before
+    text = "\n".join(lines)
     await message.answer(text[:3900], reply_markup=main_menu_kb())
     return True
 
 
+async def _read_detached(fn: Callable[[Any], Awaitable[T]]) -> T:
+    # read-only query on its own short-lived session, so several can run at once
+    # (one AsyncSession can't execute concurrently); never commits
+    async with SessionLocal() as db:
+        return await fn(db)
+
+
+_CTX_DESC_MAX = 80
+
+
+def _meal_brief(m: Any) -> dict[str, Any]:
+    # compact entry for the LLM context: minutes instead of full ISO, empty fields left out
+    out: dict[str, Any] = {"at": m.created_at.strftime("%Y-%m-%d %H:%M")}
+    if m.source and m.source != "text":
+        out["source"] = m.source
+    for k in ("calories", "protein_g", "fat_g", "carbs_g"):
+        v = getattr(m, k)
+        if v is not None:
+            out[k] = v
+    desc = (m.description_raw or "").strip()
+    if desc:
+        out["desc"] = desc if len(desc) <= _CTX_DESC_MAX else desc[: _CTX_DESC_MAX - 1] + "…"
+    return out
+
+
+def _round_num(v: Any) -> Any:
+    return int(round(v)) if isinstance(v, float) else v
+
+
+def _plan_brief(plan: dict[str, Any] | None) -> dict[str, Any] | None:
+    """Plan for the LLM context: time, name, macros and products per meal; no recipes or shopping list."""
+    if not isinstance(plan, dict):
+        return None
+    meals = []
+    for m in plan.get("meals") or []:
+        if not isinstance(m, dict):
+            continue
+        row: dict[str, Any] = {"time": m.get("time"), "title": m.get("title_ru") or m.get("title")}
+        for k in ("kcal", "protein_g", "fat_g", "carbs_g"):
+            if m.get(k) is not None:
+                row[k] = _round_num(m[k])
+        products = [p.get("name_ru") or p.get("name") for p in m.get("products") or [] if isinstance(p, dict)]
+        if products:
+            row["products"] = [p for p in products if p]
+        meals.append(row)
+    totals = plan.get("totals")
+    out: dict[str, Any] = {"meals": meals}
+    if isinstance(totals, dict):
+        out["totals"] = {k: _round_num(v) for k, v in totals.items()}
+    return out
+
+
+async def _latest_plan(db: Any, user_id: int) -> tuple[dt.date | None, dict[str, Any] | None]:
+    plan_repo = PlanRepo(db)
+    d = await plan_repo.last_plan_date(user_id)
+    return d, (await plan_repo.get_day_plan_json(user_id, d) if d else None)
+
+
 async def _handle_coach_chat(
     message: Message,
     *,
     pref_repo: PreferenceRepo,
-    meal_repo: MealRepo,
-    plan_repo: PlanRepo,
-    note_repo: CoachNoteRepo,
     user: Any,
 ) -> bool:
     q = (message.text or "").strip()
     if not q:
         return False
 
-    prefs = await pref_repo.get_json(user.id)
+    # prefs stay on the request session (may hold this update's own writes); history comes from
+    # committed data on side sessions, all fetched concurrently
     today = dt.date.today()
-    today_plan = await plan_repo.get_day_plan_json(user.id, today)
-    latest_plan_date = await plan_repo.last_plan_date(user.id)
-    latest_plan = await plan_repo.get_day_plan_json(user.id, latest_plan_date) if latest_plan_date else None
-    recent_notes = await note_repo.last_notes(user.id, limit=20)
-    last_meals = await meal_repo.last_meals(user.id, limit=12)
-    meals_json = [
-        {
-            "created_at": m.created_at.isoformat(),
-            "source": m.source,
-            "calories": m.calories,
-            "protein_g": m.protein_g,
-            "fat_g": m.fat_g,
-            "carbs_g": m.carbs_g,
-            "description_raw": m.description_raw,
-        }
-        for m in last_meals
-    ]
+    prefs, today_plan, (latest_plan_date, latest_plan), recent_notes, last_meals = await asyncio.gather(
+        pref_repo.get_json(user.id),
+        _read_detached(lambda db: PlanRepo(db).get_day_plan_json(user.id, today)),
+        _read_detached(lambda db: _latest_plan(db, user.id)),
+        _read_detached(lambda db: CoachNoteRepo(db).last_notes(user.id, limit=20)),
+        _read_detached(lambda db: MealRepo(db).last_meals(user.id, limit=12)),
+    )
+    meals_json = [_meal_brief(m) for m in last_meals]
 
     # add computed targets meta if possible (truth / hard numbers)
     try:
@@ -2533,8 +2725,8 @@ async def _handle_coach_chat(
         },
         "calc_meta": calc_meta,
         "preferences": prefs,
-        "today_plan": today_plan,
-        "latest_plan": {"date": latest_plan_date.isoformat(), "plan": latest_plan} if latest_plan_date and latest_plan else None,
+        "today_plan": _plan_brief(today_plan),
+        "latest_plan": {"date": latest_plan_date.isoformat(), "plan": _plan_brief(latest_plan)} if latest_plan_date and latest_plan else None,
         "recent_meals": meals_json,
         "coach_notes": recent_notes,
     }
@@ -2603,17 +2795,18 @@ async def _handle_recipe_ai(message: Message, *, user_repo: UserRepo, food_servi
     return True
 
 
-async def _handle_plan_edit_stateless(message: Message, *, db: Any, user: Any) -> bool:
+async def _handle_plan_edit_stateless(message: Message, *, db: Any, user: Any, text_norm: str | None = None) -> bool:
     """
     Chat-first plan edits: no dialog_state.
     If user mentions meal slot/time/training, edit the latest available plan (else tomorrow).
+    text_norm: the message text through _norm_text, when the caller already has it.
     """
     txt = (message.text or "").strip()
     if not txt:
         return False
 
-    tnorm = _norm_text(txt)
-    slot = _detect_meal_slot(txt)
+    tnorm = text_norm if text_norm is not None else _norm_text(txt)
+    slot = _detect_meal_slot(tnorm)
     times = _extract_times(txt)
     mentions_training = "трен" in tnorm
 
@@ -2676,7 +2869,7 @@ async def _handle_plan_edit_stateless(message: Message, *, db: Any, user: Any) -
 
     # Optional "day N" relative to base date (best-effort)
     try:
-        day_idx = _plan_day_index_from_text(txt, days=7)
+        day_idx = _plan_day_index_from_text(tnorm, days=7)
     except Exception:
         day_idx = 1
     edit_date = base_date + dt.timedelta(days=max(0, day_idx - 1))
@@ -2704,7 +2897,7 @@ async def _handle_plan_edit_stateless(message: Message, *, db: Any, user: Any) -
             current_for_edit = current
 
     mt = prefs.get("meal_times") if isinstance(prefs.get("meal_times"), list) else None
-    meal_times0 = [t for t in (mt or []) if isinstance(t, str) and re.fullmatch(r"\d{2}:\d{2}", t.strip())][:8]
+    meal_times0 = [t for t in (mt or []) if isinstance(t, str) and _HHMM_RE.fullmatch(t.strip())][:8]
     meal_times = _complete_meal_times([str(x) for x in meal_times0])
     routine_line = ""
     if meal_times and not times:
@@ -2990,170 +3183,265 @@ async def _handle_targets_mode(message: Message, *, user_repo: UserRepo, user: A
     return True
 
 
+_WEIGHT_PROMPT_TEXT = "Доброе утро. Пришли текущий вес (кг)."
+_DAILY_CHECKIN_TEXT = (
+    "Дневной чек‑лист (ответь одним сообщением):\n"
+    "- калории: да/нет\n"
+    "- белок: да/нет\n"
+    "- шаги: число\n"
+    "- сон: часы\n"
+    "- тренировка: да/нет\n"
+    "- алкоголь: да/нет\n"
+    "Можно коротко: «ккал да, белок нет, шаги 9000, сон 7.5, трен да, алко нет»."
+)
+
+
+def _checkin_text(want_photo: bool, want_meas: bool) -> str:
+    parts = ["Проверка прогресса:"]
+    if want_photo:
+        parts.append("- пришли фото (фронт/бок/спина) при одинаковом свете")
+    if want_meas:
+        parts.append("- и замеры: талия/бедра/грудь (см)")
+    parts.append("Если хочешь отключить — напиши: «отмени чек-ин».")
+    return "\n".join(parts)
+
+
+# (photo, measurements) -> progress request text; all 4 variants built up front
+_CHECKIN_TEXTS = {(ph, me): _checkin_text(ph, me) for ph in (True, False) for me in (True, False)}
+
+
+# users handled concurrently per tick; keeps bursts well under Telegram's ~30 msg/s
+_CHECKIN_SLOTS = asyncio.Semaphore(20)
+
+
+def _last_checkin_ts(prefs: dict[str, Any]) -> float | None:
+    # epoch is written next to the ISO string; rows from before that fall back to parsing it
+    ts = prefs.get("last_checkin_request_epoch")
+    if isinstance(ts, (int, float)) and not isinstance(ts, bool):
+        return float(ts)
+    last = _parse_dt(prefs.get("last_checkin_request_utc"))
+    return last.replace(tzinfo=dt.timezone.utc).timestamp() if last else None
+
+
+async def _run_user_schedule(bot: Bot, user_id: int, chat_id: int, prefs: dict[str, Any], now_utc: dt.datetime) -> None:
+    """
+    One user's checkin/weight/reminder/daily prompts for this tick.
+    Sends first, then writes the "last sent" markers in one merge on its own session.
+    """
+    patch: dict[str, Any] = {}
+    now_local = now_utc.astimezone(_tz_from_prefs(prefs))
+    today_str = now_local.date().isoformat()
+    is_weekday = now_local.weekday() < 5  # 0=Mon
+
+    every = prefs.get("checkin_every_days")
+    if not isinstance(every, (int, float)) or every <= 0:
+        every = None
+
+    if every is not None:
+        last_ts = _last_checkin_ts(prefs)
+        if last_ts is not None and (now_utc.timestamp() - last_ts) < float(every) * 86400.0:
+            pass
+        else:
+            ask = prefs.get("checkin_ask") or {}
+            text = _CHECKIN_TEXTS[(bool(ask.get("photo", True)), bool(ask.get("measurements", True)))]
+
+            try:
+                await bot.send_message(chat_id, text, reply_markup=main_menu_kb())
+                patch["last_checkin_request_utc"] = now_utc.isoformat()
+                patch["last_checkin_request_epoch"] = now_utc.timestamp()
+            except Exception:
+                pass
+
+    # daily weight prompt (time-based)
+    if prefs.get("weight_prompt_enabled") is True:
+        tstr = prefs.get("weight_prompt_time")
+        tstr = tstr if isinstance(tstr, str) else "06:00"
+        days = prefs.get("weight_prompt_days")
+        days = days if days in _VALID_DAYS else "all"
+        if _HHMM_RE.fullmatch(tstr):
+            hh = int(tstr[:2])
+            mm = int(tstr[3:5])
+            if (days == "weekdays" and not is_weekday) or (days == "weekends" and is_weekday):
+                pass
+            else:
+                last_date = prefs.get("last_weight_prompt_date")
+                if now_local.hour == hh and mm <= now_local.minute <= mm + 2 and last_date != today_str:
+                    try:
+                        await bot.send_message(chat_id, _WEIGHT_PROMPT_TEXT, reply_markup=main_menu_kb())
+                        patch["last_weight_prompt_date"] = today_str
+                    except Exception:
+                        pass
+
+    # generic reminders (time-based)
+    rems = prefs.get("reminders")
+    if isinstance(rems, list) and rems:
+        last_sent = prefs.get("reminders_last_sent")
+        last_sent = last_sent if isinstance(last_sent, dict) else {}
+        updated_last: dict[str, Any] | None = None
+
+        for idx, r in enumerate(rems[:20]):
+            if not isinstance(r, dict):
+                continue
+            tstr = r.get("time")
+            days = r.get("days")
+            text = r.get("text")
+            if not (isinstance(tstr, str) and _HHMM_RE.fullmatch(tstr.strip())):
+                continue
+            if days not in _VALID_DAYS:
+                continue
+            if not isinstance(text, str) or not text.strip():
+                continue
+
+            hh = int(tstr[:2])
+            mm = int(tstr[3:5])
+            if (days == "weekdays" and not is_weekday) or (days == "weekends" and is_weekday):
+                continue
+
+            rid = f"r{idx}"
+            if now_local.hour == hh and mm <= now_local.minute <= mm + 2 and last_sent.get(rid) != today_str:
+                try:
+                    await bot.send_message(chat_id, str(text).strip(), reply_markup=main_menu_kb())
+                    if updated_last is None:
+                        updated_last = dict(last_sent)
+                    updated_last[rid] = today_str
+                except Exception:
+                    pass
+
+        if updated_last is not None:
+            patch["reminders_last_sent"] = updated_last
+
+    # daily discipline check-in (structured)
+    if prefs.get("daily_checkin_enabled") is True:
+        tstr = prefs.get("daily_checkin_time")
+        tstr = tstr if isinstance(tstr, str) else "21:30"
+        days = prefs.get("daily_checkin_days")
+        days = days if days in _VALID_DAYS else "all"
+        if _HHMM_RE.fullmatch(tstr):
+            hh = int(tstr[:2])
+            mm = int(tstr[3:5])
+            if (days == "weekdays" and not is_weekday) or (days == "weekends" and is_weekday):
+                pass
+            else:
+                last_date = prefs.get("last_daily_checkin_date")
+                if now_local.hour == hh and mm <= now_local.minute <= mm + 2 and last_date != today_str:
+                    try:
+                        await bot.send_message(chat_id, _DAILY_CHECKIN_TEXT, reply_markup=main_menu_kb())
+                        patch["last_daily_checkin_date"] = today_str
+                    except Exception:
+                        pass
+
+    if patch:
+        try:
+            async with SessionLocal() as db:
+                await PreferenceRepo(db).merge(user_id, patch)
+                await db.commit()
+        except Exception:
+            pass
+
+
+async def _bounded_user_schedule(bot: Bot, user_id: int, chat_id: int, prefs: dict[str, Any], now_utc: dt.datetime) -> None:
+    async with _CHECKIN_SLOTS:
+        await _run_user_schedule(bot, user_id, chat_id, prefs, now_utc)
+
+
+def _next_user_wakeup(prefs: dict[str, Any], now_utc: dt.datetime) -> float:
+    """
+    Earliest epoch second at which _run_user_schedule could send something for these prefs.
+    Errs early (ignores weekday filters), never late.
+    """
+    now_ts = now_utc.timestamp()
+    wake = now_ts + 86400.0
+
+    every = prefs.get("checkin_every_days")
+    if isinstance(every, (int, float)) and every > 0:
+        last_ts = _last_checkin_ts(prefs)
+        if last_ts is None:
+            return now_ts
+        wake = min(wake, last_ts + float(every) * 86400.0)
+
+    # (HH:MM, local date it was last sent)
+    times: list[tuple[str, Any]] = []
+    if prefs.get("weight_prompt_enabled") is True:
+        t = prefs.get("weight_prompt_time")
+        times.append((t if isinstance(t, str) else "06:00", prefs.get("last_weight_prompt_date")))
+    if prefs.get("daily_checkin_enabled") is True:
+        t = prefs.get("daily_checkin_time")
+        times.append((t if isinstance(t, str) else "21:30", prefs.get("last_daily_checkin_date")))
+    rems = prefs.get("reminders")
+    if isinstance(rems, list):
+        last_sent = prefs.get("reminders_last_sent")
+        last_sent = last_sent if isinstance(last_sent, dict) else {}
+        for idx, r in enumerate(rems[:20]):
+            if isinstance(r, dict) and isinstance(r.get("time"), str):
+                times.append((r["time"].strip(), last_sent.get(f"r{idx}")))
+    if not times:
+        return wake
+
+    tz = _tz_from_prefs(prefs)
+    now_local = now_utc.astimezone(tz)
+    today_str = now_local.date().isoformat()
+    for t, sent_on in times:
+        if not _HHMM_RE.fullmatch(t):
+            continue
+        hh, mm = int(t[:2]), int(t[3:5])
+        if hh > 23 or mm > 59:
+            continue
+        at = now_local.replace(hour=hh, minute=mm, second=0, microsecond=0)
+        # send window is hh:mm..hh:mm+2; once it's over (or done today) the next chance is tomorrow
+        if sent_on == today_str or now_local >= at + dt.timedelta(minutes=3):
+            at = dt.datetime.combine(now_local.date() + dt.timedelta(days=1), dt.time(hh, mm), tzinfo=tz)
+        wake = min(wake, at.timestamp())
+    return wake
+
+
+# user_id -> (prefs dict it was computed from, next wakeup epoch). list_scheduled hands back the
+# same dict while the stored JSON is unchanged, so an identity check doubles as invalidation
+_user_wakeups: dict[int, tuple[dict[str, Any], float]] = {}
+
+
 async def _checkin_loop(bot: Bot) -> None:
     """
     Background loop that periodically asks users for photo/measurements according to preferences.
     """
+    global _user_wakeups
     while True:
+        delay = 60.0
         try:
             async with SessionLocal() as db:
-                pref_repo = PreferenceRepo(db)
-                # list users
-                res = await db.execute(select(User).where(User.profile_complete == True))  # noqa: E712
-                users = list(res.scalars().all())
-                now_utc = dt.datetime.now(dt.timezone.utc)
-
-                for u in users:
-                    prefs = await pref_repo.get_json(u.id)
-
-                    tz_name = prefs.get("timezone") if isinstance(prefs.get("timezone"), str) else "Europe/Prague"
-                    try:
-                        tz = ZoneInfo(tz_name)
-                    except Exception:
-                        tz = ZoneInfo("Europe/Prague")
-                    now_local = now_utc.astimezone(tz)
-
-                    every = prefs.get("checkin_every_days")
-                    if not isinstance(every, (int, float)) or every <= 0:
-                        every = None
-
-                    if every is not None:
-                        last = _parse_dt(prefs.get("last_checkin_request_utc"))
-                        if last:
-                            last_utc = last.replace(tzinfo=dt.timezone.utc)
-                        else:
-                            last_utc = None
-                        if last_utc and (now_utc - last_utc) < dt.timedelta(days=float(every)):
-                            pass
-                        else:
-                            ask = prefs.get("checkin_ask") or {}
-                            want_photo = bool(ask.get("photo", True))
-                            want_meas = bool(ask.get("measurements", True))
-                            parts = ["Проверка прогресса:"]
-                            if want_photo:
-                                parts.append("- пришли фото (фронт/бок/спина) при одинаковом свете")
-                            if want_meas:
-                                parts.append("- и замеры: талия/бедра/грудь (см)")
-                            parts.append("Если хочешь отключить — напиши: «отмени чек-ин».")
-                            text = "\n".join(parts)
-
-                            try:
-                                await bot.send_message(u.telegram_id, text, reply_markup=main_menu_kb())
-                                await pref_repo.merge(u.id, {"last_checkin_request_utc": now_utc.isoformat()})
-                                await db.commit()
-                            except Exception:
-                                pass
-
-                    # daily weight prompt (time-based)
-                    if prefs.get("weight_prompt_enabled") is True:
-                        tstr = prefs.get("weight_prompt_time") if isinstance(prefs.get("weight_prompt_time"), str) else "06:00"
-                        days = prefs.get("weight_prompt_days") if prefs.get("weight_prompt_days") in {"weekdays", "weekends", "all"} else "all"
-                        if re.fullmatch(r"\d{2}:\d{2}", tstr):
-                            hh = int(tstr[:2])
-                            mm = int(tstr[3:5])
-                            wd = now_local.weekday()  # 0=Mon
-                            is_weekday = wd < 5
-                            if (days == "weekdays" and not is_weekday) or (days == "weekends" and is_weekday):
-                                pass
-                            else:
-                                last_date = prefs.get("last_weight_prompt_date")
-                                today_str = now_local.date().isoformat()
-                                if now_local.hour == hh and mm <= now_local.minute <= mm + 2 and last_date != today_str:
-                                    try:
-                                        await bot.send_message(
-                                            u.telegram_id,
-                                            "Доброе утро. Пришли текущий вес (кг).",
-                                            reply_markup=main_menu_kb(),
-                                        )
-                                        await pref_repo.merge(u.id, {"last_weight_prompt_date": today_str})
-                                        await db.commit()
-                                    except Exception:
-                                        pass
-
-                    # generic reminders (time-based)
-                    rems = prefs.get("reminders")
-                    if isinstance(rems, list) and rems:
-                        last_sent = prefs.get("reminders_last_sent")
-                        last_sent = last_sent if isinstance(last_sent, dict) else {}
-                        updated_last: dict[str, Any] | None = None
-
-                        for idx, r in enumerate(rems[:20]):
-                            if not isinstance(r, dict):
-                                continue
-                            tstr = r.get("time")
-                            days = r.get("days")
-                            text = r.get("text")
-                            if not (isinstance(tstr, str) and re.fullmatch(r"\d{2}:\d{2}", tstr.strip())):
-                                continue
-                            if days not in {"weekdays", "weekends", "all"}:
-                                continue
-                            if not isinstance(text, str) or not text.strip():
-                                continue
-
-                            hh = int(tstr[:2])
-                            mm = int(tstr[3:5])
-                            wd = now_local.weekday()
-                            is_weekday = wd < 5
-                            if (days == "weekdays" and not is_weekday) or (days == "weekends" and is_weekday):
-                                continue
-
-                            rid = f"r{idx}"
-                            today_str = now_local.date().isoformat()
-                            if now_local.hour == hh and mm <= now_local.minute <= mm + 2 and last_sent.get(rid) != today_str:
-                                try:
-                                    await bot.send_message(u.telegram_id, str(text).strip(), reply_markup=main_menu_kb())
-                                    if updated_last is None:
-                                        updated_last = dict(last_sent)
-                                    updated_last[rid] = today_str
-                                except Exception:
-                                    pass
-
-                        if updated_last is not None:
-                            try:
-                                await pref_repo.merge(u.id, {"reminders_last_sent": updated_last})
-                                await db.commit()
-                            except Exception:
-                                pass
-
-                    # daily discipline check-in (structured)
-                    if prefs.get("daily_checkin_enabled") is True:
-                        tstr = prefs.get("daily_checkin_time") if isinstance(prefs.get("daily_checkin_time"), str) else "21:30"
-                        days = prefs.get("daily_checkin_days") if prefs.get("daily_checkin_days") in {"weekdays", "weekends", "all"} else "all"
-                        if re.fullmatch(r"\d{2}:\d{2}", tstr):
-                            hh = int(tstr[:2])
-                            mm = int(tstr[3:5])
-                            wd = now_local.weekday()
-                            is_weekday = wd < 5
-                            if (days == "weekdays" and not is_weekday) or (days == "weekends" and is_weekday):
-                                pass
-                            else:
-                                last_date = prefs.get("last_daily_checkin_date")
-                                today_str = now_local.date().isoformat()
-                                if now_local.hour == hh and mm <= now_local.minute <= mm + 2 and last_date != today_str:
-                                    try:
-                                        await bot.send_message(
-                                            u.telegram_id,
-                                            "Дневной чек‑лист (ответь одним сообщением):\n"
-                                            "- калории: да/нет\n"
-                                            "- белок: да/нет\n"
-                                            "- шаги: число\n"
-                                            "- сон: часы\n"
-                                            "- тренировка: да/нет\n"
-                                            "- алкоголь: да/нет\n"
-                                            "Можно коротко: «ккал да, белок нет, шаги 9000, сон 7.5, трен да, алко нет».",
-                                            reply_markup=main_menu_kb(),
-                                        )
-                                        await pref_repo.merge(u.id, {"last_daily_checkin_date": today_str})
-                                        await db.commit()
-                                    except Exception:
-                                        pass
+                # only users with some schedule in their preferences, prefs joined in;
+                # cached in the repo until a prefs/profile write commits
+                scheduled = await UserRepo(db).list_scheduled()
+            now_utc = dt.datetime.now(dt.timezone.utc)
+            now_ts = now_utc.timestamp()
+            wakeups: dict[int, tuple[dict[str, Any], float]] = {}
+            due: list[tuple[int, int, dict[str, Any]]] = []
+            for user_id, chat_id, prefs in scheduled:
+                prev = _user_wakeups.get(user_id)
+                if prev is None or prev[0] is not prefs or prev[1] <= now_ts:
+                    # sends rewrite prefs, so after a send the next tick recomputes anyway
+                    prev = (prefs, _next_user_wakeup(prefs, now_utc))
+                    if prev[1] <= now_ts:
+                        due.append((user_id, chat_id, prefs))
+                wakeups[user_id] = prev
+            _user_wakeups = wakeups
+            # users are independent: fan out, each task writes through its own session
+            await asyncio.gather(
+                *(_bounded_user_schedule(bot, user_id, chat_id, prefs, now_utc) for user_id, chat_id, prefs in due),
+                return_exceptions=True,
+            )
+            if wakeups:
+                # wake right at the earliest event; still re-poll every minute for new/changed prefs.
+                # overdue users (failed sends) just retry on the regular minute tick
+                left = min(w for _, w in wakeups.values()) - dt.datetime.now(dt.timezone.utc).timestamp()
+                if left > 0:
+                    delay = min(60.0, max(1.0, left))
         except Exception:
             pass
 
-        await asyncio.sleep(60)
+        await asyncio.sleep(delay)
 
 
-@router.message(Command("plan"))
+@commands_router.message(Command("plan"))
 async def cmd_plan(message: Message) -> None:
     if not message.from_user:
         return
@@ -3161,7 +3449,7 @@ async def cmd_plan(message: Message) -> None:
     async with SessionLocal() as db:
         user_repo = UserRepo(db)
         pref_repo = PreferenceRepo(db)
-        user = await user_repo.get_or_create(message.from_user.id, message.from_user.username)
+        user = await user_repo.get_or_create(message.from_user.id, message.from_user.username, food_prefs=True)
         if not user.profile_complete:
             await message.answer("Сначала заполним профиль: /start")
             return
@@ -3215,117 +3503,129 @@ async def _generate_plan_for_days(message: Message, *, db: Any, user: Any, days:
         "carbs_g": int(targ.get("carbs_g")) if macros_override else user.carbs_g_target,
     }
 
-    try:
-        day_plans: list[dict[str, Any]] = []
-        for i in range(days):
-            d = start_date + dt.timedelta(days=i)
-            kcal_target = _get_day_kcal(d)
-            if kcal_target is None:
-                raise RuntimeError("Нет целевой нормы калорий в профиле.")
-            if macros_override:
-                macro_line = f"Целевые БЖУ: Б {base_macros.get('protein_g')} / Ж {base_macros.get('fat_g')} / У {base_macros.get('carbs_g')} г.\n"
-            else:
-                try:
-                    mt = macros_for_targets(int(kcal_target), weight_kg=float(user.weight_kg or 0), goal=user.goal or "maintain")  # type: ignore[arg-type]
-                    macro_line = f"Целевые БЖУ: Б {mt.protein_g} / Ж {mt.fat_g} / У {mt.carbs_g} г.\n"
-                except Exception:
-                    macro_line = ""
-            # retry if model doesn't match targets or returns invalid JSON
-            last_plan: dict[str, Any] | None = None
-            last_err: Exception | None = None
-            # Use user's routine if present
-            mt = prefs.get("meal_times") if isinstance(prefs.get("meal_times"), list) else None
-            meal_times0 = [t for t in (mt or []) if isinstance(t, str) and re.fullmatch(r"\d{2}:\d{2}", t.strip())][:8]
-            meal_times = _complete_meal_times([str(x) for x in meal_times0])
-            routine_line = ""
-            if meal_times:
-                routine_line = "\nРежим пользователя: используй эти времена приёмов пищи (строго): " + ", ".join(meal_times) + "."
-            user_prompt = (
-                _profile_context(user)
+    # same for every day: build once, not per day
+    profile_ctx = _profile_context(user)
+    prefs_json = dumps(prefs)
+    # Use user's routine if present
+    mt = prefs.get("meal_times") if isinstance(prefs.get("meal_times"), list) else None
+    meal_times0 = [t for t in (mt or []) if isinstance(t, str) and _HHMM_RE.fullmatch(t.strip())][:8]
+    meal_times = _complete_meal_times([str(x) for x in meal_times0])
+    routine_line = ""
+    if meal_times:
+        routine_line = "\nРежим пользователя: используй эти времена приёмов пищи (строго): " + ", ".join(meal_times) + "."
+    # Speed + cost: try fast model first, then fallback to high-quality model.
+    models_to_try: list[str] = []
+    m_fast = str(getattr(settings, "openai_plan_model_fast", "") or "").strip()
+    if m_fast:
+        models_to_try.append(m_fast)
+    models_to_try.append(settings.openai_plan_model)
+    # Optional extra fallback (helps when some models return empty content/refusal)
+    m_fb = str(getattr(settings, "openai_plan_model_fallback", "") or "").strip()
+    if m_fb:
+        models_to_try.append(m_fb)
+
+    async def _plan_one_day(i: int) -> dict[str, Any]:
+        d = start_date + dt.timedelta(days=i)
+        kcal_target = _get_day_kcal(d)
+        if kcal_target is None:
+            raise RuntimeError("Нет целевой нормы калорий в профиле.")
+        if macros_override:
+            macro_line = f"Целевые БЖУ: Б {base_macros.get('protein_g')} / Ж {base_macros.get('fat_g')} / У {base_macros.get('carbs_g')} г.\n"
+        else:
+            try:
+                mt = macros_for_targets(int(kcal_target), weight_kg=float(user.weight_kg or 0), goal=user.goal or "maintain")  # type: ignore[arg-type]
+                macro_line = f"Целевые БЖУ: Б {mt.protein_g} / Ж {mt.fat_g} / У {mt.carbs_g} г.\n"
+            except Exception:
+                macro_line = ""
+        # retry if model doesn't match targets or returns invalid JSON
+        last_plan: dict[str, Any] | None = None
+        last_err: Exception | None = None
+        user_prompt = (
+            profile_ctx
+            + "\nПредпочтения/режим дня (из БД):\n"
+            + prefs_json
+            + f"\nСоставь рацион на {d.isoformat()} на <b>{kcal_target} ккал</b>.\n"
+            + macro_line
+            + routine_line
+            + "Требования:\n"
+            + "- Страна: Чехия.\n"
+            + "- Сумма за день должна попасть в цель (допуск ±7%).\n"
+            + "- В каждом приёме пищи обязателен список продуктов с граммами.\n"
+            + "- ВАЖНО: в продуктах и названиях дай 2 языка: русский + чешский.\n"
+            + "- shopping_list обязателен и тоже (русский + чешский).\n"
+            + "- Никаких спорт-добавок (whey/протеин/креатин/гейнер).\n"
+            + "- Рацион должен быть сытный, вкусный, без повторов блюд (по возможности), с овощами/клетчаткой.\n"
+            + "- День должен быть закрыт до вечера: последняя еда после 18:00.\n"
+        )
+
+        models_seen: set[str] = set()
+        for m in models_to_try:
+            if not m or m in models_seen:
+                continue
+            models_seen.add(m)
+            try:
+                plan_raw = await text_json(
+                    system=f"{SYSTEM_COACH}\n\n{DAY_PLAN_JSON}",
+                    user=user_prompt,
+                    model=m,
+                    max_output_tokens=2800,
+                    timeout_s=getattr(settings, "openai_plan_timeout_s", 30),
+                )
+            except Exception as e:
+                last_err = e
+                continue
+            if not isinstance(plan_raw, dict):
+                last_err = RuntimeError("Plan JSON is not an object")
+                continue
+            plan = _normalize_day_plan(plan_raw)
+            last_plan = plan
+            if _plan_quality_ok(plan, kcal_target) and _plan_last_hour(plan) >= 18:
+                break
+        if last_plan is None:
+            raise last_err or RuntimeError("Plan generation failed")
+        # Auto-fix pass: if plan is far from target or ends too early, ask the model to adjust.
+        needs_fix = (not _plan_quality_ok(last_plan, kcal_target)) or (_plan_last_hour(last_plan) < 18) or (_plan_totals_kcal(last_plan) < float(kcal_target) * 0.90)
+        if needs_fix:
+            fix_prompt = (
+                profile_ctx
                 + "\nПредпочтения/режим дня (из БД):\n"
-                + dumps(prefs)
-                + f"\nСоставь рацион на {d.isoformat()} на <b>{kcal_target} ккал</b>.\n"
-                + macro_line
-                + routine_line
-                + "Требования:\n"
-                + "- Страна: Чехия.\n"
-                + "- Сумма за день должна попасть в цель (допуск ±7%).\n"
-                + "- В каждом приёме пищи обязателен список продуктов с граммами.\n"
-                + "- ВАЖНО: в продуктах и названиях дай 2 языка: русский + чешский.\n"
-                + "- shopping_list обязателен и тоже (русский + чешский).\n"
-                + "- Никаких спорт-добавок (whey/протеин/креатин/гейнер).\n"
-                + "- Рацион должен быть сытный, вкусный, без повторов блюд (по возможности), с овощами/клетчаткой.\n"
-                + "- День должен быть закрыт до вечера: последняя еда после 18:00.\n"
+                + prefs_json
+                + f"\nЦель: {kcal_target} ккал. {macro_line}"
+                + (("\nВремена приёмов пищи (строго): " + ", ".join(meal_times) + ".\n") if meal_times else "")
+                + "\nТекущий черновик плана (его надо исправить):\n"
+                + dumps(last_plan)
+                + "\n\nЗадача: исправь план так, чтобы:\n"
+                + "- ИТОГО дня было близко к цели (допуск ±7%)\n"
+                + "- День был закрыт до вечера (последняя еда после 18:00)\n"
+                + "- Сохрани рус+чеш названия, граммовки, рецепты\n"
+                + "- Если калорий не хватает — добавь 1-2 приёма пищи и/или увеличь порции\n"
+                + "- Верни строго JSON по схеме.\n"
             )
-
-            # Speed + cost: try fast model first, then fallback to high-quality model.
-            models_to_try: list[str] = []
-            m_fast = str(getattr(settings, "openai_plan_model_fast", "") or "").strip()
-            if m_fast:
-                models_to_try.append(m_fast)
-            models_to_try.append(settings.openai_plan_model)
-            # Optional extra fallback (helps when some models return empty content/refusal)
-            m_fb = str(getattr(settings, "openai_plan_model_fallback", "") or "").strip()
-            if m_fb:
-                models_to_try.append(m_fb)
-            models_seen: set[str] = set()
-            for m in models_to_try:
-                if not m or m in models_seen:
-                    continue
-                models_seen.add(m)
-                try:
-                    plan_raw = await text_json(
-                        system=f"{SYSTEM_COACH}\n\n{DAY_PLAN_JSON}",
-                        user=user_prompt,
-                        model=m,
-                        max_output_tokens=2800,
-                        timeout_s=getattr(settings, "openai_plan_timeout_s", 30),
-                    )
-                except Exception as e:
-                    last_err = e
-                    continue
-                if not isinstance(plan_raw, dict):
-                    last_err = RuntimeError("Plan JSON is not an object")
-                    continue
-                plan = _normalize_day_plan(plan_raw)
-                last_plan = plan
-                if _plan_quality_ok(plan, kcal_target) and _plan_last_hour(plan) >= 18:
-                    break
-            if last_plan is None:
-                raise last_err or RuntimeError("Plan generation failed")
-            # Auto-fix pass: if plan is far from target or ends too early, ask the model to adjust.
-            needs_fix = (not _plan_quality_ok(last_plan, kcal_target)) or (_plan_last_hour(last_plan) < 18) or (_plan_totals_kcal(last_plan) < float(kcal_target) * 0.90)
-            if needs_fix:
-                fix_prompt = (
-                    _profile_context(user)
-                    + "\nПредпочтения/режим дня (из БД):\n"
-                    + dumps(prefs)
-                    + f"\nЦель: {kcal_target} ккал. {macro_line}"
-                    + (("\nВремена приёмов пищи (строго): " + ", ".join(meal_times) + ".\n") if meal_times else "")
-                    + "\nТекущий черновик плана (его надо исправить):\n"
-                    + dumps(last_plan)
-                    + "\n\nЗадача: исправь план так, чтобы:\n"
-                    + "- ИТОГО дня было близко к цели (допуск ±7%)\n"
-                    + "- День был закрыт до вечера (последняя еда после 18:00)\n"
-                    + "- Сохрани рус+чеш названия, граммовки, рецепты\n"
-                    + "- Если калорий не хватает — добавь 1-2 приёма пищи и/или увеличь порции\n"
-                    + "- Верни строго JSON по схеме.\n"
+            try:
+                fixed_raw = await text_json(
+                    system=f"{SYSTEM_COACH}\n\n{DAY_PLAN_JSON}",
+                    user=fix_prompt,
+                    model=settings.openai_plan_model,
+                    max_output_tokens=2800,
+                    timeout_s=getattr(settings, "openai_plan_timeout_s", 60),
                 )
-                try:
-                    fixed_raw = await text_json(
-                        system=f"{SYSTEM_COACH}\n\n{DAY_PLAN_JSON}",
-                        user=fix_prompt,
-                        model=settings.openai_plan_model,
-                        max_output_tokens=2800,
-                        timeout_s=getattr(settings, "openai_plan_timeout_s", 60),
-                    )
-                    if isinstance(fixed_raw, dict):
-                        fixed = _normalize_day_plan(fixed_raw)
-                        last_plan = fixed
-                except Exception:
-                    pass
-            plan = last_plan
-            day_plans.append(plan)
+                if isinstance(fixed_raw, dict):
+                    fixed = _normalize_day_plan(fixed_raw)
+                    last_plan = fixed
+            except Exception:
+                pass
+        return last_plan
+
+    try:
+        # days are independent: generate them concurrently (the OpenAI client caps parallel calls)
+        tasks = [asyncio.ensure_future(_plan_one_day(i)) for i in range(days)]
+        try:
+            day_plans: list[dict[str, Any]] = list(await asyncio.gather(*tasks))
+        except BaseException:
+            # one failed day fails the whole run: don't leave the others burning tokens
+            for t in tasks:
+                t.cancel()
+            raise
     except Exception as e:
         try:
             print("PLAN_GENERATION_ERROR:", type(e).__name__, _scrub_secrets(str(e))[:500])
@@ -3363,7 +3663,7 @@ async def _generate_plan_for_days(message: Message, *, db: Any, user: Any, days:
     await _send_plans(message, db=db, user=user, start_date=start_date, day_plans=day_plans)
 
 
-@router.message(Command("recipe"))
+@commands_router.message(Command("recipe"))
 async def cmd_recipe(message: Message) -> None:
     text = (message.text or "").strip()
     payload = text[len("/recipe") :].strip()
@@ -3397,7 +3697,7 @@ async def cmd_recipe(message: Message) -> None:
     )
 
 
-@router.message(Command("week"))
+@commands_router.message(Command("week"))
 async def cmd_week(message: Message) -> None:
     if not message.from_user:
         return
@@ -3409,7 +3709,7 @@ async def cmd_week(message: Message) -> None:
         note_repo = CoachNoteRepo(db)
         pref_repo = PreferenceRepo(db)
         wrepo = WeightLogRepo(db)
-        user = await user_repo.get_or_create(message.from_user.id, message.from_user.username)
+        user = await user_repo.get_or_create(message.from_user.id, message.from_user.username, food_prefs=True)
         if not user.profile_complete:
             await message.answer("Сначала заполним профиль: /start")
             return
@@ -3435,17 +3735,19 @@ async def cmd_week(message: Message) -> None:
                 }
             )
 
+        # serialized once: the text fallback sends the same context
+        week_ctx = _profile_context(user) + "\nДневник за 7 дней:\n" + dumps(diary)
         try:
             analysis = await text_json(
                 system=f"{SYSTEM_NUTRITIONIST}\n\n{WEEKLY_ANALYSIS_JSON}",
-                user=_profile_context(user) + "\nДневник за 7 дней:\n" + dumps(diary),
+                user=week_ctx,
                 max_output_tokens=1200,
             )
         except Exception:
             txt = await text_output(
                 system=SYSTEM_NUTRITIONIST
                 + "\nПроанализируй дневник за 7 дней и профиль: ошибки, рекомендации, поддержка. Пиши пунктами.",
-                user=_profile_context(user) + "\nДневник за 7 дней:\n" + dumps(diary),
+                user=week_ctx,
                 max_output_tokens=1200,
             )
             out = _safe_nonempty_text(_sanitize_ai_text(txt), fallback="⚠️ Не смог получить текст анализа. Попробуй ещё раз через пару секунд.")
@@ -3518,6 +3820,41 @@ async def cmd_week(message: Message) -> None:
             )
 
 
+# menu buttons that only answer with a fixed hint
+_BTN_REPLIES: dict[str, str] = {
+    BTN_MENU: "Меню:",
+    BTN_REMINDERS: (
+        "Опиши напоминания одним сообщением — я сохраню.\n"
+        "Примеры:\n"
+        "- «каждый день в 06:00 спроси вес»\n"
+        "- «в 09:00 по будням перекус»\n"
+        "- «в 21:30 спроси, как прошёл день и соблюдал ли калории»\n"
+        "- «каждые 3 дня попроси фото и замеры»\n\n"
+        "Чтобы отключить/изменить — просто напиши новое правило."
+    ),
+    BTN_PROGRESS: (
+        "Пришли замеры текстом (пример: «талия 102, грудь 112, бедра 108»)\n"
+        "или фото прогресса с подписью «прогресс»."
+    ),
+    BTN_WEIGHT: "Напиши новый вес в кг (например: 82.5).",
+    BTN_PHOTO_HELP: "Ок. Просто отправь фото блюда сюда — я разберу и посчитаю.",
+    BTN_LOG_MEAL: "Напиши прием пищи одним сообщением, начиная с <code>еда:</code> (пример: «еда: гречка 200г, курица 150г, масло 10г»).",
+}
+
+# menu buttons / router actions that map straight onto a command handler
+_BTN_COMMANDS: dict[str, Callable[[Message], Awaitable[None]]] = {
+    BTN_HELP: cmd_help,
+    BTN_PROFILE: cmd_profile,
+    BTN_WEEK: cmd_week,
+}
+_ACTION_COMMANDS: dict[str, Callable[[Message], Awaitable[None]]] = {
+    "help": cmd_help,
+    "show_profile": cmd_profile,
+    "plan_day": cmd_plan,
+    "analyze_week": cmd_week,
+}
+
+
 @router.message()
 async def any_text(message: Message) -> None:
     if not message.from_user:
@@ -3527,14 +3864,16 @@ async def any_text(message: Message) -> None:
         user_repo = UserRepo(db)
         meal_repo = MealRepo(db)
         food_repo = FoodRepo(db)
-        user = await user_repo.get_or_create(message.from_user.id, message.from_user.username)
+        user = await user_repo.get_or_create(message.from_user.id, message.from_user.username, food_prefs=True)
 
         # If a long-running plan is being generated, keep UX tight.
         t_now = (message.text or "").strip()
+        # normalized once here; the handlers below get it instead of re-running _norm_text
+        t_norm = _norm_text(t_now)
         if user.dialog_state == "plan_generating":
             # auto-timeout: if stuck too long, reset
             try:
-                data = loads(user.dialog_data_json) if user.dialog_data_json else {}
+                data = await user_repo.get_dialog_data(user) or {}
                 started = data.get("started_at_utc") if isinstance(data, dict) else None
                 if isinstance(started, str):
                     st = dt.datetime.fromisoformat(started.replace("Z", "+00:00"))
@@ -3546,7 +3885,7 @@ async def any_text(message: Message) -> None:
             except Exception:
                 pass
 
-            if _norm_text(t_now) in {_norm_text(BTN_CANCEL), "отмена"} or t_now in {"❌ Отмена", BTN_MENU}:
+            if t_norm in _CANCEL_NORM or t_now in {BTN_CANCEL, BTN_MENU}:
                 await user_repo.set_dialog(user, state=None, step=None, data=None)
                 await db.commit()
                 await message.answer("Ок, отменил. 🧠 Если нужно — снова жми 🗓️ Рацион на день.", reply_markup=main_menu_kb())
@@ -3568,15 +3907,14 @@ async def any_text(message: Message) -> None:
             return
 
         # Menu buttons
-        t = (message.text or "").strip()
-        if t in {BTN_MENU}:
-            await message.answer("Меню:", reply_markup=main_menu_kb())
-            return
-        if t in {BTN_HELP}:
-            await cmd_help(message)
+        t = t_now
+        reply = _BTN_REPLIES.get(t)
+        if reply is not None:
+            await message.answer(reply, reply_markup=main_menu_kb())
             return
-        if t in {BTN_PROFILE}:
-            await cmd_profile(message)
+        cmd = _BTN_COMMANDS.get(t)
+        if cmd is not None:
+            await cmd(message)
             return
         if t in {BTN_PLAN}:
             pref_repo = PreferenceRepo(db)
@@ -3588,51 +3926,18 @@ async def any_text(message: Message) -> None:
             await message.answer("⏳ Готовлю рацион… (обычно 10–60 сек) 🍽️", reply_markup=cancel_kb())
             await _generate_plan_for_days(message, db=db, user=user, days=1, start_date=start_date)
             return
-        if t in {BTN_WEEK}:
-            await cmd_week(message)
-            return
-        if t in {BTN_REMINDERS}:
-            await message.answer(
-                "Опиши напоминания одним сообщением — я сохраню.\n"
-                "Примеры:\n"
-                "- «каждый день в 06:00 спроси вес»\n"
-                "- «в 09:00 по будням перекус»\n"
-                "- «в 21:30 спроси, как прошёл день и соблюдал ли калории»\n"
-                "- «каждые 3 дня попроси фото и замеры»\n\n"
-                "Чтобы отключить/изменить — просто напиши новое правило.",
-                reply_markup=main_menu_kb(),
-            )
-            return
-        if t in {BTN_PROGRESS}:
-            await message.answer(
-                "Пришли замеры текстом (пример: «талия 102, грудь 112, бедра 108»)\n"
-                "или фото прогресса с подписью «прогресс».",
-                reply_markup=main_menu_kb(),
-            )
-            return
-        if t in {BTN_WEIGHT}:
-            await message.answer("Напиши новый вес в кг (например: 82.5).", reply_markup=main_menu_kb())
-            return
-        if t in {BTN_PHOTO_HELP}:
-            await message.answer("Ок. Просто отправь фото блюда сюда — я разберу и посчитаю.", reply_markup=main_menu_kb())
-            return
-        if t in {BTN_LOG_MEAL}:
-            await message.answer("Напиши прием пищи одним сообщением, начиная с <code>еда:</code> (пример: «еда: гречка 200г, курица 150г, масло 10г»).", reply_markup=main_menu_kb())
-            return
 
         # Agent router (free-form commands)
-        user_text = (message.text or "").strip()
+        user_text = t_now
         # Chat-first: attempt plan edit without any dialog state
-        if await _handle_plan_edit_stateless(message, db=db, user=user):
+        if await _handle_plan_edit_stateless(message, db=db, user=user, text_norm=t_norm):
             return
         route = await _agent_route(user_text, user=user)
         action = (route or {}).get("action")
 
-        if action == "help":
-            await cmd_help(message)
-            return
-        if action == "show_profile":
-            await cmd_profile(message)
+        cmd = _ACTION_COMMANDS.get(action) if isinstance(action, str) else None
+        if cmd is not None:
+            await cmd(message)
             return
         if action == "update_weight" and (route or {}).get("weight_kg") is not None:
             w = float(route.get("weight_kg"))
@@ -3715,15 +4020,9 @@ async def any_text(message: Message) -> None:
                 f"Новая норма: <b>{t.calories} ккал</b>, БЖУ: <b>{t.protein_g}/{t.fat_g}/{t.carbs_g} г</b>"
             )
             return
-        if action == "plan_day":
-            await cmd_plan(message)
-            return
-        if action == "analyze_week":
-            await cmd_week(message)
-            return
         if action == "update_prefs":
             pref_repo = PreferenceRepo(db)
-            handled = await _apply_coach_memory_if_needed(message, pref_repo=pref_repo, user=user)
+            handled = await _apply_coach_memory_if_needed(message, pref_repo=pref_repo, user=user, text_norm=t_norm)
             if handled:
                 await db.commit()
                 return
@@ -3736,9 +4035,7 @@ async def any_text(message: Message) -> None:
                 return
         if action == "coach_chat":
             pref_repo = PreferenceRepo(db)
-            plan_repo = PlanRepo(db)
-            note_repo = CoachNoteRepo(db)
-            handled = await _handle_coach_chat(message, pref_repo=pref_repo, meal_repo=meal_repo, plan_repo=plan_repo, note_repo=note_repo, user=user)
+            handled = await _handle_coach_chat(message, pref_repo=pref_repo, user=user)
             if handled:
                 await db.commit()
                 return
@@ -3749,9 +4046,7 @@ async def any_text(message: Message) -> None:
 
         # Default: always answer as coach (ChatGPT-like).
         pref_repo = PreferenceRepo(db)
-        plan_repo = PlanRepo(db)
-        note_repo = CoachNoteRepo(db)
-        handled = await _handle_coach_chat(message, pref_repo=pref_repo, meal_repo=meal_repo, plan_repo=plan_repo, note_repo=note_repo, user=user)
+        handled = await _handle_coach_chat(message, pref_repo=pref_repo, user=user)
         if handled:
             await db.commit()
             return
@@ -3759,10 +4054,15 @@ async def any_text(message: Message) -> None:
 
 async def main() -> None:
     await init_db()
-    bot = Bot(settings.bot_token, default=DefaultBotProperties(parse_mode="HTML"))
+    # Telegram API payloads go through the same JSON codec as the rest of the bot
+    session = AiohttpSession(json_loads=loads, json_dumps=dumps)
+    bot = Bot(settings.bot_token, session=session, default=DefaultBotProperties(parse_mode="HTML"))
     dp = Dispatcher()
+    dp.include_router(commands_router)
     dp.include_router(router)
+    dp.shutdown.register(close_off_http)
     asyncio.create_task(_checkin_loop(bot))
+    asyncio.create_task(sqlite_incremental_vacuum_loop())
     await dp.start_polling(bot)
 
 
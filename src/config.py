@@ -23,14 +23,23 @@ class Settings(BaseSettings):
     openai_plan_timeout_s: int = Field(default=30, validation_alias="OPENAI_PLAN_TIMEOUT_S")
     # Hard timeout for OpenAI requests (seconds) to avoid "hangs"
     openai_timeout_s: int = Field(default=45, validation_alias="OPENAI_TIMEOUT_S")
+    # Max in-flight OpenAI requests per bot process; extra calls queue locally instead of hitting 429s
+    openai_max_concurrency: int = Field(default=32, validation_alias="OPENAI_MAX_CONCURRENCY")
 
     db_path: str = Field(default="data/botfit.sqlite3", validation_alias="DB_PATH")
     database_url: str | None = Field(default=None, validation_alias="DATABASE_URL")
+    # Async engine pool (per bot process): each Telegram update holds a session while it runs
+    db_pool_size: int = Field(default=20, validation_alias="DB_POOL_SIZE")
+    db_max_overflow: int = Field(default=40, validation_alias="DB_MAX_OVERFLOW")
+    db_pool_timeout_s: int = Field(default=30, validation_alias="DB_POOL_TIMEOUT_S")
+    db_pool_recycle_s: int = Field(default=3600, validation_alias="DB_POOL_RECYCLE_S")
 
     default_country: str = Field(default="CZ", validation_alias="DEFAULT_COUNTRY")
     default_stores: str = Field(default="Lidl,Kaufland,Albert", validation_alias="DEFAULT_STORES")
 
     ffmpeg_path: str | None = Field(default=None, validation_alias="FFMPEG_PATH")
+    # Max concurrent voice-note decodes (PyAV threads / ffmpeg child processes)
+    audio_workers: int = Field(default=2, validation_alias="AUDIO_WORKERS")
 
     off_base_url: str = Field(default="https://world.openfoodfacts.org", validation_alias="OFF_BASE_URL")
     off_country: str = Field(default="CZ", validation_alias="OFF_COUNTRY")
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import asyncio
+import logging
 import os
 from pathlib import Path
 
+from sqlalchemy import AsyncAdaptedQueuePool
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 
 from src.config import settings
@@ -14,22 +17,68 @@ def _ensure_db_dir(db_path: str) -> None:
         os.makedirs(p.parent, exist_ok=True)
 
 
+def _passthrough(value: str) -> str:
+    # JSON columns take and return already-serialized strings (src.jsonutil)
+    return value
+
+
+def _pool_kwargs() -> dict:
+    return {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout_s,
+        "pool_recycle": settings.db_pool_recycle_s,
+    }
+
+
 def make_engine() -> AsyncEngine:
     if settings.database_url:
         return create_async_engine(
             settings.database_url,
             future=True,
             echo=False,
+            json_serializer=_passthrough,
+            json_deserializer=_passthrough,
+            # network DB: drop connections that died behind a proxy/failover before handing them out
+            pool_pre_ping=True,
+            **_pool_kwargs(),
         )
 
     _ensure_db_dir(settings.db_path)
-    return create_async_engine(f"sqlite+aiosqlite:///{settings.db_path}", future=True, echo=False)
+    # aiosqlite defaults to NullPool (new connection + worker thread per session); keep them pooled.
+    # local file: no pre-ping, a connection can't go stale over the network
+    return create_async_engine(
+        f"sqlite+aiosqlite:///{settings.db_path}",
+        future=True,
+        echo=False,
+        poolclass=AsyncAdaptedQueuePool,
+        **_pool_kwargs(),
+    )
 
 
 engine: AsyncEngine = make_engine()
-SessionLocal: async_sessionmaker[AsyncSession] = async_sessionmaker(engine, expire_on_commit=False)
+SessionLocal: async_sessionmaker[AsyncSession] = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
 
 
 async def session() -> AsyncSession:
     return SessionLocal()
 
+
+async def sqlite_incremental_vacuum_loop(*, pages: int = 1000, interval_s: int = 3600) -> None:
+    """
+    Periodically returns free pages to the filesystem.
+    Works on databases created with auto_vacuum=INCREMENTAL (init_db / alembic set it).
+    Databases created before that stay auto_vacuum=NONE, and the pragma is a no-op on
+    them until a one-off manual VACUUM switches the mode.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            async with engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                # executescript steps the pragma to completion; execute() frees a single page
+                await raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        except Exception:
+            logging.getLogger(__name__).warning("incremental_vacuum failed", exc_info=True)
@@ -1,77 +1,130 @@
 from __future__ import annotations
 
+import asyncio
+import re
+import time
+from collections import OrderedDict
 from dataclasses import asdict
 from typing import Any
 
 from src.jsonutil import dumps, loads
 from src.openfoodfacts import FoodCandidate, get_by_barcode, make_search_url, search
+from src.models import Food
 from src.repositories import FoodRepo
 
 
+# in-process front cache for OFF search (barcodes are already cached in the foods table):
+# popular queries repeat across users, TTL keeps results reasonably fresh
+_SEARCH_TTL_S = 24 * 3600
+_SEARCH_CACHE_SIZE = 512
+_SEARCH_CACHE: OrderedDict[str, tuple[float, list[FoodCandidate]]] = OrderedDict()
+
+
+def _search_key(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def _search_cache_get(key: str) -> list[FoodCandidate] | None:
+    hit = _SEARCH_CACHE.get(key)
+    if hit is None:
+        return None
+    expires_at, cands = hit
+    if expires_at <= time.monotonic():
+        del _SEARCH_CACHE[key]
+        return None
+    _SEARCH_CACHE.move_to_end(key)
+    return list(cands)
+
+
+def _search_cache_put(key: str, cands: list[FoodCandidate]) -> None:
+    # empty results are not cached: they are usually an OFF hiccup, not a real miss
+    if not cands:
+        return
+    _SEARCH_CACHE[key] = (time.monotonic() + _SEARCH_TTL_S, list(cands))
+    _SEARCH_CACHE.move_to_end(key)
+    while len(_SEARCH_CACHE) > _SEARCH_CACHE_SIZE:
+        _SEARCH_CACHE.popitem(last=False)
+
+
+def _candidate_from_row(f: Food) -> FoodCandidate:
+    nutr = loads(f.nutriments_json) or {}
+    return FoodCandidate(
+        source=f.source,
+        barcode=f.barcode,
+        name=f.name,
+        brand=f.brand,
+        kcal_100g=nutr.get("kcal_100g"),
+        protein_100g=nutr.get("protein_100g"),
+        fat_100g=nutr.get("fat_100g"),
+        carbs_100g=nutr.get("carbs_100g"),
+        image_url=nutr.get("image_url"),
+        raw=nutr.get("raw") or {},
+    )
+
+
 class FoodService:
     def __init__(self, food_repo: FoodRepo):
         self.food_repo = food_repo
+        # lookups may run concurrently (asyncio.gather), but the repo's AsyncSession can't
+        self._db_lock = asyncio.Lock()
 
     async def resolve_by_barcode(self, barcode: str) -> FoodCandidate | None:
-        cached = await self.food_repo.get_by_barcode("openfoodfacts", barcode)
-        if cached:
-            nutr = loads(cached.nutriments_json) or {}
-            return FoodCandidate(
-                source=cached.source,
-                barcode=cached.barcode,
-                name=cached.name,
-                brand=cached.brand,
-                kcal_100g=nutr.get("kcal_100g"),
-                protein_100g=nutr.get("protein_100g"),
-                fat_100g=nutr.get("fat_100g"),
-                carbs_100g=nutr.get("carbs_100g"),
-                image_url=nutr.get("image_url"),
-                raw=nutr.get("raw") or {},
-            )
-
-        cand = await get_by_barcode(barcode)
-        if not cand:
-            return None
+        return (await self.resolve_many([barcode])).get(barcode)
 
+    async def resolve_many(self, barcodes: list[str]) -> dict[str, FoodCandidate]:
+        """
+        Batch barcode lookup: one `IN (...)` query for cached rows, OFF only for misses.
+        Duplicates are looked up once. Unknown barcodes are absent from the result.
+        """
+        wanted = list(dict.fromkeys(b for b in barcodes if b))
+        if not wanted:
+            return {}
+        async with self._db_lock:
+            rows = await self.food_repo.get_by_barcodes("openfoodfacts", wanted)
+        out = {bc: _candidate_from_row(f) for bc, f in rows.items()}
+
+        missing = [bc for bc in wanted if bc not in out]
+        if missing:
+            fetched = await asyncio.gather(*(get_by_barcode(bc) for bc in missing))
+            async with self._db_lock:
+                for bc, cand in zip(missing, fetched):
+                    if not cand:
+                        continue
+                    await self._store(cand)
+                    out[bc] = cand
+        return out
+
+    async def _store(self, c: FoodCandidate) -> None:
         await self.food_repo.upsert(
-            source=cand.source,
-            barcode=cand.barcode,
-            name=cand.name,
-            brand=cand.brand,
+            source=c.source,
+            barcode=c.barcode,
+            name=c.name,
+            brand=c.brand,
             nutriments_json=dumps(
                 {
-                    "kcal_100g": cand.kcal_100g,
-                    "protein_100g": cand.protein_100g,
-                    "fat_100g": cand.fat_100g,
-                    "carbs_100g": cand.carbs_100g,
-                    "image_url": cand.image_url,
-                    "raw": cand.raw,
+                    "kcal_100g": c.kcal_100g,
+                    "protein_100g": c.protein_100g,
+                    "fat_100g": c.fat_100g,
+                    "carbs_100g": c.carbs_100g,
+                    "image_url": c.image_url,
+                    "raw": c.raw,
                 }
             ),
         )
-        return cand
 
     async def search(self, query: str) -> list[FoodCandidate]:
+        key = _search_key(query)
+        cached = _search_cache_get(key)
+        if cached is not None:
+            return cached
+
         cands = await search(query)
         # cache best-effort by barcode
-        for c in cands:
-            if c.barcode:
-                await self.food_repo.upsert(
-                    source=c.source,
-                    barcode=c.barcode,
-                    name=c.name,
-                    brand=c.brand,
-                    nutriments_json=dumps(
-                        {
-                            "kcal_100g": c.kcal_100g,
-                            "protein_100g": c.protein_100g,
-                            "fat_100g": c.fat_100g,
-                            "carbs_100g": c.carbs_100g,
-                            "image_url": c.image_url,
-                            "raw": c.raw,
-                        }
-                    ),
-                )
+        async with self._db_lock:
+            for c in cands:
+                if c.barcode:
+                    await self._store(c)
+        _search_cache_put(key, cands)
         return cands
 
     async def best_image_url(self, query: str) -> str:
@@ -125,8 +178,12 @@ class FoodService:
         }
 
 
+# same set as the old per-char check: а..я / А..Я plus ё/Ё
+_CYR_RE = re.compile(r"[А-Яа-яЁё]")
+
+
 def _has_cyrillic(s: str) -> bool:
-    return any("а" <= ch.lower() <= "я" or ch.lower() == "ё" for ch in s)
+    return _CYR_RE.search(s) is not None
 
 
 def _translit_ru(s: str) -> str:
@@ -172,7 +229,7 @@ def make_store_search_url(store: str, query: str) -> str:
 def compute_item_macros(*, grams: float, cand: FoodCandidate) -> dict[str, Any] | None:
     if grams <= 0:
         return None
-    if cand.kcal_100g is None or cand.protein_100g is None or cand.fat_100g is None or cand.carbs_100g is None:
+    if not cand.has_macros:
         return None
     factor = grams / 100.0
     return {
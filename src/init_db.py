@@ -1,15 +1,37 @@
 from __future__ import annotations
 
 from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
 
 from src.db import engine
 from src.models import Base
 
 
+async def _ensure_unique_food_barcodes(conn: AsyncConnection) -> None:
+    # create_all never touches an existing index: databases created before alembic 0009 keep the
+    # non-unique (source, barcode) index that FoodRepo.upsert's ON CONFLICT can't target
+    res = await conn.execute(text("PRAGMA index_list(foods)"))
+    if any(row[1] == "ix_foods_source_barcode" and row[2] for row in res):
+        return
+    # same dedupe as 0009: keep the most recently cached row per (source, barcode)
+    await conn.execute(
+        text(
+            "DELETE FROM foods WHERE barcode IS NOT NULL AND id NOT IN "
+            "(SELECT MAX(id) FROM foods WHERE barcode IS NOT NULL GROUP BY source, barcode)"
+        )
+    )
+    await conn.execute(text("DROP INDEX IF EXISTS ix_foods_source_barcode"))
+    await conn.execute(text("CREATE UNIQUE INDEX ix_foods_source_barcode ON foods (source, barcode)"))
+
+
 async def init_db() -> None:
     async with engine.begin() as conn:
+        # only takes effect on a fresh (empty) database, so it must precede create_all
+        await conn.execute(text("PRAGMA auto_vacuum=INCREMENTAL;"))
         await conn.run_sync(Base.metadata.create_all)
         # Pragmas for better concurrency/durability on SQLite
         await conn.execute(text("PRAGMA journal_mode=WAL;"))
         await conn.execute(text("PRAGMA synchronous=NORMAL;"))
-
+    # own transaction: the dedupe DELETE opens one, and the pragmas above can't run inside it
+    async with engine.begin() as conn:
+        await _ensure_unique_food_barcodes(conn)
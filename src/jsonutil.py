@@ -4,13 +4,20 @@ from typing import Any
 
 import json
 
+import orjson
+
 
 def dumps(obj: Any) -> str:
-    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+    # orjson output is already compact UTF-8 (== ensure_ascii=False, separators=(",", ":"));
+    # non-str dict keys are stringified like the stdlib encoder does
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
 
 
 def loads(s: str | None) -> Any:
     if not s:
         return None
-    return json.loads(s)
-
+    try:
+        return orjson.loads(s)
+    except orjson.JSONDecodeError:
+        # rows written by the old stdlib encoder may contain NaN/Infinity, which orjson rejects
+        return json.loads(s)
@@ -3,7 +3,8 @@ from __future__ import annotations
 import datetime as dt
 from typing import Any
 
-from sqlalchemy import Boolean, Date, DateTime, Float, ForeignKey, Index, Integer, String, Text
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Float, ForeignKey, Index, Integer, SmallInteger, String, Text, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -11,11 +12,16 @@ class Base(DeclarativeBase):
     pass
 
 
+# JSON documents are stored as strings (src.jsonutil); the column is JSONB on Postgres,
+# strings pass through the driver as-is (see json_serializer in src.db)
+JSONDoc = Text().with_variant(JSONB(none_as_null=True), "postgresql")
+
+
 class User(Base):
     __tablename__ = "users"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    telegram_id: Mapped[int] = mapped_column(Integer, unique=True, index=True)
+    telegram_id: Mapped[int] = mapped_column(BigInteger, unique=True, index=True)
     username: Mapped[str | None] = mapped_column(String(64), nullable=True)
 
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=lambda: dt.datetime.now(dt.timezone.utc).replace(tzinfo=None))
@@ -35,10 +41,12 @@ class User(Base):
     activity_level: Mapped[str | None] = mapped_column(String(16), nullable=True)  # low/medium/high
     goal: Mapped[str | None] = mapped_column(String(16), nullable=True)  # loss/maintain/gain
 
-    allergies: Mapped[str | None] = mapped_column(Text, nullable=True)
-    restrictions: Mapped[str | None] = mapped_column(Text, nullable=True)
-    favorite_products: Mapped[str | None] = mapped_column(Text, nullable=True)
-    disliked_products: Mapped[str | None] = mapped_column(Text, nullable=True)
+    # long texts only feed LLM prompts: loaded on request (UserRepo.get_or_create(food_prefs=True));
+    # raiseload turns a missed flag into an error instead of an implicit lazy load
+    allergies: Mapped[str | None] = mapped_column(Text, nullable=True, deferred=True, deferred_group="food_prefs", deferred_raiseload=True)
+    restrictions: Mapped[str | None] = mapped_column(Text, nullable=True, deferred=True, deferred_group="food_prefs", deferred_raiseload=True)
+    favorite_products: Mapped[str | None] = mapped_column(Text, nullable=True, deferred=True, deferred_group="food_prefs", deferred_raiseload=True)
+    disliked_products: Mapped[str | None] = mapped_column(Text, nullable=True, deferred=True, deferred_group="food_prefs", deferred_raiseload=True)
 
     country: Mapped[str] = mapped_column(String(8), default="CZ")
     stores_csv: Mapped[str] = mapped_column(String(256), default="Lidl,Kaufland,Albert")
@@ -52,7 +60,7 @@ class User(Base):
     # простая “память” диалога (анкета/уточнение фото и т.п.)
     dialog_state: Mapped[str | None] = mapped_column(String(64), nullable=True)
     dialog_step: Mapped[int | None] = mapped_column(Integer, nullable=True)
-    dialog_data_json: Mapped[str | None] = mapped_column(Text, nullable=True)
+    dialog_data_json: Mapped[str | None] = mapped_column(JSONDoc, nullable=True)
 
     meals: Mapped[list["Meal"]] = relationship(back_populates="user")
     preferences: Mapped["Preference"] = relationship(back_populates="user", uselist=False)
@@ -65,7 +73,7 @@ class Preference(Base):
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), unique=True, index=True)
 
     # расширяемые настройки (храним JSON строкой, чтобы не ограничивать)
-    json: Mapped[str | None] = mapped_column(Text, nullable=True)
+    json: Mapped[str | None] = mapped_column(JSONDoc, nullable=True)
 
     user: Mapped[User] = relationship(back_populates="preferences")
 
@@ -74,7 +82,7 @@ class Meal(Base):
     __tablename__ = "meals"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
 
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=lambda: dt.datetime.now(dt.timezone.utc).replace(tzinfo=None))
     eaten_at: Mapped[dt.datetime | None] = mapped_column(DateTime, nullable=True)
@@ -83,14 +91,14 @@ class Meal(Base):
     description_raw: Mapped[str | None] = mapped_column(Text, nullable=True)
 
     # структура приема пищи (items + totals), хранится JSON-строкой
-    meal_json: Mapped[str | None] = mapped_column(Text, nullable=True)
+    meal_json: Mapped[str | None] = mapped_column(JSONDoc, nullable=True)
 
     photo_file_id: Mapped[str | None] = mapped_column(String(256), nullable=True)
 
     calories: Mapped[int | None] = mapped_column(Integer, nullable=True)
-    protein_g: Mapped[int | None] = mapped_column(Integer, nullable=True)
-    fat_g: Mapped[int | None] = mapped_column(Integer, nullable=True)
-    carbs_g: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    protein_g: Mapped[int | None] = mapped_column(SmallInteger, nullable=True)
+    fat_g: Mapped[int | None] = mapped_column(SmallInteger, nullable=True)
+    carbs_g: Mapped[int | None] = mapped_column(SmallInteger, nullable=True)
     total_weight_g: Mapped[int | None] = mapped_column(Integer, nullable=True)
 
     user: Mapped[User] = relationship(back_populates="meals")
@@ -100,7 +108,7 @@ class Stat(Base):
     __tablename__ = "stats"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
 
     week_start: Mapped[dt.date] = mapped_column(Date, index=True)
     week_end: Mapped[dt.date] = mapped_column(Date, index=True)
@@ -117,27 +125,27 @@ class Plan(Base):
     __tablename__ = "plans"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
 
     date: Mapped[dt.date] = mapped_column(Date, index=True)
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=lambda: dt.datetime.now(dt.timezone.utc).replace(tzinfo=None))
 
     calories_target: Mapped[int | None] = mapped_column(Integer, nullable=True)
-    plan_json: Mapped[str | None] = mapped_column(Text, nullable=True)
+    plan_json: Mapped[str | None] = mapped_column(JSONDoc, nullable=True)
 
 
 class CoachNote(Base):
     __tablename__ = "coach_notes"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
 
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=lambda: dt.datetime.now(dt.timezone.utc).replace(tzinfo=None))
 
     kind: Mapped[str] = mapped_column(String(32), default="note")  # profile_set/weekly_review/prefs_update/weight_update/goal_change/...
     title: Mapped[str | None] = mapped_column(String(128), nullable=True)
 
-    note_json: Mapped[str | None] = mapped_column(Text, nullable=True)
+    note_json: Mapped[str | None] = mapped_column(JSONDoc, nullable=True)
     note_text: Mapped[str | None] = mapped_column(Text, nullable=True)
 
 
@@ -145,7 +153,7 @@ class Goal(Base):
     __tablename__ = "goals"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
 
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=lambda: dt.datetime.now(dt.timezone.utc).replace(tzinfo=None))
     active: Mapped[bool] = mapped_column(Boolean, default=True)
@@ -158,22 +166,23 @@ class Goal(Base):
 
 class WeightLog(Base):
     __tablename__ = "weight_logs"
+    # one row per user per day: keyed by (user_id, date), rows clustered by user
+    __table_args__ = {"sqlite_with_rowid": False}
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
 
-    date: Mapped[dt.date] = mapped_column(Date, index=True)
+    date: Mapped[dt.date] = mapped_column(Date, primary_key=True, index=True)
     weight_kg: Mapped[float] = mapped_column(Float)
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=lambda: dt.datetime.now(dt.timezone.utc).replace(tzinfo=None))
 
 
 class DailyCheckin(Base):
     __tablename__ = "daily_checkins"
+    __table_args__ = {"sqlite_with_rowid": False}
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
 
-    date: Mapped[dt.date] = mapped_column(Date, index=True)
+    date: Mapped[dt.date] = mapped_column(Date, primary_key=True, index=True)
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=lambda: dt.datetime.now(dt.timezone.utc).replace(tzinfo=None))
 
     # structured
@@ -185,7 +194,7 @@ class DailyCheckin(Base):
     alcohol: Mapped[bool | None] = mapped_column(Boolean, nullable=True)
 
     note_text: Mapped[str | None] = mapped_column(Text, nullable=True)
-    raw_json: Mapped[str | None] = mapped_column(Text, nullable=True)
+    raw_json: Mapped[str | None] = mapped_column(JSONDoc, nullable=True)
 
 
 class Food(Base):
@@ -198,13 +207,13 @@ class Food(Base):
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     source: Mapped[str] = mapped_column(String(32), default="openfoodfacts")  # openfoodfacts/manual
-    barcode: Mapped[str | None] = mapped_column(String(32), nullable=True, index=True)
+    barcode: Mapped[str | None] = mapped_column(String(32), nullable=True)
 
     name: Mapped[str] = mapped_column(String(256))
     brand: Mapped[str | None] = mapped_column(String(256), nullable=True)
 
     # nutriments per 100g (JSON)
-    nutriments_json: Mapped[str] = mapped_column(Text)
+    nutriments_json: Mapped[str] = mapped_column(JSONDoc)
 
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, default=lambda: dt.datetime.now(dt.timezone.utc).replace(tzinfo=None))
     updated_at: Mapped[dt.datetime] = mapped_column(
@@ -214,10 +223,13 @@ class Food(Base):
     )
 
 
+# user_id lookups are served by the left prefix of these composites
 Index("ix_meals_user_created", Meal.user_id, Meal.created_at)
-Index("ix_foods_source_barcode", Food.source, Food.barcode)
+Index("ix_stats_user_week", Stat.user_id, Stat.week_start)
+Index("ix_plans_user_date", Plan.user_id, Plan.date)
+Index("ix_foods_source_barcode", Food.source, Food.barcode, unique=True)
 Index("ix_coach_notes_user_created", CoachNote.user_id, CoachNote.created_at)
 Index("ix_goals_user_created", Goal.user_id, Goal.created_at)
-Index("ix_weight_logs_user_date", WeightLog.user_id, WeightLog.date)
-Index("ix_daily_checkins_user_date", DailyCheckin.user_id, DailyCheckin.date)
+# GoalRepo.get_active: only the active goal is ever looked up by user
+Index("ix_goals_user_active", Goal.user_id, sqlite_where=text("active = 1"), postgresql_where=text("active"))
 
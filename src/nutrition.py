@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Literal
 
 
@@ -45,6 +46,12 @@ def tdee(bmr: float, activity: ActivityLevel) -> float:
     return bmr * _activity_multiplier(activity)
 
 
+def compute_tdee(sex: Sex, age: int, height_cm: float, weight_kg: float, activity: ActivityLevel) -> int:
+    # maintenance kcal only (same rounding as CalcMeta.tdee_kcal); independent of goal/tempo
+    b = bmr_mifflin_st_jeor(sex=sex, age=age, height_cm=height_cm, weight_kg=weight_kg)
+    return int(round(tdee(b, activity=activity)))
+
+
 def default_deficit_pct(goal: Goal) -> float:
     # positive = deficit, negative = surplus
     if goal == "loss":
@@ -110,6 +117,8 @@ def compute_targets(
     return t
 
 
+# pure function of scalar inputs returning frozen dataclasses: safe to share cached results
+@lru_cache(maxsize=4096)
 def compute_targets_with_meta(
     *,
     sex: Sex,
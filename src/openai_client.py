@@ -2,15 +2,44 @@ from __future__ import annotations
 
 import asyncio
 import base64
-import json
-from typing import Any
+from typing import Any, Coroutine, TypeVar
 
-from openai import AsyncOpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
 from src.config import settings
+from src.jsonutil import loads
 
 
-client = AsyncOpenAI(api_key=settings.openai_api_key)
+T = TypeVar("T")
+
+_MAX_CONCURRENCY = max(1, settings.openai_max_concurrency)
+# connection pool sized to the semaphore so both layers agree on the cap
+client = AsyncOpenAI(
+    api_key=settings.openai_api_key,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=_MAX_CONCURRENCY, max_keepalive_connections=_MAX_CONCURRENCY),
+    ),
+)
+_API_SLOTS = asyncio.Semaphore(_MAX_CONCURRENCY)
+
+
+async def _bounded(aw: Coroutine[Any, Any, T], timeout_s: float | None = None) -> T:
+    """
+    Await one API request under the process-wide concurrency cap.
+    Time spent waiting for a slot does not count towards timeout_s.
+    """
+    try:
+        await _API_SLOTS.acquire()
+    except BaseException:
+        aw.close()  # never started
+        raise
+    try:
+        if timeout_s is None:
+            return await aw
+        return await asyncio.wait_for(aw, timeout=timeout_s)
+    finally:
+        _API_SLOTS.release()
 
 
 def _is_unsupported_param_error(e: Exception, param: str) -> bool:
@@ -37,7 +66,7 @@ def _fmt_exc(e: Exception | None) -> str:
 def _try_parse_json(text: str) -> dict[str, Any] | None:
     t = text.strip()
     try:
-        obj = json.loads(t)
+        obj = loads(t)
         return obj if isinstance(obj, dict) else None
     except Exception:
         pass
@@ -47,7 +76,7 @@ def _try_parse_json(text: str) -> dict[str, Any] | None:
     end = t.rfind("}")
     if start != -1 and end != -1 and end > start:
         try:
-            obj = json.loads(t[start : end + 1])
+            obj = loads(t[start : end + 1])
             return obj if isinstance(obj, dict) else None
         except Exception:
             return None
@@ -103,22 +132,22 @@ async def _chat_create(
         kwargs: dict[str, Any] = {"max_completion_tokens": max_output_tokens}
         if response_format is not None:
             kwargs["response_format"] = response_format
-        cc = await asyncio.wait_for(
+        cc = await _bounded(
             client.chat.completions.create(model=model, messages=messages, **kwargs),
-            timeout=timeout_s,
+            timeout_s,
         )
         return _extract_text_or_raise(cc)
     except Exception as e:
         last_err = e
         if response_format is not None and _is_unsupported_param_error(e, "response_format"):
             try:
-                cc = await asyncio.wait_for(
+                cc = await _bounded(
                     client.chat.completions.create(
                         model=model,
                         messages=messages,
                         max_completion_tokens=max_output_tokens,
                     ),
-                    timeout=timeout_s,
+                    timeout_s,
                 )
                 return _extract_text_or_raise(cc)
             except Exception as e2:
@@ -132,21 +161,21 @@ async def _chat_create(
         kwargs2: dict[str, Any] = {"max_tokens": max_output_tokens}
         if response_format is not None:
             kwargs2["response_format"] = response_format
-        cc = await asyncio.wait_for(
+        cc = await _bounded(
             client.chat.completions.create(model=model, messages=messages, **kwargs2),
-            timeout=timeout_s,
+            timeout_s,
         )
         return _extract_text_or_raise(cc)
     except Exception as e:
         last_err = e
         if response_format is not None and _is_unsupported_param_error(e, "response_format"):
-            cc = await asyncio.wait_for(
+            cc = await _bounded(
                 client.chat.completions.create(
                     model=model,
                     messages=messages,
                     max_tokens=max_output_tokens,
                 ),
-                timeout=timeout_s,
+                timeout_s,
             )
             return _extract_text_or_raise(cc)
         raise RuntimeError(f"Chat completion failed. Last error: {_fmt_exc(last_err)}")
@@ -177,9 +206,9 @@ async def _responses_create_text(
     if enforce_json:
         # 1) Preferred: text.format json_object (newer SDKs)
         try:
-            resp = await asyncio.wait_for(
+            resp = await _bounded(
                 client.responses.create(**base_kwargs, text={"format": {"type": "json_object"}}),  # type: ignore[arg-type]
-                timeout=timeout_s,
+                timeout_s,
             )
             return (getattr(resp, "output_text", None) or "").strip()
         except Exception as e:
@@ -187,9 +216,9 @@ async def _responses_create_text(
             # fall through for compatibility attempts
         # 2) Compatibility: response_format json_object (some SDKs)
         try:
-            resp = await asyncio.wait_for(
+            resp = await _bounded(
                 client.responses.create(**base_kwargs, response_format={"type": "json_object"}),  # type: ignore[arg-type]
-                timeout=timeout_s,
+                timeout_s,
             )
             return (getattr(resp, "output_text", None) or "").strip()
         except Exception as e:
@@ -197,7 +226,7 @@ async def _responses_create_text(
             # 3) Last resort: no structured mode (we'll still parse+retry)
 
     try:
-        resp = await asyncio.wait_for(client.responses.create(**base_kwargs), timeout=timeout_s)
+        resp = await _bounded(client.responses.create(**base_kwargs), timeout_s)
         return (getattr(resp, "output_text", None) or "").strip()
     except Exception as e:
         raise RuntimeError(f"Responses create failed. Last error: {_fmt_exc(last_err or e)}")
@@ -345,7 +374,7 @@ async def vision_json(
 
     text = ""
     if _has_responses_api():
-        resp = await asyncio.wait_for(
+        resp = await _bounded(
             client.responses.create(
                 model=m,
                 input=[
@@ -360,7 +389,7 @@ async def vision_json(
                 ],
                 max_output_tokens=max_output_tokens,
             ),
-            timeout=timeout_s,
+            timeout_s,
         )
         text = (getattr(resp, "output_text", None) or "").strip()
     else:
@@ -426,9 +455,11 @@ async def transcribe_audio(*, audio_bytes: bytes, filename: str = "audio.ogg") -
 
     bio = BytesIO(audio_bytes)
     bio.name = filename  # some clients rely on name
-    tr = await client.audio.transcriptions.create(
-        model=settings.openai_transcribe_model,
-        file=bio,
+    tr = await _bounded(
+        client.audio.transcriptions.create(
+            model=settings.openai_transcribe_model,
+            file=bio,
+        )
     )
     # openai-python returns object with `.text`
     return getattr(tr, "text", "") or ""
@@ -8,6 +8,25 @@ import aiohttp
 from src.config import settings
 
 
+# one pooled session per process: concurrent lookups share keep-alive sockets to OFF
+_MAX_CONNECTIONS = 10
+_session: aiohttp.ClientSession | None = None
+
+
+def _http() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=_MAX_CONNECTIONS))
+    return _session
+
+
+async def close_http() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
 @dataclass(frozen=True)
 class FoodCandidate:
     source: str
@@ -21,6 +40,10 @@ class FoodCandidate:
     image_url: str | None
     raw: dict[str, Any]
 
+    @property
+    def has_macros(self) -> bool:
+        return not (self.kcal_100g is None or self.protein_100g is None or self.fat_100g is None or self.carbs_100g is None)
+
 
 def _f(x: Any) -> float | None:
     try:
@@ -45,11 +68,10 @@ async def get_by_barcode(barcode: str) -> FoodCandidate | None:
     url = f"{base}/api/v2/product/{barcode}.json"
     params = {"fields": "code,product_name,brands,nutriments,image_front_url,image_url"}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=12)) as resp:
-            if resp.status != 200:
-                return None
-            data = await resp.json()
+    async with _http().get(url, params=params, timeout=aiohttp.ClientTimeout(total=12)) as resp:
+        if resp.status != 200:
+            return None
+        data = await resp.json()
     if data.get("status") != 1:
         return None
     prod = data.get("product") or {}
@@ -83,11 +105,10 @@ async def search(query: str, *, page_size: int | None = None) -> list[FoodCandid
         "cc": settings.off_country.lower(),
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=12)) as resp:
-            if resp.status != 200:
-                return []
-            data = await resp.json()
+    async with _http().get(url, params=params, timeout=aiohttp.ClientTimeout(total=12)) as resp:
+        if resp.status != 200:
+            return []
+        data = await resp.json()
 
     out: list[FoodCandidate] = []
     for prod in (data.get("products") or [])[:ps]:
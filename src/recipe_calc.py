@@ -15,6 +15,12 @@ class IngredientRow:
 
 
 _NUM = r"(\d+(?:[.,]\d+)?)"
+# compiled once: parse_ingredient_line runs them for every line of a recipe block
+_GRAMS_RE = re.compile(rf"{_NUM}\s*(?:г|g)\b", re.IGNORECASE)
+_KCAL_RE = re.compile(rf"{_NUM}\s*(?:ккал|kcal)\b", re.IGNORECASE)
+_PROTEIN_RE = re.compile(rf"(?:\bб|\bprotein)\s*[:=]?\s*{_NUM}", re.IGNORECASE)
+_FAT_RE = re.compile(rf"(?:\bж|\bfat)\s*[:=]?\s*{_NUM}", re.IGNORECASE)
+_CARBS_RE = re.compile(rf"(?:\bу|\bcarb|\bcarbs)\s*[:=]?\s*{_NUM}", re.IGNORECASE)
 
 
 def _f(x: str) -> float:
@@ -27,21 +33,21 @@ def parse_ingredient_line(line: str) -> IngredientRow | None:
         return None
 
     # grams: prefer "... 200г" or "... 200 g"
-    mg = re.search(rf"{_NUM}\s*(?:г|g)\b", s, flags=re.IGNORECASE)
+    mg = _GRAMS_RE.search(s)
     if not mg:
         return None
     grams = int(round(_f(mg.group(1))))
 
     # calories: "... 250ккал" / "250 kcal"
-    mk = re.search(rf"{_NUM}\s*(?:ккал|kcal)\b", s, flags=re.IGNORECASE)
+    mk = _KCAL_RE.search(s)
     if not mk:
         return None
     calories = _f(mk.group(1))
 
     # macros: Б/Ж/У
-    mp = re.search(rf"(?:\bб|\bprotein)\s*[:=]?\s*{_NUM}", s, flags=re.IGNORECASE)
-    mf = re.search(rf"(?:\bж|\bfat)\s*[:=]?\s*{_NUM}", s, flags=re.IGNORECASE)
-    mc = re.search(rf"(?:\bу|\bcarb|\bcarbs)\s*[:=]?\s*{_NUM}", s, flags=re.IGNORECASE)
+    mp = _PROTEIN_RE.search(s)
+    mf = _FAT_RE.search(s)
+    mc = _CARBS_RE.search(s)
     if not (mp and mf and mc):
         return None
 
@@ -74,11 +80,15 @@ def parse_ingredients_block(text: str) -> list[IngredientRow]:
 
 
 def compute_totals(rows: list[IngredientRow]) -> dict:
-    total_weight = sum(r.grams for r in rows)
-    total_kcal = sum(r.calories for r in rows)
-    total_p = sum(r.protein_g for r in rows)
-    total_f = sum(r.fat_g for r in rows)
-    total_c = sum(r.carbs_g for r in rows)
+    # one pass over the rows instead of five generator sums
+    total_weight = 0
+    total_kcal = total_p = total_f = total_c = 0
+    for r in rows:
+        total_weight += r.grams
+        total_kcal += r.calories
+        total_p += r.protein_g
+        total_f += r.fat_g
+        total_c += r.carbs_g
 
     per100 = None
     if total_weight > 0:
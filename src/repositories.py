@@ -1,43 +1,179 @@
 from __future__ import annotations
 
 import datetime as dt
+import time
 from typing import Any
 
-from sqlalchemy import Select, select
+from sqlalchemy import Select, Text, bindparam, cast, event, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, undefer_group
+from sqlalchemy.orm.attributes import set_committed_value
 
 from src.jsonutil import dumps, loads
 from src.models import CoachNote, DailyCheckin, Food, Goal, Meal, Plan, Preference, Stat, User, WeightLog
 
 
+# hot-path statements built once; values go in as bound params so the compiled-SQL cache key never changes
+_USER_BY_TG: Select[tuple[User]] = select(User).where(User.telegram_id == bindparam("tg"))
+_USER_BY_TG_FOOD_PREFS: Select[tuple[User]] = _USER_BY_TG.options(undefer_group("food_prefs"))
+_USER_WITH_PREFS_BY_TG = (
+    select(User, Preference.json)
+    .outerjoin(Preference, Preference.user_id == User.id)
+    .where(User.telegram_id == bindparam("tg"))
+)
+_PREF_BY_USER: Select[tuple[Preference]] = select(Preference).where(Preference.user_id == bindparam("uid"))
+# preference keys that make _checkin_loop do anything for a user
+_SCHEDULE_PREF_KEYS = ("checkin_every_days", "weight_prompt_enabled", "reminders", "daily_checkin_enabled")
+# key-presence LIKE works on the TEXT (sqlite) and JSONB (postgres) variants alike; it's a superset,
+# the loop still checks the actual values
+_SCHEDULED_USERS = (
+    select(User.id, User.telegram_id, Preference.json)
+    .join(Preference, Preference.user_id == User.id)
+    .where(User.profile_complete == True)  # noqa: E712
+    .where(or_(*(cast(Preference.json, Text).like(f'%"{k}"%') for k in _SCHEDULE_PREF_KEYS)))
+)
+# user_id -> (raw json, decoded) from the previous checkin tick: prefs rarely change between minutes
+_scheduled_prefs_memo: dict[int, tuple[str, dict[str, Any]]] = {}
+# list_scheduled result, reused until a committed prefs/profile_complete write (or the TTL for
+# writes that bypass the repos); the generation guards against caching a query that raced a commit
+_SCHEDULED_TTL_S = 600.0
+# plain (user_id, telegram_id, prefs) rows: no ORM instances outlive the session that loaded them
+_scheduled_cache: tuple[float, list[tuple[int, int, dict[str, Any]]]] | None = None
+_scheduled_gen = 0
+# INSERT .. ON CONFLICT builders for the dialects the bot runs on
+_DIALECT_INSERT = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+
+def _touch_schedule(db: AsyncSession) -> None:
+    db.info["schedule_dirty"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _drop_scheduled_cache(session: Session) -> None:
+    global _scheduled_cache, _scheduled_gen
+    if session.info.pop("schedule_dirty", False):
+        _scheduled_cache = None
+        _scheduled_gen += 1
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_session_caches(session: Session) -> None:
+    session.info.pop("schedule_dirty", None)
+    # rolled-back rows are expired/transient; they'd need a reload, which async can't do lazily
+    session.info.pop("pref_rows", None)
+
+
+def _session_prefs(db: AsyncSession) -> dict[int, Preference]:
+    # user_id -> Preference row already loaded in this session (one session == one update)
+    return db.info.setdefault("pref_rows", {})
+
+
 class UserRepo:
     def __init__(self, db: AsyncSession):
         self.db = db
 
-    async def get_or_create(self, telegram_id: int, username: str | None) -> User:
-        q: Select[tuple[User]] = select(User).where(User.telegram_id == telegram_id)
-        res = await self.db.execute(q)
+    async def get_or_create(self, telegram_id: int, username: str | None, *, food_prefs: bool = False) -> User:
+        """
+        food_prefs=True also loads the deferred allergies/restrictions/favorite/disliked texts;
+        pass it from handlers that build LLM prompts (async sessions can't lazy-load them later).
+        """
+        q = _USER_BY_TG_FOOD_PREFS if food_prefs else _USER_BY_TG
+        res = await self.db.execute(q, {"tg": telegram_id})
         u = res.scalar_one_or_none()
         if u:
             if username and u.username != username:
                 u.username = username
             return u
-        u = User(telegram_id=telegram_id, username=username)
+        # deferred texts set explicitly so a fresh row never needs a lazy load
+        u = User(
+            telegram_id=telegram_id,
+            username=username,
+            allergies=None,
+            restrictions=None,
+            favorite_products=None,
+            disliked_products=None,
+        )
         self.db.add(u)
         await self.db.flush()
 
         pref = Preference(user_id=u.id, json=dumps({}))
         self.db.add(pref)
         await self.db.flush()
+        _session_prefs(self.db)[u.id] = pref
         return u
 
+    async def get_with_prefs(self, telegram_id: int, username: str | None) -> tuple[User, dict[str, Any]]:
+        """
+        User + preferences JSON in one query for existing users (falls back to get_or_create).
+        """
+        row = (await self.db.execute(_USER_WITH_PREFS_BY_TG, {"tg": telegram_id})).first()
+        if row is None:
+            return await self.get_or_create(telegram_id, username), {}
+        u, raw = row
+        if username and u.username != username:
+            u.username = username
+        obj = loads(raw) if raw else {}
+        return u, obj if isinstance(obj, dict) else {}
+
+    async def update_profile(self, user: User, values: dict[str, Any]) -> None:
+        """
+        Write many profile columns as one Core UPDATE (no per-attribute ORM bookkeeping),
+        then mirror the values onto `user` without marking it dirty.
+        """
+        stmt = update(User).where(User.id == user.id).values(**values).execution_options(synchronize_session=False)
+        await self.db.execute(stmt)
+        for key, value in values.items():
+            set_committed_value(user, key, value)
+        if "profile_complete" in values:
+            _touch_schedule(self.db)
+
     async def set_dialog(self, user: User, state: str | None, step: int | None, data: Any | None) -> None:
         user.dialog_state = state
         user.dialog_step = step
         user.dialog_data_json = dumps(data) if data is not None else None
+        user.__dict__.pop("_dialog_data_memo", None)
+
+    async def list_scheduled(self) -> list[tuple[int, int, dict[str, Any]]]:
+        """
+        (user_id, telegram_id, decoded prefs) for profile-complete users whose preferences
+        mention any checkin/reminder setting.
+        """
+        global _scheduled_prefs_memo, _scheduled_cache
+        now = time.monotonic()
+        if _scheduled_cache is not None and now - _scheduled_cache[0] < _SCHEDULED_TTL_S:
+            return _scheduled_cache[1]
+        gen = _scheduled_gen
+        res = await self.db.execute(_SCHEDULED_USERS)
+        out: list[tuple[int, int, dict[str, Any]]] = []
+        memo: dict[int, tuple[str, dict[str, Any]]] = {}
+        for user_id, telegram_id, raw in res:
+            prev = _scheduled_prefs_memo.get(user_id)
+            if prev is not None and prev[0] == raw:
+                obj = prev[1]
+            else:
+                obj = loads(raw) if raw else {}
+                obj = obj if isinstance(obj, dict) else {}
+            memo[user_id] = (raw, obj)
+            out.append((user_id, telegram_id, obj))
+        # rebuilt on every query, so users that dropped out of the schedule don't linger
+        _scheduled_prefs_memo = memo
+        if gen == _scheduled_gen:
+            _scheduled_cache = (now, out)
+        return out
 
     async def get_dialog_data(self, user: User) -> Any:
-        return loads(user.dialog_data_json)
+        """
+        Decoded dialog_data_json, memoized on the instance until the column changes:
+        several handlers may probe the dialog for one update, the blob is decoded once.
+        The result is shared: treat it as read-only and copy before changing anything.
+        """
+        raw = user.dialog_data_json
+        memo = user.__dict__.get("_dialog_data_memo")
+        if memo is None or memo[0] is not raw:
+            memo = (raw, loads(raw))
+            user.__dict__["_dialog_data_memo"] = memo
+        return memo[1]
 
 
 class PreferenceRepo:
@@ -45,28 +181,42 @@ class PreferenceRepo:
         self.db = db
 
     async def get(self, user_id: int) -> Preference:
-        q: Select[tuple[Preference]] = select(Preference).where(Preference.user_id == user_id)
-        res = await self.db.execute(q)
-        pref = res.scalar_one_or_none()
-        if pref:
+        """The user's Preference row; looked up once per session, later calls reuse it."""
+        rows = _session_prefs(self.db)
+        pref = rows.get(user_id)
+        if pref is not None:
             return pref
-        pref = Preference(user_id=user_id, json=dumps({}))
-        self.db.add(pref)
-        await self.db.flush()
+        res = await self.db.execute(_PREF_BY_USER, {"uid": user_id})
+        pref = res.scalar_one_or_none()
+        if not pref:
+            pref = Preference(user_id=user_id, json=dumps({}))
+            self.db.add(pref)
+            await self.db.flush()
+        rows[user_id] = pref
         return pref
 
     async def get_json(self, user_id: int) -> dict[str, Any]:
+        """
+        Decoded preferences. The parsed dict is memoized on the Preference instance until
+        its json changes (one update often reads prefs several times). The dict is shared: treat it
+        as read-only and build a new one to write (see merge).
+        """
         pref = await self.get(user_id)
-        obj = loads(pref.json) if pref.json else {}
-        return obj if isinstance(obj, dict) else {}
+        raw = pref.json
+        memo = pref.__dict__.get("_json_memo")
+        if memo is None or memo[0] is not raw:
+            obj = loads(raw) if raw else {}
+            memo = (raw, obj if isinstance(obj, dict) else {})
+            pref.__dict__["_json_memo"] = memo
+        return memo[1]
 
     async def set_json(self, user_id: int, obj: dict[str, Any]) -> None:
         pref = await self.get(user_id)
         pref.json = dumps(obj)
+        _touch_schedule(self.db)
 
     async def merge(self, user_id: int, patch: dict[str, Any]) -> dict[str, Any]:
-        obj = await self.get_json(user_id)
-        obj.update(patch)
+        obj = {**await self.get_json(user_id), **patch}
         await self.set_json(user_id, obj)
         return obj
 
@@ -152,6 +302,22 @@ class PlanRepo:
         obj = loads(p.plan_json)
         return obj if isinstance(obj, dict) else None
 
+    async def get_day_plans_json(self, user_id: int, start_date: dt.date, days: int) -> dict[dt.date, dict[str, Any]]:
+        """Plans for [start_date, start_date + days) in one range query over (user_id, date); missing days are absent."""
+        end_date = start_date + dt.timedelta(days=days)
+        q = (
+            select(Plan.date, Plan.plan_json)
+            .where(Plan.user_id == user_id)
+            .where(Plan.date >= start_date)
+            .where(Plan.date < end_date)
+        )
+        out: dict[dt.date, dict[str, Any]] = {}
+        for d, raw in await self.db.execute(q):
+            obj = loads(raw) if raw else None
+            if isinstance(obj, dict):
+                out[d] = obj
+        return out
+
     async def last_plan_date(self, user_id: int) -> dt.date | None:
         q: Select[tuple[Plan]] = select(Plan).where(Plan.user_id == user_id).order_by(Plan.date.desc()).limit(1)
         res = await self.db.execute(q)
@@ -363,6 +529,13 @@ class FoodRepo:
         res = await self.db.execute(q)
         return res.scalar_one_or_none()
 
+    async def get_by_barcodes(self, source: str, barcodes: list[str]) -> dict[str, Food]:
+        if not barcodes:
+            return {}
+        q: Select[tuple[Food]] = select(Food).where(Food.source == source).where(Food.barcode.in_(barcodes))
+        res = await self.db.execute(q)
+        return {f.barcode: f for f in res.scalars() if f.barcode}
+
     async def upsert(
         self,
         *,
@@ -372,16 +545,34 @@ class FoodRepo:
         brand: str | None,
         nutriments_json: str,
     ) -> Food:
-        if barcode:
-            existing = await self.get_by_barcode(source, barcode)
-            if existing:
-                existing.name = name
-                existing.brand = brand
-                existing.nutriments_json = nutriments_json
-                return existing
-
-        f = Food(source=source, barcode=barcode, name=name, brand=brand, nutriments_json=nutriments_json)
-        self.db.add(f)
-        await self.db.flush()
-        return f
+        if not barcode:
+            f = Food(source=source, barcode=barcode, name=name, brand=brand, nutriments_json=nutriments_json)
+            self.db.add(f)
+            await self.db.flush()
+            return f
+
+        # one statement against the unique (source, barcode) index: two updates caching the
+        # same product concurrently both land on one row instead of one raising IntegrityError
+        insert = _DIALECT_INSERT[self.db.get_bind().dialect.name]
+        stmt = insert(Food).values(
+            source=source, barcode=barcode, name=name, brand=brand, nutriments_json=nutriments_json
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Food.source, Food.barcode],
+            set_={
+                "name": stmt.excluded.name,
+                "brand": stmt.excluded.brand,
+                "nutriments_json": stmt.excluded.nutriments_json,
+                "updated_at": stmt.excluded.updated_at,
+            },
+        )
+        await self.db.execute(stmt)
+        q: Select[tuple[Food]] = (
+            select(Food)
+            .where(Food.source == source)
+            .where(Food.barcode == barcode)
+            .execution_options(populate_existing=True)
+        )
+        res = await self.db.execute(q)
+        return res.scalar_one()
 
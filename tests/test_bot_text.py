@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import re
+
+import pytest
+
+import src.bot as bot
+
+
+def _sanitize_regex_chain(s: str) -> str:
+    # the unconditional pass chain _sanitize_ai_text used before its marker checks
+    if not s:
+        return s
+    t = s.strip()
+    t = re.compile(r"\*\*(.+?)\*\*", re.S).sub(r"<b>\1</b>", t)
+    t = re.compile(r"__(.+?)__", re.S).sub(r"<b>\1</b>", t)
+    t = re.compile(r"(?<!\*)\*(?!\*)(.+?)(?<!\*)\*(?!\*)", re.S).sub(r"<i>\1</i>", t)
+    t = re.compile(r"(?<!_)_(?!_)(.+?)(?<!_)_(?!_)", re.S).sub(r"<i>\1</i>", t)
+    t = t.replace("•", "- ")
+    return t.replace("*", "").replace("_", "")
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "   ",
+        "plain reply without markers",
+        "  • one\n• two  ",
+        "**bold** only",
+        "__bold__ only",
+        "*italic* only",
+        "_italic_ only",
+        "**bold** and *italic*",
+        "__bold__ and _italic_",
+        "**bold** __bold__ *it* _it_",
+        "**a *b* c**",
+        "__a _b_ c__",
+        "*a __b__ c*",
+        "_a **b** c_",
+        "snake_case_name and 2*3*4",
+        "unclosed **bold and _under",
+        "***triple*** ___triple___",
+        "**multi\nline** _multi\nline_",
+        "• **Итог:** _120 ккал_ *на 100 г*",
+    ],
+)
+def test_sanitize_matches_regex_chain(text: str) -> None:
+    assert bot._sanitize_ai_text(text) == _sanitize_regex_chain(text)
+
+
+class _FakeMessage:
+    def __init__(self) -> None:
+        self.sent: list[str] = []
+
+    async def answer(self, text: str, **kwargs: object) -> None:
+        self.sent.append(text)
+
+
+def _chunk_by_concat(header: str, lines: list[str], limit: int = 3900) -> list[str]:
+    # the string-concatenating chunker _send_html_lines used before it tracked lengths
+    chunks: list[str] = []
+    cur = header.strip()
+    for ln in lines:
+        ln = str(ln or "").strip()
+        if not ln:
+            continue
+        cand = cur + ("\n" if cur else "") + ln
+        if len(cand) <= limit:
+            cur = cand
+            continue
+        if cur:
+            chunks.append(cur)
+        cur = header.strip() + "\n" + ln
+        if len(cur) > limit:
+            safe_ln = bot._HTML_LINK_RE.sub(" ", ln).strip()
+            cur = header.strip() + "\n" + safe_ln[: max(0, limit - len(header) - 1)]
+    if cur:
+        chunks.append(cur)
+    return chunks[:5]
+
+
+async def _send(header: str, lines: list[str]) -> list[str]:
+    msg = _FakeMessage()
+    await bot._send_html_lines(msg, header=header, lines=lines, reply_markup=object())
+    return msg.sent
+
+
+async def test_chunk_of_exactly_limit_is_not_split() -> None:
+    # "H" + "\n" + 3898 chars == 3900
+    sent = await _send("H", ["a" * 1000, "b" * 2897])
+    assert [len(c) for c in sent] == [3900]
+    sent = await _send("H", ["a" * 1000, "b" * 2898])
+    assert sent == ["H\n" + "a" * 1000, "H\n" + "b" * 2898]
+
+
+async def test_single_line_over_limit_is_cut_without_links() -> None:
+    link = '<a href="https://example.com/p">shop</a>'
+    sent = await _send("H", ["short", "x" * 2000 + link + "y" * 3000])
+    assert sent[0] == "H\nshort"
+    assert len(sent[1]) == 3900
+    assert "<a" not in sent[1] and sent[1].startswith("H\n" + "x" * 2000 + " y")
+
+
+@pytest.mark.parametrize(
+    ("header", "lines"),
+    [
+        ("", ["a" * 3900, "b"]),
+        ("", ["a" * 3901]),
+        ("  Header  ", ["", None, "  pad  ", "c" * 3889, "d"]),
+        ("H", ["z" * 500] * 60),  # more than five chunks: the rest is dropped
+        ("H", ["l" * 3898, "m" * 3898, "n" * 5000]),
+    ],
+)
+async def test_chunks_match_concat_chunker(header: str, lines: list[str]) -> None:
+    assert await _send(header, lines) == _chunk_by_concat(header, lines)
+
+
+def _coerce_by_regex(x: object) -> float | None:
+    # _coerce_number before its exact-type and digit-string fast paths
+    try:
+        if isinstance(x, bool):
+            return None
+        if isinstance(x, (int, float)):
+            return float(x)
+        if isinstance(x, str):
+            m = bot._NUMBER_RE.search(x.strip().replace(",", "."))
+            if m:
+                return float(m.group(0))
+    except Exception:
+        return None
+    return None
+
+
+@pytest.mark.parametrize(
+    "x",
+    [
+        True,
+        False,
+        0,
+        120,
+        -5,
+        120.5,
+        float("nan"),
+        float("inf"),
+        "120",
+        "120.5",
+        "12,5",
+        " 7 ",
+        "007",
+        "120 г",
+        "120g",
+        "≈120",
+        "-3",
+        "1e3",
+        "nan",
+        "1_000",
+        "12.",
+        ".5",
+        "1.2.3",
+        "١٢٣",
+        "",
+        "abc",
+        None,
+        [1],
+    ],
+)
+def test_coerce_number_matches_regex_path(x: object) -> None:
+    got, want = bot._coerce_number(x), _coerce_by_regex(x)
+    if isinstance(want, float) and want != want:
+        assert got != got
+    else:
+        assert got == want
+    assert type(got) is type(want)
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import datetime as dt
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import src.bot as bot
+
+PRAGUE = ZoneInfo("Europe/Prague")
+# 2026-10-16 is a Friday; Prague is UTC+2 on that date
+NOW_LOCAL = dt.datetime(2026, 10, 16, 9, 0, 30, tzinfo=PRAGUE)
+NOW_UTC = NOW_LOCAL.astimezone(dt.timezone.utc)
+TODAY = NOW_LOCAL.date().isoformat()
+
+
+def _local_ts(day: int, hh: int, mm: int) -> float:
+    return dt.datetime(2026, 10, day, hh, mm, tzinfo=PRAGUE).timestamp()
+
+
+def _wake(prefs: dict, now_utc: dt.datetime = NOW_UTC) -> float:
+    return bot._next_user_wakeup(prefs, now_utc)
+
+
+def test_no_schedule_sleeps_a_day() -> None:
+    assert _wake({}) == NOW_UTC.timestamp() + 86400.0
+
+
+@pytest.mark.parametrize(
+    ("hhmm", "expected"),
+    [
+        ("10:15", _local_ts(16, 10, 15)),  # later today
+        ("09:00", _local_ts(16, 9, 0)),  # window just opened -> due (in the past)
+        ("08:58", _local_ts(16, 8, 58)),  # last minute of the 3-minute window -> still due
+        ("08:57", _local_ts(17, 8, 57)),  # window over -> tomorrow
+        ("06:00", _local_ts(17, 6, 0)),
+    ],
+)
+def test_weight_prompt_window(hhmm: str, expected: float) -> None:
+    prefs = {"weight_prompt_enabled": True, "weight_prompt_time": hhmm}
+    assert _wake(prefs) == expected
+
+
+def test_window_tail_edge_is_exclusive() -> None:
+    prefs = {"daily_checkin_enabled": True, "daily_checkin_time": "09:00"}
+    at = dt.datetime(2026, 10, 16, 9, 0, tzinfo=PRAGUE)
+    just_inside = (at + dt.timedelta(minutes=3) - dt.timedelta(microseconds=1)).astimezone(dt.timezone.utc)
+    at_tail = (at + dt.timedelta(minutes=3)).astimezone(dt.timezone.utc)
+    assert _wake(prefs, just_inside) == at.timestamp()
+    assert _wake(prefs, at_tail) == _local_ts(17, 9, 0)
+
+
+def test_sent_today_moves_to_tomorrow() -> None:
+    prefs = {"weight_prompt_enabled": True, "weight_prompt_time": "09:00", "last_weight_prompt_date": TODAY}
+    assert _wake(prefs) == _local_ts(17, 9, 0)
+    prefs["last_weight_prompt_date"] = "2026-10-15"
+    assert _wake(prefs) == _local_ts(16, 9, 0)
+
+
+def test_default_times_when_missing() -> None:
+    assert _wake({"weight_prompt_enabled": True}) == _local_ts(17, 6, 0)
+    assert _wake({"daily_checkin_enabled": True}) == _local_ts(16, 21, 30)
+
+
+@pytest.mark.parametrize("bad", ["24:00", "12:60", "99:99", "9:00", "09:00:00", "noon", ""])
+def test_invalid_times_are_skipped(bad: str) -> None:
+    prefs = {"reminders": [{"time": bad, "days": "all", "text": "x"}]}
+    assert _wake(prefs) == NOW_UTC.timestamp() + 86400.0
+
+
+def test_disabled_prompts_are_ignored() -> None:
+    prefs = {"weight_prompt_enabled": False, "weight_prompt_time": "10:00", "daily_checkin_enabled": "yes"}
+    assert _wake(prefs) == NOW_UTC.timestamp() + 86400.0
+
+
+def test_earliest_event_wins() -> None:
+    prefs = {
+        "daily_checkin_enabled": True,
+        "daily_checkin_time": "21:30",
+        "reminders": [{"time": "12:00", "days": "all", "text": "обед"}, {"time": " 10:30 ", "days": "all", "text": "x"}],
+    }
+    assert _wake(prefs) == _local_ts(16, 10, 30)
+
+
+def test_timezone_is_respected() -> None:
+    prefs = {"weight_prompt_enabled": True, "weight_prompt_time": "10:00", "timezone": "UTC"}
+    expected = dt.datetime(2026, 10, 16, 10, 0, tzinfo=dt.timezone.utc).timestamp()
+    assert _wake(prefs) == expected
+
+
+def test_checkin_without_last_is_due_now() -> None:
+    prefs = {"checkin_every_days": 3, "weight_prompt_enabled": True, "weight_prompt_time": "10:00"}
+    assert _wake(prefs) == NOW_UTC.timestamp()
+
+
+def test_checkin_due_after_interval() -> None:
+    last = NOW_UTC - dt.timedelta(hours=60)
+    prefs = {"checkin_every_days": 3, "last_checkin_request_epoch": last.timestamp()}
+    assert _wake(prefs) == last.timestamp() + 3 * 86400.0
+    # never sleeps past a day, even when the next checkin is further out
+    prefs["last_checkin_request_epoch"] = NOW_UTC.timestamp()
+    assert _wake(prefs) == NOW_UTC.timestamp() + 86400.0
+
+
+@pytest.mark.parametrize("every", [0, -1, "3", None, False])
+def test_checkin_ignored_for_bad_interval(every: object) -> None:
+    assert _wake({"checkin_every_days": every}) == NOW_UTC.timestamp() + 86400.0
+
+
+class _FakeBot:
+    def __init__(self) -> None:
+        self.sent: list[str] = []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs: object) -> None:
+        self.sent.append(text)
+
+
+async def test_reminder_key_matches_run_user_schedule(monkeypatch: pytest.MonkeyPatch) -> None:
+    async def no_merge(*args: object, **kwargs: object) -> None:
+        return None
+
+    # keep the run from touching the DB when it sends
+    monkeypatch.setattr(bot.PreferenceRepo, "merge", no_merge)
+    # index counts every entry (incl. junk), so the valid reminder is "r1" in both functions
+    rems = ["junk", {"time": "09:00", "days": "all", "text": "перекус"}]
+
+    done = {"reminders": rems, "reminders_last_sent": {"r1": TODAY}}
+    fake = _FakeBot()
+    await bot._run_user_schedule(fake, 1, 1, done, NOW_UTC)
+    assert fake.sent == []
+    assert _wake(done) == _local_ts(17, 9, 0)
+
+    pending = {"reminders": rems, "reminders_last_sent": {"r0": TODAY}}
+    fake = _FakeBot()
+    await bot._run_user_schedule(fake, 1, 1, pending, NOW_UTC)
+    assert fake.sent == ["перекус"]
+    assert _wake(pending) == _local_ts(16, 9, 0)
+
+
+def test_last_checkin_ts_prefers_epoch() -> None:
+    prefs = {"last_checkin_request_epoch": 1_700_000_000, "last_checkin_request_utc": "2000-01-01T00:00:00"}
+    assert bot._last_checkin_ts(prefs) == 1_700_000_000.0
+
+
+def test_last_checkin_ts_iso_only() -> None:
+    when = dt.datetime(2026, 10, 1, 12, 0, tzinfo=dt.timezone.utc)
+    assert bot._last_checkin_ts({"last_checkin_request_utc": when.isoformat()}) == when.timestamp()
+    # legacy naive strings are UTC
+    assert bot._last_checkin_ts({"last_checkin_request_utc": "2026-10-01T12:00:00"}) == when.timestamp()
+
+
+@pytest.mark.parametrize(
+    "prefs",
+    [
+        {},
+        {"last_checkin_request_utc": "yesterday"},
+        {"last_checkin_request_utc": 12345},
+        {"last_checkin_request_epoch": True},
+        {"last_checkin_request_epoch": "1700000000"},
+    ],
+)
+def test_last_checkin_ts_garbage(prefs: dict) -> None:
+    assert bot._last_checkin_ts(prefs) is None
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import sqlite3
+from pathlib import Path
+
+import pytest
+from alembic import command
+from alembic.config import Config
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture
+def db_file(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    path = tmp_path / "migrate.sqlite3"
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    monkeypatch.delenv("DATABASE_URLS", raising=False)
+    monkeypatch.setenv("DB_PATH", str(path))
+    return path
+
+
+def _upgrade(rev: str) -> None:
+    cfg = Config(str(ROOT / "alembic.ini"))
+    cfg.set_main_option("script_location", str(ROOT / "alembic"))
+    command.upgrade(cfg, rev)
+
+
+def _seed_users(conn: sqlite3.Connection, *ids: int) -> None:
+    conn.executemany(
+        "INSERT INTO users (id, telegram_id, created_at, updated_at) VALUES (?, ?, '2026-01-01', '2026-01-01')",
+        [(i, 1000 + i) for i in ids],
+    )
+
+
+def test_0007_keys_daily_tables_and_keeps_latest_duplicate(db_file: Path) -> None:
+    _upgrade("0006_int_widths")
+    with sqlite3.connect(db_file) as conn:
+        _seed_users(conn, 1, 2)
+        # a schema without the unique (user_id, date) index may hold duplicates
+        conn.execute("DROP INDEX ix_weight_logs_user_date")
+        conn.executemany(
+            "INSERT INTO weight_logs (user_id, date, weight_kg, created_at) VALUES (?, ?, ?, '2026-01-01')",
+            [(1, "2026-10-01", 80.0), (1, "2026-10-01", 79.5), (1, "2026-10-02", 79.0), (2, "2026-10-01", 60.0)],
+        )
+        conn.executemany(
+            "INSERT INTO daily_checkins (user_id, date, created_at, steps, note_text) VALUES (?, ?, '2026-01-01', ?, ?)",
+            [(1, "2026-10-01", 5000, "ok"), (2, "2026-10-01", 9000, None)],
+        )
+    _upgrade("head")
+    with sqlite3.connect(db_file) as conn:
+        weights = conn.execute("SELECT user_id, date, weight_kg FROM weight_logs ORDER BY user_id, date").fetchall()
+        checkins = conn.execute("SELECT user_id, date, steps, note_text FROM daily_checkins ORDER BY user_id").fetchall()
+        pk = [r[1] for r in conn.execute("PRAGMA table_info(weight_logs)") if r[5]]
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute(
+                "INSERT INTO weight_logs (user_id, date, weight_kg, created_at) VALUES (1, '2026-10-02', 1, '2026-01-01')"
+            )
+    assert weights == [(1, "2026-10-01", 79.5), (1, "2026-10-02", 79.0), (2, "2026-10-01", 60.0)]
+    assert checkins == [(1, "2026-10-01", 5000, "ok"), (2, "2026-10-01", 9000, None)]
+    assert pk == ["user_id", "date"]
+
+
+def test_0009_dedupes_barcodes_and_makes_index_unique(db_file: Path) -> None:
+    _upgrade("0008_goals_active_index")
+    with sqlite3.connect(db_file) as conn:
+        conn.executemany(
+            "INSERT INTO foods (source, barcode, name, nutriments_json, created_at, updated_at) "
+            "VALUES (?, ?, ?, '{}', '2026-01-01', '2026-01-01')",
+            [
+                ("off", "1", "old"),
+                ("off", "1", "new"),
+                ("manual", "1", "manual"),
+                ("off", None, "loose a"),
+                ("off", None, "loose b"),
+            ],
+        )
+    _upgrade("head")
+    with sqlite3.connect(db_file) as conn:
+        rows = conn.execute("SELECT source, barcode, name FROM foods ORDER BY id").fetchall()
+        indexes = {r[1]: r[2] for r in conn.execute("PRAGMA index_list(foods)")}
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute(
+                "INSERT INTO foods (source, barcode, name, nutriments_json, created_at, updated_at) "
+                "VALUES ('off', '1', 'dup', '{}', '2026-01-01', '2026-01-01')"
+            )
+    assert rows == [("off", "1", "new"), ("manual", "1", "manual"), ("off", None, "loose a"), ("off", None, "loose b")]
+    assert indexes["ix_foods_source_barcode"] == 1
+    assert "ix_foods_barcode" not in indexes
+
+
+# foods as the pre-0009 ORM create_all (init_db) built it: both indexes non-unique
+_BASELINE_FOODS = (
+    "CREATE TABLE foods (id INTEGER NOT NULL, source VARCHAR(32) NOT NULL, barcode VARCHAR(32), "
+    "name VARCHAR(256) NOT NULL, brand VARCHAR(256), nutriments_json TEXT NOT NULL, "
+    "created_at DATETIME NOT NULL, updated_at DATETIME NOT NULL, PRIMARY KEY (id))",
+    "CREATE INDEX ix_foods_barcode ON foods (barcode)",
+    "CREATE INDEX ix_foods_source_barcode ON foods (source, barcode)",
+)
+
+
+async def test_init_db_upgrades_baseline_foods_for_upsert(db_file: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    import src.init_db
+    from src.repositories import FoodRepo
+
+    with sqlite3.connect(db_file) as conn:
+        for ddl in _BASELINE_FOODS:
+            conn.execute(ddl)
+        conn.executemany(
+            "INSERT INTO foods (source, barcode, name, nutriments_json, created_at, updated_at) "
+            "VALUES (?, ?, ?, '{}', '2026-01-01', '2026-01-01')",
+            [("off", "1", "old"), ("off", "1", "new"), ("off", None, "loose"), ("off", None, "loose")],
+        )
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{db_file}")
+    monkeypatch.setattr(src.init_db, "engine", engine)
+    try:
+        await src.init_db.init_db()
+        await src.init_db.init_db()  # idempotent once the index is unique
+        async with async_sessionmaker(engine, expire_on_commit=False)() as db:
+            food = await FoodRepo(db).upsert(source="off", barcode="1", name="newer", brand=None, nutriments_json="{}")
+            await FoodRepo(db).upsert(source="off", barcode="2", name="other", brand=None, nutriments_json="{}")
+            await db.commit()
+    finally:
+        await engine.dispose()
+
+    with sqlite3.connect(db_file) as conn:
+        rows = conn.execute("SELECT id, source, barcode, name FROM foods ORDER BY id").fetchall()
+    # the older duplicate is gone, the kept row (id 2) took the update in place
+    assert rows == [(2, "off", "1", "newer"), (3, "off", None, "loose"), (4, "off", None, "loose"), (5, "off", "2", "other")]
+    assert food.name == "newer"
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from src.nutrition import compute_targets_with_meta
+from src.nutrition import compute_targets_with_meta, compute_tdee
 
 
 def test_loss_has_deficit() -> None:
@@ -44,3 +44,17 @@ def test_gain_surplus() -> None:
     assert targets.calories > meta.tdee_kcal
     assert meta.deficit_kcal < 0
 
+
+
+def test_compute_tdee_matches_meta() -> None:
+    for goal, pct in (("loss", 0.25), ("maintain", 0.0), ("gain", -0.10)):
+        _, meta = compute_targets_with_meta(
+            sex="female",
+            age=35,
+            height_cm=165,
+            weight_kg=70,
+            activity="low",
+            goal=goal,
+            deficit_pct=pct,
+        )
+        assert compute_tdee("female", 35, 165, 70, "low") == meta.tdee_kcal
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.exc import InvalidRequestError
+
+import src.repositories as repos
+from src.models import Food
+from src.repositories import FoodRepo, PreferenceRepo, UserRepo
+
+
+@pytest.fixture(autouse=True)
+def _fresh_schedule_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(repos, "_scheduled_cache", None)
+    monkeypatch.setattr(repos, "_scheduled_prefs_memo", {})
+
+
+async def _scheduled_user(session_maker, tg: int = 100) -> int:
+    async with session_maker() as db:
+        u = await UserRepo(db).get_or_create(tg, None)
+        await UserRepo(db).update_profile(u, {"profile_complete": True})
+        await PreferenceRepo(db).set_json(u.id, {"checkin_every_days": 3})
+        await db.commit()
+        return u.id
+
+
+async def test_list_scheduled_caches_plain_rows(session_maker) -> None:
+    uid = await _scheduled_user(session_maker)
+    async with session_maker() as db:
+        rows = await UserRepo(db).list_scheduled()
+    assert rows == [(uid, 100, {"checkin_every_days": 3})]
+    assert repos._scheduled_cache is not None
+    async with session_maker() as db:
+        assert await UserRepo(db).list_scheduled() is rows
+
+
+async def test_committed_prefs_write_drops_schedule_cache(session_maker) -> None:
+    uid = await _scheduled_user(session_maker)
+    async with session_maker() as db:
+        await UserRepo(db).list_scheduled()
+    assert repos._scheduled_cache is not None
+
+    async with session_maker() as db:
+        await PreferenceRepo(db).merge(uid, {"checkin_every_days": 7})
+        assert repos._scheduled_cache is not None  # not before the commit
+        await db.commit()
+    assert repos._scheduled_cache is None
+
+    async with session_maker() as db:
+        assert await UserRepo(db).list_scheduled() == [(uid, 100, {"checkin_every_days": 7})]
+
+
+async def test_committed_profile_complete_write_drops_schedule_cache(session_maker) -> None:
+    await _scheduled_user(session_maker)
+    async with session_maker() as db:
+        await UserRepo(db).list_scheduled()
+        user = await UserRepo(db).get_or_create(100, None)
+        await UserRepo(db).update_profile(user, {"profile_complete": False})
+        await db.commit()
+    assert repos._scheduled_cache is None
+    async with session_maker() as db:
+        assert await UserRepo(db).list_scheduled() == []
+
+
+async def test_rollback_keeps_schedule_cache(session_maker) -> None:
+    uid = await _scheduled_user(session_maker)
+    async with session_maker() as db:
+        rows = await UserRepo(db).list_scheduled()
+    async with session_maker() as db:
+        await PreferenceRepo(db).merge(uid, {"reminders": []})
+        await db.rollback()
+    assert repos._scheduled_cache is not None
+    # the rolled-back tag doesn't leak into the next commit of the same session
+    async with session_maker() as db:
+        await PreferenceRepo(db).merge(uid, {"reminders": []})
+        await db.rollback()
+        await db.commit()
+    async with session_maker() as db:
+        assert await UserRepo(db).list_scheduled() is rows
+
+
+async def test_dialog_data_decoded_once_until_set_dialog(session_maker) -> None:
+    async with session_maker() as db:
+        repo = UserRepo(db)
+        user = await repo.get_or_create(1, None)
+        await repo.set_dialog(user, state="s", step=1, data={"profile": {"age": 30}})
+        first = await repo.get_dialog_data(user)
+        assert first == {"profile": {"age": 30}}
+        assert await repo.get_dialog_data(user) is first
+
+
+async def test_set_dialog_drops_dialog_memo(session_maker) -> None:
+    async with session_maker() as db:
+        repo = UserRepo(db)
+        user = await repo.get_or_create(1, None)
+        await repo.set_dialog(user, state="s", step=1, data={"n": 1})
+        assert await repo.get_dialog_data(user) == {"n": 1}
+        await repo.set_dialog(user, state="s", step=2, data={"n": 2})
+        assert "_dialog_data_memo" not in user.__dict__
+        assert await repo.get_dialog_data(user) == {"n": 2}
+        await repo.set_dialog(user, state=None, step=None, data=None)
+        assert await repo.get_dialog_data(user) is None
+
+
+async def test_get_json_memo_survives_until_write(session_maker) -> None:
+    async with session_maker() as db:
+        repo = PreferenceRepo(db)
+        await repo.set_json(1, {"reminders": [{"time": "09:00"}], "reminders_last_sent": {"r0": "2026-10-16"}})
+        first = await repo.get_json(1)
+        assert await repo.get_json(1) is first
+        merged = await repo.merge(1, {"reminders_last_sent": {"r0": "2026-10-17"}})
+        # merge builds a new dict: what earlier readers hold is untouched
+        assert first["reminders_last_sent"] == {"r0": "2026-10-16"}
+        assert await repo.get_json(1) == merged == {"reminders": [{"time": "09:00"}], "reminders_last_sent": {"r0": "2026-10-17"}}
+
+
+async def test_food_upsert_updates_row_cached_by_another_session(session_maker, monkeypatch: pytest.MonkeyPatch) -> None:
+    async def stale_miss(self: FoodRepo, source: str, barcode: str) -> None:
+        return None
+
+    # every lookup misses, as if the other session's row landed right after it
+    monkeypatch.setattr(FoodRepo, "get_by_barcode", stale_miss)
+    async with session_maker() as a, session_maker() as b:
+        await FoodRepo(b).upsert(source="off", barcode="123", name="old", brand=None, nutriments_json="{}")
+        await b.commit()
+        food = await FoodRepo(a).upsert(source="off", barcode="123", name="new", brand="B", nutriments_json='{"kcal_100g": 1}')
+        await a.commit()
+    assert (food.name, food.brand, food.nutriments_json) == ("new", "B", '{"kcal_100g": 1}')
+    async with session_maker() as db:
+        rows = (await db.execute(select(Food).where(Food.barcode == "123"))).scalars().all()
+    assert [(f.id, f.name) for f in rows] == [(food.id, "new")]
+
+
+async def test_food_upsert_refreshes_instance_in_session(session_maker) -> None:
+    async with session_maker() as db:
+        repo = FoodRepo(db)
+        first = await repo.upsert(source="off", barcode="9", name="a", brand=None, nutriments_json="{}")
+        second = await repo.upsert(source="off", barcode="9", name="b", brand=None, nutriments_json="{}")
+        assert second is first and first.name == "b"
+        other = await repo.upsert(source="manual", barcode="9", name="c", brand=None, nutriments_json="{}")
+        assert other.id != first.id
+        nobarcode = [await repo.upsert(source="off", barcode=None, name="x", brand=None, nutriments_json="{}") for _ in range(2)]
+        assert nobarcode[0].id != nobarcode[1].id
+
+
+async def test_profile_context_needs_food_prefs_loaded(session_maker) -> None:
+    from src.bot import _profile_context
+
+    async with session_maker() as db:
+        user = await UserRepo(db).get_or_create(7, None)
+        await UserRepo(db).update_profile(user, {"allergies": "орехи", "favorite_products": "творог"})
+        await db.commit()
+
+    async with session_maker() as db:
+        user = await UserRepo(db).get_or_create(7, None)
+        with pytest.raises(InvalidRequestError):
+            _profile_context(user)
+
+    async with session_maker() as db:
+        user = await UserRepo(db).get_or_create(7, None, food_prefs=True)
+        text = _profile_context(user)
+    assert "аллергии: орехи" in text and "любимые продукты: творог" in text
+
+
+async def test_new_user_profile_context_without_reload(session_maker) -> None:
+    from src.bot import _profile_context
+
+    async with session_maker() as db:
+        user = await UserRepo(db).get_or_create(8, None)
+        assert "аллергии: None" in _profile_context(user)